@@ -1,8 +1,13 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import time
+
 import uproot
-import pandas as pd
 import numpy as np
 import argh
-import vector
+
+from rlasim.lib.kinematics import boost_to_rest_frame, invariant_mass
 
 
 def srq_check(px, py, pz, E, m):
@@ -17,183 +22,97 @@ def srq_check(px, py, pz, E, m):
 
     # Lta = Lat = lambda i: -v
 
-def main(infile='data/single_mode_train.root', outfile='data/single_mode_train_rot.root'):
-
-    print("Attempting eta load")
-    file = uproot.open(infile)["DecayTree"]
-    keys = file.keys()
-
-    print(keys)
-
-    results_np = file.arrays(keys, library="np")
-
-
-    results = pd.DataFrame.from_dict(results_np)
-    mother_P = np.sqrt(results.mother_PX ** 2 + results.mother_PY ** 2 + results.mother_PZ ** 2)
-    mother_P_true = np.sqrt(
-        results.mother_PX_TRUE ** 2 + results.mother_PY_TRUE ** 2 + results.mother_PZ_TRUE ** 2)
-
-    pe_1 = np.sqrt(
-        results.particle_1_M ** 2 + results.particle_1_PX ** 2 + results.particle_1_PY ** 2 + results.particle_1_PZ ** 2)
-    pe_2 = np.sqrt(
-        results.particle_2_M ** 2 + results.particle_2_PX ** 2 + results.particle_2_PY ** 2 + results.particle_2_PZ ** 2)
-    pe_3 = np.sqrt(
-        results.particle_3_M ** 2 + results.particle_3_PX ** 2 + results.particle_3_PY ** 2 + results.particle_3_PZ ** 2)
-
-    pe = pe_1 + pe_2 + pe_3
-    px = results.particle_1_PX + results.particle_2_PX + results.particle_3_PX
-    py = results.particle_1_PY + results.particle_2_PY + results.particle_3_PY
-    pz = results.particle_1_PZ + results.particle_2_PZ + results.particle_3_PZ
-
-    B = vector.array({"px": px.to_numpy(), "py": py.to_numpy(), "pz": pz.to_numpy(), "E": pe.to_numpy()})
-
-    P1 = vector.array(
-        {"px": results.particle_1_PX, "py": results.particle_1_PY, "pz": results.particle_1_PZ, "E": pe_1})
-    P2 = vector.array(
-        {"px": results.particle_2_PX, "py": results.particle_2_PY, "pz": results.particle_2_PZ, "E": pe_2})
-    P3 = vector.array(
-        {"px": results.particle_3_PX, "py": results.particle_3_PY, "pz": results.particle_3_PZ, "E": pe_3})
-
-    P1_ROT = P1.boostCM_of(B)
-    P2_ROT = P2.boostCM_of(B)
-    P3_ROT = P3.boostCM_of(B)
-
-    PM_ROT = B.boostCM_of(B)
-
-
-
-    pe_1_true = np.sqrt(
-        results.particle_1_M_TRUE ** 2 + results.particle_1_PX_TRUE ** 2 + results.particle_1_PY_TRUE ** 2 + results.particle_1_PZ_TRUE ** 2)
-    pe_2_true = np.sqrt(
-        results.particle_2_M_TRUE ** 2 + results.particle_2_PX_TRUE ** 2 + results.particle_2_PY_TRUE ** 2 + results.particle_2_PZ_TRUE ** 2)
-    pe_3_true = np.sqrt(
-        results.particle_3_M_TRUE ** 2 + results.particle_3_PX_TRUE ** 2 + results.particle_3_PY_TRUE ** 2 + results.particle_3_PZ_TRUE ** 2)
-
-    pe_true = pe_1_true + pe_2_true + pe_3_true
-    px_true = results.particle_1_PX_TRUE + results.particle_2_PX_TRUE + results.particle_3_PX_TRUE
-    py_true = results.particle_1_PY_TRUE + results.particle_2_PY_TRUE + results.particle_3_PY_TRUE
-    pz_true = results.particle_1_PZ_TRUE + results.particle_2_PZ_TRUE + results.particle_3_PZ_TRUE
-
-
-    B_true = vector.array({"px": px_true.to_numpy(), "py": py_true.to_numpy(), "pz": pz_true.to_numpy(), "E": pe_true.to_numpy()})
-
-    P1_true = vector.array(
-        {"px": results.particle_1_PX_TRUE, "py": results.particle_1_PY_TRUE, "pz": results.particle_1_PZ_TRUE, "E": pe_1_true})
-    P2_true = vector.array(
-        {"px": results.particle_2_PX_TRUE, "py": results.particle_2_PY_TRUE, "pz": results.particle_2_PZ_TRUE, "E": pe_2_true})
-    P3_true = vector.array(
-        {"px": results.particle_3_PX_TRUE, "py": results.particle_3_PY_TRUE, "pz": results.particle_3_PZ_TRUE, "E": pe_3_true})
-
-
-    P1_ROT_TRUE = P1_true.boostCM_of(B_true)
-    P2_ROT_TRUE = P2_true.boostCM_of(B_true)
-    P3_ROT_TRUE = P3_true.boostCM_of(B_true)
-
-    PM_ROT_TRUE = B_true.boostCM_of(B_true)
-
-
-    print(type(B_true[0].px))
-
-    srq_check(B_true[0].px, B_true[0].py, B_true[0].pz, B_true[0].E, B_true[0].mass)
-
-
-    print(PM_ROT.mass)
-    print(P1_ROT.mass)
-    print(P2_ROT.mass)
-    print(P3_ROT.mass)
-
-    print(PM_ROT_TRUE.mass)
-    print(P1_ROT_TRUE.mass)
-    print(P2_ROT_TRUE.mass)
-    print(P3_ROT_TRUE.mass)
-
-    outdata = {'nEvent': results_np['nEvent'],
-               'mother_PX': PM_ROT.px,
-               'mother_PX_TRUE': PM_ROT_TRUE.px,
-               'mother_PY': PM_ROT.py,
-               'mother_PY_TRUE': PM_ROT_TRUE.py,
-               'mother_PZ': PM_ROT.pz,
-               'mother_PZ_TRUE': PM_ROT_TRUE.pz,
-               'mother_E': PM_ROT.E,
-               'mother_E_TRUE': PM_ROT_TRUE.E,
-               'mother_M': PM_ROT.mass,
-               'mother_M_TRUE': PM_ROT_TRUE.mass,
-               'particle_1_PX': P1_ROT.px,
-               'particle_1_PX_TRUE': P1_ROT_TRUE.px,
-               'particle_2_PX': P2_ROT.px,
-               'particle_2_PX_TRUE': P2_ROT_TRUE.px,
-               'particle_3_PX': P3_ROT.px,
-               'particle_3_PX_TRUE': P3_ROT_TRUE.px,
-               'particle_1_PY': P1_ROT.py,
-               'particle_1_PY_TRUE': P1_ROT_TRUE.py,
-               'particle_2_PY': P2_ROT.py,
-               'particle_2_PY_TRUE':  P2_ROT_TRUE.py,
-               'particle_3_PY': P3_ROT.py,
-               'particle_3_PY_TRUE':  P3_ROT_TRUE.py,
-               'particle_1_PZ': P1_ROT.pz,
-               'particle_1_PZ_TRUE':  P1_ROT_TRUE.pz,
-               'particle_2_PZ': P2_ROT.pz,
-               'particle_2_PZ_TRUE': P2_ROT_TRUE.pz,
-               'particle_3_PZ': P3_ROT.pz,
-               'particle_3_PZ_TRUE': P3_ROT_TRUE.pz,
-               'particle_1_E': P1_ROT.E,
-               'particle_1_E_TRUE': P1_ROT_TRUE.E,
-               'particle_2_E': P2_ROT.E,
-               'particle_2_E_TRUE': P2_ROT_TRUE.E,
-               'particle_3_E': P3_ROT.E,
-               'particle_3_E_TRUE': P3_ROT_TRUE.E,
-               'particle_1_M': P1_ROT.mass,
-               'particle_1_M_TRUE': P1_ROT_TRUE.mass,
-               'particle_2_M': P2_ROT.mass,
-               'particle_2_M_TRUE': P2_ROT_TRUE.mass,
-               'particle_3_M': P3_ROT.mass,
-               'particle_3_M_TRUE': P3_ROT_TRUE.mass,
-               'mother_PID': results_np['mother_PID'],
-               'particle_1_PID': results_np['particle_1_PID'],
-               'particle_2_PID': results_np['particle_2_PID'],
-               'particle_3_PID': results_np['particle_3_PID'],
-               }
-
-    # results = pd.DataFrame.from_dict(outdata)
-    # mother_P = np.sqrt(results.mother_PX ** 2 + results.mother_PY ** 2 + results.mother_PZ ** 2)
-    # mother_P_true = np.sqrt(
-    #     results.mother_PX_TRUE ** 2 + results.mother_PY_TRUE ** 2 + results.mother_PZ_TRUE ** 2)
-    #
-    # pe_1 = np.sqrt(
-    #     results.particle_1_M ** 2 + results.particle_1_PX ** 2 + results.particle_1_PY ** 2 + results.particle_1_PZ ** 2)
-    # pe_2 = np.sqrt(
-    #     results.particle_2_M ** 2 + results.particle_2_PX ** 2 + results.particle_2_PY ** 2 + results.particle_2_PZ ** 2)
-    # pe_3 = np.sqrt(
-    #     results.particle_3_M ** 2 + results.particle_3_PX ** 2 + results.particle_3_PY ** 2 + results.particle_3_PZ ** 2)
-    #
-    # pe = pe_1 + pe_2 + pe_3
-    # px = results.particle_1_PX + results.particle_2_PX + results.particle_3_PX
-    # py = results.particle_1_PY + results.particle_2_PY + results.particle_3_PY
-    # pz = results.particle_1_PZ + results.particle_2_PZ + results.particle_3_PZ
-    #
-    # B = vector.array({"px": px.to_numpy(), "py": py.to_numpy(), "pz": pz.to_numpy(), "E": pe.to_numpy()})
-    #
-    # P1 = vector.array(
-    #     {"px": results.particle_1_PX, "py": results.particle_1_PY, "pz": results.particle_1_PZ, "E": pe_1})
-    # P2 = vector.array(
-    #     {"px": results.particle_2_PX, "py": results.particle_2_PY, "pz": results.particle_2_PZ, "E": pe_2})
-    # P3 = vector.array(
-    #     {"px": results.particle_3_PX, "py": results.particle_3_PY, "pz": results.particle_3_PZ, "E": pe_3})
-    #
-    # # P1_ROT = P1.boostCM_of(B)
-    # # P2_ROT = P2.boostCM_of(B)
-    # # P3_ROT = P3.boostCM_of(B)
-    # #
-    # # PM_ROT = B.boostCM_of(B)
-    #
-    # print(P3.mass)
-    #
-    # 0/0
-
-    file2 = uproot.recreate(outfile)
-    file2['DecayTree'] = outdata
-    file2.close()
+def boost_arrays(results_np):
+    """
+    Boosts the reconstructed and the true decay products of a chunk of events into the rest frame of their parent
+    (the sum of the three), with plain numpy kernels.
+    :param results_np: dict of numpy arrays of the input tree
+    :return: dict of the output tree, same branches as before
+    """
+    boosted = {}
+    for suffix in ['', '_TRUE']:
+        momenta = np.stack([np.stack([results_np['particle_%d_%s%s' % (i, c, suffix)] for c in ['PX', 'PY', 'PZ']],
+                                     axis=-1) for i in [1, 2, 3]], axis=1)
+        masses = np.stack([results_np['particle_%d_M%s' % (i, suffix)] for i in [1, 2, 3]], axis=1)
+        energies = np.sqrt(masses ** 2 + np.sum(momenta ** 2, axis=-1))
+
+        parent_momenta = np.sum(momenta, axis=1)
+        parent_energies = np.sum(energies, axis=1)
+        momenta_rot, energies_rot = boost_to_rest_frame(momenta, energies, parent_momenta[:, np.newaxis],
+                                                        parent_energies[:, np.newaxis])
+        parent_momenta_rot, parent_energies_rot = boost_to_rest_frame(parent_momenta, parent_energies,
+                                                                      parent_momenta, parent_energies)
+
+        boosted['mother' + suffix] = (parent_momenta_rot, parent_energies_rot,
+                                      invariant_mass(parent_momenta_rot, parent_energies_rot))
+        for i in [1, 2, 3]:
+            boosted['particle_%d%s' % (i, suffix)] = (momenta_rot[:, i - 1], energies_rot[:, i - 1],
+                                                     invariant_mass(momenta_rot[:, i - 1], energies_rot[:, i - 1]))
+
+    outdata = {'nEvent': results_np['nEvent']}
+    for particles in [['mother'], ['particle_1', 'particle_2', 'particle_3']]:
+        for c_idx, c in enumerate(['PX', 'PY', 'PZ', 'E', 'M']):
+            for particle in particles:
+                for suffix in ['', '_TRUE']:
+                    momenta_rot, energies_rot, masses_rot = boosted[particle + suffix]
+                    if c_idx < 3:
+                        outdata['%s_%s%s' % (particle, c, suffix)] = momenta_rot[:, c_idx]
+                    else:
+                        outdata['%s_%s%s' % (particle, c, suffix)] = energies_rot if c == 'E' else masses_rot
+    for particle in ['mother', 'particle_1', 'particle_2', 'particle_3']:
+        outdata[particle + '_PID'] = results_np[particle + '_PID']
+    return outdata
+
+
+# Branches of the input tree boost_arrays needs
+input_branches = ['nEvent'] + ['%s_PID' % p for p in ['mother', 'particle_1', 'particle_2', 'particle_3']] + \
+                 ['particle_%d_%s%s' % (i, c, suffix) for i in [1, 2, 3] for c in ['PX', 'PY', 'PZ', 'M']
+                  for suffix in ['', '_TRUE']]
+
+
+def boost_range(infile, tree_name, start, stop):
+    # Runs in the worker processes, every one opens the file itself
+    with uproot.open(infile) as file:
+        return boost_arrays(file[tree_name].arrays(input_branches, entry_start=start, entry_stop=stop, library='np'))
+
+
+def iterate_boosted_parallel(infile, tree_name, chunk_size, num_workers):
+    # Chunks come back in order, at most two per worker are in flight so memory stays bounded
+    with uproot.open(infile) as file:
+        num_entries = file[tree_name].num_entries
+    ranges = [(start, min(start + chunk_size, num_entries)) for start in range(0, num_entries, chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        in_flight = collections.deque()
+        for start, stop in ranges:
+            in_flight.append(executor.submit(boost_range, infile, tree_name, start, stop))
+            if len(in_flight) >= 2 * num_workers:
+                yield in_flight.popleft().result()
+        while len(in_flight) > 0:
+            yield in_flight.popleft().result()
+
+
+def main(infile='data/training25.root', outfile='data/training25_rot.root', chunk_size=1000000, num_workers=0,
+         tree_name='DecayTree'):
+    # Boosts the decay products into the rest frame of the parent chunk by chunk, so the memory needed depends on
+    # chunk_size and not on the size of the file. num_workers > 0 boosts the chunks in that many processes.
+    t1 = time.time()
+    if num_workers > 0:
+        chunks = iterate_boosted_parallel(infile, tree_name, chunk_size, num_workers)
+    else:
+        chunks = (boost_arrays(results_np) for results_np in
+                  uproot.iterate('%s:%s' % (infile, tree_name), input_branches, step_size=chunk_size, library='np'))
+
+    num_events = 0
+    with uproot.recreate(outfile) as file2:
+        for outdata in chunks:
+            if num_events == 0:
+                file2[tree_name] = outdata
+            else:
+                file2[tree_name].extend(outdata)
+            num_events += len(outdata['nEvent'])
+            print("Boosted %d events, %.1f s" % (num_events, time.time() - t1))
 
 
 if __name__=='__main__':
-    argh.dispatch_command(main(infile='data/training25.root', outfile='data/training25_rot.root'))
\ No newline at end of file
+    argh.dispatch_command(main)
@@ -0,0 +1,42 @@
+import time
+
+import argh
+
+from rlasim.lib.data_core import RootBlockShuffledSubsetDataset
+
+
+def main(root_file, block_size=4096, num_blocks=100, num_subsets=3, workers='1,2,4,8',
+         executors='thread,process,async', backend='uproot', latency=0.0):
+    # Reads a few subsets with every executor / worker count combination and reports the throughput. For async the
+    # worker count is the number of reads in flight. latency (seconds) is added to every read in the main process to
+    # emulate a network file system.
+    if latency > 0:
+        read_root_file = RootBlockShuffledSubsetDataset.read_root_file
+
+        def slow_read_root_file(self, *args):
+            time.sleep(latency)
+            return read_root_file(self, *args)
+        RootBlockShuffledSubsetDataset.read_root_file = slow_read_root_file
+
+    for executor in executors.split(','):
+        for num_workers in [int(w) for w in workers.split(',')]:
+            dataset = RootBlockShuffledSubsetDataset(root_file, block_size=block_size, num_blocks=num_blocks,
+                                                     backend=backend, read_executor=executor,
+                                                     num_read_workers=num_workers, max_in_flight=num_workers,
+                                                     prefetch_subsets=1)
+            t1 = time.time()
+            num_bytes = 0
+            for i in range(num_subsets):
+                dataset.prepare_next_epoch(release=True)
+                dataset.get_no_masking(0)
+                num_bytes += sum(v.nbytes for v in dataset.current_sampled_subset.values())
+            elapsed = time.time() - t1
+            dataset.exit()
+
+            blocks = num_subsets * num_blocks
+            print("%8s %2d workers: %8.1f blocks/s %8.1f MB/s" % (executor, num_workers, blocks / elapsed,
+                                                                   num_bytes / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
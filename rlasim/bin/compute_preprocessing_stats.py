@@ -0,0 +1,27 @@
+import os
+import time
+
+import argh
+
+from rlasim.lib.data_core import load_branch_stats, resolve_input_files, packed_feature_branches, \
+    get_branch_stats_path
+
+
+def main(input_file, tree_name='DecayTree', backend='uproot', selection=None):
+    # One pass over every file to compute the min, max, mean, std and quantiles of the momenta, stored next to the
+    # files. With precomputed_stats: True in data_params the training then loads them instead of estimating them from
+    # batches. selection has to be the one in data_params, if any.
+    branches = packed_feature_branches['momenta'] + packed_feature_branches['momenta_mother']
+    for file_path in resolve_input_files(input_file):
+        t1 = time.time()
+        stats = load_branch_stats(file_path, branches, tree_name=tree_name, backend=backend, selection=selection)
+        stats_path = os.path.join(file_path, 'stats.json') if backend == 'columnar' else get_branch_stats_path(file_path)
+        print("%s: %d entries, %.1f s -> %s" % (file_path, stats['num_entries'], time.time() - t1, stats_path))
+        for b in branches:
+            x = stats['branches'][b]
+            print("  %-16s min %12.4f  max %12.4f  mean %12.4f  std %12.4f  q0.001 %12.4f  q0.999 %12.4f" % (
+                b, x['min'], x['max'], x['mean'], x['std'], x['quantiles']['0.001'], x['quantiles']['0.999']))
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
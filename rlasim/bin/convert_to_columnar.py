@@ -0,0 +1,16 @@
+import argh
+
+from rlasim.lib.data_core import convert_root_to_columnar, get_columnar_cache_path
+
+
+def main(root_file, output_dir=None, tree_name='DecayTree', chunk_size=1000000):
+    # Writes one memory mapped .npy file per branch. Use backend: 'columnar' in data_params to train from it.
+    if output_dir is None:
+        output_dir = get_columnar_cache_path(root_file)
+    print("Converting", root_file, "to", output_dir)
+    convert_root_to_columnar(root_file, output_dir, tree_name=tree_name, chunk_size=chunk_size)
+    print("Done")
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
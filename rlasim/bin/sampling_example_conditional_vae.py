@@ -10,7 +10,7 @@ import argh
 from rlasim.lib.utils import load_checkpoint
 
 from pytorch_lightning import Trainer
-from rlasim.lib.organise_data import ThreeBodyDecayDataset
+from rlasim.lib.organise_data import ThreeBodyDecayDataset, get_required_branches
 
 
 
@@ -34,7 +34,9 @@ def main(config_file='configs/vae_conditional_7.yaml', only_summary=False, data_
 	# A subset of the full dataset will be sampled (with total samples equal to num_blocks*block_size).
 	# Leave num_blocks=-1 for the full dataset.
 	# The first parameter is the path of the root file you can use your own path as well.
-	loader = RootBlockShuffledSubsetDataLoader(config['data_params']['data_path']['validate']['path'], block_size=1000, num_blocks=100, batch_size=1024)
+	# Only the branches needed by the model and the plots are read, see get_required_branches.
+	loader = RootBlockShuffledSubsetDataLoader(config['data_params']['data_path']['validate']['path'], block_size=1000, num_blocks=100, batch_size=1024,
+											   branches=get_required_branches(config))
 
 	# Don't have to call it, but it's nice to see the progress
 	loader.wait_to_load()
@@ -57,7 +59,7 @@ def main(config_file='configs/vae_conditional_7.yaml', only_summary=False, data_
 	print("All done, exiting...")
 
 	# This loader starts some threads in the background so you should also exit it in the end.
-	# This might take O(10s) but you can kill the program as well.
+	# Reads that are in progress are dropped, so this returns right away.
 	print("All done just waiting to exit")
 	loader.exit()
 
@@ -15,7 +15,7 @@ from rlasim.lib.networks_conditional import MlpConditionalVAE, BaseVAE
 import os
 import argh
 
-from rlasim.lib.organise_data import ThreeBodyDecayDataset
+from rlasim.lib.organise_data import ThreeBodyDecayDataset, get_required_branches
 from rlasim.lib.utils import load_checkpoint
 
 
@@ -27,6 +27,8 @@ def main(config_file='configs/vae_conditional_7.yaml', predict=False):
         print(exc)
         exit()
 
+    # Only read the branches that the model, the losses and the plots consume
+    config['data_params']['branches'] = get_required_branches(config)
     data = ThreeBodyDecayDataset(**config["data_params"])
     vae_network = MlpConditionalVAE(**config["model_params"])
 
@@ -56,7 +58,9 @@ def main(config_file='configs/vae_conditional_7.yaml', predict=False):
         Path(f"{tb_logger.log_dir}/gsamples").mkdir(exist_ok=True, parents=True)
 
         print(f"======= Training {config['model_params']['name']} =======")
-        runner.fit(experiment, datamodule=data)
+        # Resuming from a full checkpoint also restores the position of the data loaders
+        resume_path = config['checkpoint'].get('resume', '')
+        runner.fit(experiment, datamodule=data, ckpt_path=resume_path if resume_path else None)
 
     data.exit()
 
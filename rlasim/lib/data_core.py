@@ -1,10 +1,21 @@
+import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import copy
 import math
+import multiprocessing
+import os
 from typing import Dict, Union, Type, Tuple, Callable, Optional, Iterable
 
 import uproot
 
 from rlasim.lib.progress_bar import AsyncProgressBar
+from rlasim.lib.root_io import downcast_arrays, get_columnar_cache_path, convert_root_to_columnar, \
+    is_columnar_cache_valid, ColumnarTree, open_tree, read_range_to_shared_memory, shared_memory_arrays, \
+    resolve_input_files, load_tree_index, basket_boundaries_from_index, get_tree_index_path, \
+    discard_shared_memory_future, EventSelection, load_channel_index, load_branch_stats, combine_branch_stats, \
+    get_branch_stats_path
 
 torch_installed = True
 try:
@@ -55,6 +66,7 @@ def get_pdgid(name_):
 
     return int(respective[0].pdgid)
 
+
 if torch_installed:
     import re
 
@@ -131,46 +143,225 @@ if torch_installed:
 
 
     def nbe_default_collate(batch):
+        # Datasets with __getitems__ return the whole batch as a dict already, there is nothing to join
+        if isinstance(batch, collections.abc.Mapping):
+            return {k: torch.as_tensor(v) for k, v in batch.items()}
         return collate(batch, collate_fn_map=nbe_collate_fn_map)
 
 
+    def batch_indices(indices):
+        """
+        Indices of a batch from a batch sampler as something to index all the columns with at once.
+        :param indices: list or array of row indices
+        :return: a slice if the indices are a contiguous increasing range (the columns are then only viewed), otherwise
+                 an int64 numpy array
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+            return slice(int(indices[0]), int(indices[-1]) + 1)
+        return indices
+
+
+
+    def reuse_array(array, shape, dtype):
+        """
+        Leading rows of array, or of the array it is a view of, as an array of the given shape and dtype if they fit.
+        Subsets shortened by a selection are views of the arrays they were assembled in, this lets the next subset
+        use the full arrays again.
+        :return: np.ndarray or None if array can't be reused
+        """
+        for candidate in [array, getattr(array, 'base', None)]:
+            if isinstance(candidate, np.ndarray) and candidate.dtype == dtype and \
+                    candidate.shape[1:] == tuple(shape[1:]) and candidate.shape[0] >= shape[0] and \
+                    candidate.flags.c_contiguous:
+                return candidate[:shape[0]]
+        return None
+
+
+    class DictArrayAssembler:
+        """
+        Writes blocks of dicts of numpy arrays or torch tensors straight into preallocated per key destinations, so
+        joining them needs no intermediate copies. The rows of a block added at offset go to rows [offset, offset + n)
+        of the result. With a permutation, finish() shuffles the result in place so that its row i is row
+        permutation[i] of the joined blocks, one key at a time through a single scratch array. Scattering every block
+        to its permuted rows directly was measured ~3x slower than this (random writes of small blocks vs one gather
+        per key). Blocks can be added from multiple threads and in any order.
+
+        :param length: Number of rows of the result, an int or a dict with one per key
+        :param permutation: Optional permutation of range(length) (numpy), only with a single length
+        :param out: Optional dict of arrays to write into, used for the keys where shape and dtype match
+        :param to_numpy: Write torch tensors into numpy destinations, moving them to the cpu block by block instead of
+                         joining on the device and copying the result
+        """
+        def __init__(self, length, permutation=None, out=None, to_numpy=False):
+            self.length = length
+            self.permutation = permutation
+            self.out = out
+            self.to_numpy = to_numpy
+
+            self.result = {}
+            self._torch_permutations = {}
+            self._lock = threading.Lock()
+
+        def _length_of(self, key):
+            return self.length[key] if isinstance(self.length, dict) else self.length
+
+        def _destination(self, key, value):
+            with self._lock:
+                if key in self.result:
+                    return self.result[key]
+
+                shape = (self._length_of(key),) + tuple(value.shape[1:])
+                if isinstance(value, np.ndarray) or self.to_numpy:
+                    dtype = value.dtype if isinstance(value, np.ndarray) else torch.empty(0, dtype=value.dtype).numpy().dtype
+                    reusable = reuse_array(self.out.get(key, None), shape, dtype) if self.out is not None else None
+                    destination = reusable if reusable is not None else np.empty(shape, dtype=dtype)
+                else:
+                    destination = torch.empty(shape, dtype=value.dtype, device=value.device)
+                self.result[key] = destination
+                return destination
+
+        def add_array(self, key, value, offset):
+            destination = self._destination(key, value)
+            if isinstance(destination, np.ndarray) and not isinstance(value, np.ndarray):
+                value = value.detach().cpu().numpy()
+            destination[offset:offset + len(value)] = value
+
+        def add(self, block, offset):
+            for key, value in block.items():
+                self.add_array(key, value, offset)
+
+        def add_rows(self, block, rows):
+            """
+            Like add, but row i of the block goes to row rows[i] of the result, for blocks made of many short pieces.
+            """
+            for key, value in block.items():
+                destination = self._destination(key, value)
+                if isinstance(destination, np.ndarray) and not isinstance(value, np.ndarray):
+                    value = value.detach().cpu().numpy()
+                destination[rows] = value
+
+        def finish(self):
+            """
+            Applies the permutation, if any, and returns the result. Call once after all the blocks have been added.
+            """
+            if self.permutation is None:
+                return self.result
+
+            scratch = {}
+            for key, destination in self.result.items():
+                if isinstance(destination, np.ndarray):
+                    # One scratch column per shape and dtype is reused for all the keys that have it
+                    scratch_key = (destination.shape, destination.dtype)
+                    if scratch_key not in scratch:
+                        scratch[scratch_key] = np.empty_like(destination)
+                    np.take(destination, self.permutation, axis=0, out=scratch[scratch_key])
+                    destination[...] = scratch[scratch_key]
+                else:
+                    if destination.device not in self._torch_permutations:
+                        self._torch_permutations[destination.device] = torch.from_numpy(self.permutation).to(
+                            destination.device)
+                    destination.copy_(destination[self._torch_permutations[destination.device]])
+            return self.result
+
+
+    def tensors_dict_join(list_of_dicts, permutation=None, to_numpy=False):
+        """
+        Concatenates a list of dicts of numpy arrays or torch tensors key by key.
+        :param list_of_dicts: list of dicts, the values have the number of rows as first dimension
+        :param permutation: optional numpy permutation to shuffle the rows in the same pass, see DictArrayAssembler
+        :param to_numpy: return numpy arrays, torch tensors are moved to the cpu block by block
+        :return: dict of the joined arrays
+        """
+        lengths = collections.defaultdict(int)
+        for dictionary in list_of_dicts:
+            for key, tensor in dictionary.items():
+                lengths[key] += len(tensor)
 
-    def tensors_dict_join(list_of_dicts):
-        collected_tensors = {}
-
+        assembler = DictArrayAssembler(dict(lengths), permutation=permutation, to_numpy=to_numpy)
+        offsets = collections.defaultdict(int)
         for dictionary in list_of_dicts:
             for key, tensor in dictionary.items():
-                if key in collected_tensors:
-                    collected_tensors[key].append(tensor)
-                else:
-                    collected_tensors[key] = [tensor]
+                assembler.add_array(key, tensor, offsets[key])
+                offsets[key] += len(tensor)
 
-        concatenated_dict = {}
+        return assembler.finish()
 
-        for key, tensor_list in collected_tensors.items():
-            if isinstance(tensor_list[0], np.ndarray):
-                concatenated_dict[key] = np.concatenate(tensor_list, axis=0)
-            else:
-                concatenated_dict[key] = torch.cat(tensor_list, dim=0)
 
-        return concatenated_dict
+    from rlasim.lib.kinematics import three_body_kinematics, masses_from_sample, truth_kinematics_features
+
+    # Branches that get stacked into the [N, 3, 3] momenta and [N, 1, 3] momenta_mother arrays, in that order
+    packed_feature_branches = {
+        'momenta': ['particle_%d_%s' % (i, c) for i in [1, 2, 3] for c in ['PX', 'PY', 'PZ']],
+        'momenta_mother': ['mother_PX_TRUE', 'mother_PY_TRUE', 'mother_PZ_TRUE'],
+    }
+
+
+    def pack_momenta_arrays(dict_of_arrays, out=None):
+        """
+        Stacks the momentum components into contiguous momenta [N, 3, 3] and momenta_mother [N, 1, 3] arrays, the same
+        layout MomentaCatPreprocessor produces. Features whose branches are not all present are skipped.
+        :param dict_of_arrays: dict of 1D numpy arrays of equal length
+        :param out: optional dict with preallocated arrays for the packed features to write into
+        :return: dict with the packed arrays, the input arrays are left in place
+        """
+        packed = {}
+        for feature, branches in packed_feature_branches.items():
+            if not all(b in dict_of_arrays for b in branches):
+                continue
+            length = len(dict_of_arrays[branches[0]])
+            shape = (length, len(branches) // 3, 3)
+            reusable = reuse_array(out.get(feature, None), shape, dict_of_arrays[branches[0]].dtype) \
+                if out is not None else None
+            if reusable is not None:
+                np.stack([dict_of_arrays[b] for b in branches], axis=1, out=reusable.reshape((length, -1)))
+                packed[feature] = reusable
+            else:
+                stacked = np.stack([dict_of_arrays[b] for b in branches], axis=1)
+                packed[feature] = stacked.reshape((length, -1, 3))
+        return packed
+
+
+    def derive_truth_kinematics(dict_of_arrays):
+        """
+        Truth Dalitz masses (not squared, NaNs zeroed) and parent mass of every event, the same values ThreeBodyVaeLoss
+        and ThreeBodyGanLoss compute for the truth side.
+        :param dict_of_arrays: dict of numpy arrays with the momenta [N, 3, 3] (or the particle_*_P{X,Y,Z} branches) and
+                               the particle_*_M branches
+        :return: dict with the mass_13, mass_32 and parent_mass arrays
+        """
+        momenta = dict_of_arrays['momenta'] if 'momenta' in dict_of_arrays else \
+            pack_momenta_arrays(dict_of_arrays)['momenta']
+        kinematics = three_body_kinematics(momenta, masses_from_sample(dict_of_arrays, _engine='np'), _engine='np')
+        return {k: kinematics[k] for k in truth_kinematics_features}
+
+
+    def check_branches(available_keys, branches):
+        """
+        Validates a column projection against the branches of a tree.
+        :param available_keys: Keys of the tree
+        :param branches: List of branches to read or None for all of them
+        :return: List of keys that should be read
+        """
+        if branches is None:
+            return list(available_keys)
+        missing = [b for b in branches if b not in available_keys]
+        if len(missing) > 0:
+            raise ValueError('The following branches were requested but are not in the tree: ' + str(missing))
+        return list(branches)
 
 
     class RootTensorDataset2(Dataset):
-        def __init__(self, file, tree_name, cache_size=1000):
+        def __init__(self, file, tree_name, cache_size=1000, branches=None):
             self.tree = uproot.open(file)[tree_name]
-            self.keys = self.tree.keys()
+            index = load_tree_index(file, tree_name)
+            self.keys = check_branches(index['keys'], branches)
             self.block_size = cache_size
             self.cache = []
             self.cache_start = 0
             self.cache_end = 0
 
-            lens = set()
-            for k in self.keys:
-                num_entries = self.tree[k].num_entries
-                lens = lens.union({num_entries})
-            assert len(lens) == 1
-            self.length = list(lens)[0]
+            self.length = index['num_entries']
             self.length = math.floor(self.length/cache_size)
 
         def get_block(self, start):
@@ -202,16 +393,287 @@ if torch_installed:
     import threading
 
     from rlasim.lib.data_core import tensors_dict_join
-    from queue import Queue
     from torch.utils.data._utils.collate import default_collate
 
 
+    def dict_arrays_nbytes(dict_of_arrays):
+        return sum(int(v.nbytes) for v in dict_of_arrays.values())
+
+
+    class SubsetPrefetchQueue:
+        """
+        Bounded producer/consumer queue for sampled subsets. The producer blocks (on a condition variable, no
+        polling) while the queue holds max_subsets subsets or max_bytes bytes and the consumer blocks while it is
+        empty. An empty queue always accepts a subset, so a single subset larger than max_bytes can't deadlock.
+
+        :param max_subsets: Maximum number of subsets waiting to be consumed
+        :param max_bytes: Maximum number of bytes waiting to be consumed, -1 for no limit
+        """
+        def __init__(self, max_subsets=3, max_bytes=-1):
+            assert max_subsets >= 1
+            self.max_subsets = max_subsets
+            self.max_bytes = max_bytes
+
+            self._items = collections.deque()
+            self._bytes = 0
+            self._closed = False
+            self._cond = threading.Condition()
+
+            self.consumer_wait_time = 0.
+            self.consumer_num_waits = 0
+            self.producer_wait_time = 0.
+
+        def _is_full(self):
+            if len(self._items) == 0:
+                return False
+            if len(self._items) >= self.max_subsets:
+                return True
+            if self.max_bytes != -1 and self._bytes >= self.max_bytes:
+                return True
+            return False
+
+        def wait_for_space(self):
+            """
+            Blocks until there is space for another subset.
+            :return: False if the queue was closed while waiting, True otherwise
+            """
+            with self._cond:
+                t1 = time.time()
+                while self._is_full() and not self._closed:
+                    self._cond.wait()
+                self.producer_wait_time += time.time() - t1
+                return not self._closed
+
+        def has_space(self):
+            with self._cond:
+                return not self._is_full() and not self._closed
+
+        def put(self, subset, nbytes=None):
+            if nbytes is None:
+                nbytes = dict_arrays_nbytes(subset)
+            with self._cond:
+                t1 = time.time()
+                while self._is_full() and not self._closed:
+                    self._cond.wait()
+                self.producer_wait_time += time.time() - t1
+                if self._closed:
+                    return False
+                self._items.append((subset, nbytes))
+                self._bytes += nbytes
+                self._cond.notify_all()
+                return True
+
+        def get(self, block=True):
+            """
+            Blocks until a subset is available.
+            :param block: if False, returns None right away if the queue is empty
+            :return: The oldest subset or None if the queue was closed
+            """
+            with self._cond:
+                if len(self._items) == 0 and not self._closed and block:
+                    t1 = time.time()
+                    while len(self._items) == 0 and not self._closed:
+                        self._cond.wait()
+                    self.consumer_wait_time += time.time() - t1
+                    self.consumer_num_waits += 1
+                if len(self._items) == 0:
+                    return None
+                subset, nbytes = self._items.popleft()
+                self._bytes -= nbytes
+                self._cond.notify_all()
+                return subset
+
+        def qsize(self):
+            with self._cond:
+                return len(self._items)
+
+        def nbytes(self):
+            with self._cond:
+                return self._bytes
+
+        def close(self):
+            with self._cond:
+                self._closed = True
+                self._items.clear()
+                self._bytes = 0
+                self._cond.notify_all()
+
+        def get_wait_stats(self):
+            with self._cond:
+                return {'consumer_wait_time': self.consumer_wait_time,
+                        'consumer_num_waits': self.consumer_num_waits,
+                        'producer_wait_time': self.producer_wait_time,
+                        'queued_subsets': len(self._items),
+                        'queued_bytes': self._bytes}
+
+
+    def plan_block_reads(blocks, block_size, length, basket_boundaries=None, max_read_size=-1):
+        """
+        Turns sampled blocks into as few contiguous reads as possible. The blocks are sorted and a block is merged
+        into the previous read if it directly follows it or if no branch starts a new basket between the end of the
+        previous read and the block. In the latter case the rows in the gap are decompressed anyway, so reading them
+        costs no extra I/O. Either way a read never grows beyond max_read_size.
+
+        :param blocks: Iterable of block indices
+        :param block_size: Number of entries per block
+        :param length: Total number of entries, the last block is clipped to it
+        :param basket_boundaries: Sorted entries where any of the branches starts a basket, None if unknown. See
+                                  basket_boundaries_from_index.
+        :param max_read_size: Blocks are no longer merged once a read would exceed this many entries, so that the
+                              reads can still be spread over multiple threads. -1 for no limit.
+        :return: List of (read_start, read_stop, [(block_start, block_stop), ...]) with absolute entry numbers
+        """
+        def basket_of(entry):
+            return np.searchsorted(basket_boundaries, entry, side='right') - 1
+
+        reads = []
+        for b in sorted(blocks):
+            start = b * block_size
+            stop = min((b + 1) * block_size, length)
+            if len(reads) > 0:
+                read_start, read_stop, read_blocks = reads[-1]
+                shares_basket = basket_boundaries is not None and basket_of(start) <= basket_of(read_stop - 1)
+                fits = max_read_size == -1 or stop - read_start <= max_read_size
+                if (shares_basket or start == read_stop) and fits:
+                    read_blocks.append((start, stop))
+                    reads[-1] = (read_start, stop, read_blocks)
+                    continue
+            reads.append((start, stop, [(start, stop)]))
+
+        return reads
+
+
+    class RootTreeHandlePool:
+        """
+        Pool of opened trees so that reading a block doesn't re-open the file and re-parse the ROOT header and
+        TTree metadata every time. A handle is borrowed by one reader at a time and returned to the pool after the
+        read, so at most as many handles are open per file as there are concurrent readers.
+
+        :param tree_name: Name of the tree inside the files
+        :param backend: 'uproot' to read root files or 'columnar' to read directories written by
+                        convert_root_to_columnar
+        """
+        def __init__(self, tree_name='DecayTree', backend='uproot'):
+            self.tree_name = tree_name
+            self.backend = backend
+            self._free = collections.defaultdict(list)
+            self._closed = False
+            self._lock = threading.Lock()
+
+        def _open(self, file_path):
+            return open_tree(file_path, self.tree_name, self.backend)
+
+        @contextlib.contextmanager
+        def tree(self, file_path):
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError('The handle pool has been closed.')
+                handle = self._free[file_path].pop() if len(self._free[file_path]) > 0 else None
+
+            if handle is None:
+                handle = self._open(file_path)
+
+            try:
+                yield handle[1]
+            finally:
+                with self._lock:
+                    if self._closed:
+                        handle[0].close()
+                    else:
+                        self._free[file_path].append(handle)
+
+        def read(self, file_path, start_index, end_index, branches=None):
+            with self.tree(file_path) as tree:
+                # Every block is read once per subset so uproot's array cache would only hold dead data
+                return tree.arrays(branches, library='np', entry_start=start_index, entry_stop=end_index,
+                                   array_cache=None)
+
+        def close(self):
+            with self._lock:
+                self._closed = True
+                # Borrowed handles are closed when they are returned
+                for handles in self._free.values():
+                    for file, _ in handles:
+                        file.close()
+                self._free.clear()
+
+
+    class SubsetRead:
+        """
+        Everything the readers of one subset share: the reads left, the slot of every block in the subset and the
+        assembler writing into it. Readers still running after the subset was abandoned by exit() only ever write
+        into their own SubsetRead, never into the next subset. Blocks are (start, stop) ranges of a file and don't
+        need to have the same length.
+        """
+        def __init__(self, planned_reads, permutation=None, out=None):
+            self.planned_reads = list(planned_reads)
+            self.lock = threading.Lock()
+            self.data_read = []
+            self.num_readers = 0
+            self.finished = threading.Event()
+            self.cancelled = concurrent.futures.Future()
+
+            # The slots of the blocks in the subset follow the file order, whichever reader finishes first, which
+            # keeps the subset reproducible. A block can be sampled twice with file weights, hence the lists.
+            all_blocks = sorted((file_index, block_start, block_stop) for file_index, _, _, blocks in planned_reads
+                                for block_start, block_stop in blocks)
+            self.slots = collections.defaultdict(list)
+            for slot, key in reversed(list(enumerate(all_blocks))):
+                self.slots[key].append(slot)
+            lengths = np.array([block_stop - block_start for _, block_start, block_stop in all_blocks], dtype=np.int64)
+            # First row of every slot in the subset
+            self.offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+            self.assembly = DictArrayAssembler(int(lengths.sum()), permutation=permutation, out=out)
+            # Rows of every slot that passed the selection
+            self.counts = lengths
+            self.num_rows_read = 0
+            # First exception of a reader, the subset is incomplete then
+            self.error = None
+
+        def compact(self):
+            """
+            Moves the rows that passed the selection together, in slot order, and shortens the result of the
+            assembler to them (views of the full arrays).
+            :return: Number of rows left
+            """
+            offsets = np.concatenate([[0], np.cumsum(self.counts)])
+            total = int(offsets[-1])
+            for key, destination in list(self.assembly.result.items()):
+                for slot, count in enumerate(self.counts):
+                    source = self.offsets[slot]
+                    if count > 0 and offsets[slot] != source:
+                        destination[offsets[slot]:offsets[slot] + count] = destination[source:source + count]
+                self.assembly.result[key] = destination[:total]
+            return total
+
+        def reader_done(self):
+            with self.lock:
+                self.num_readers -= 1
+                if self.num_readers == 0:
+                    self.finished.set()
+
+        def cancel(self):
+            with self.lock:
+                if not self.cancelled.done():
+                    self.cancelled.set_result(True)
+            self.finished.set()
+
+        def fail(self, error):
+            with self.lock:
+                if self.error is None:
+                    self.error = error
+            self.finished.set()
+
+
     class RootBlockShuffledSubsetDataset(Dataset):
-        def shuffle_dict_arrays(self, dict_of_arrays):
+        def shuffle_dict_arrays(self, dict_of_arrays, rng=None):
             # Assuming all arrays have the same length
             array_length = len(next(iter(dict_of_arrays.values())))
             shuffling_indices = np.arange(array_length)
-            np.random.shuffle(shuffling_indices)
+            if rng is None:
+                np.random.shuffle(shuffling_indices)
+            else:
+                rng.shuffle(shuffling_indices)
 
             shuffled_dict = {key: array[shuffling_indices] for key, array in dict_of_arrays.items()}
 
@@ -228,124 +690,754 @@ if torch_installed:
             return selected_elements
 
         def read_root_file(self, file_path, tree_name, start_index, end_index):
-            with uproot.open(file_path) as file:
-                tree = file[tree_name]
-                branches = tree.arrays(library="np", entry_start=start_index, entry_stop=end_index)
+            assert tree_name == self._handle_pool.tree_name
+            branches = self._handle_pool.read(file_path, start_index, end_index, branches=self.keys)
 
             return branches
 
         # Define the function that will be executed in each thread
-        def read_blocks_thread(self, sampled_blocks, data_read):
-            while True:
-                with self.block_lock:
-                    if not sampled_blocks:
+        def read_blocks_thread(self, subset_read):
+            try:
+                while not subset_read.cancelled.done() and subset_read.error is None:
+                    with subset_read.lock:
+                        if not subset_read.planned_reads:
+                            break
+                        file_index, start, end, blocks = subset_read.planned_reads.pop()
+
+                    try:
+                        x = self.read_root_file(self.input_files[file_index], self.tree_name, start, end)
+                        if self.debug:
+                            print("Done", len(subset_read.data_read))
+
+                        x = downcast_arrays(x)
+                        self._add_read_blocks(x, file_index, start, blocks, subset_read)
+                    except Exception as e:
+                        # Either the read outlived exit(), which closed the files under it, or the subset is missing
+                        # this read and _read_sampled_blocks raises the error
+                        if not subset_read.cancelled.done():
+                            subset_read.fail(e)
                         break
-                    b = sampled_blocks.pop()
-
-                start = b * self._block_size
-                end = min((b + 1) * self._block_size, self.length_full)
-                x = self.read_root_file(self.input_file, 'DecayTree', start, end)
-                if self.debug:
-                    print("Done", len(data_read))
-
-                cache_2 = {}
-                for k, v in x.items():
-                    if v.dtype == np.float64:
-                        cache_2[k] = v.astype(np.float32)
-                    elif v.dtype == np.int64:
-                        cache_2[k] = v.astype(np.int32)
+            finally:
+                subset_read.reader_done()
+
+        def _add_read_blocks(self, x, file_index, start, blocks, subset_read):
+            # Every block is copied straight to its slot of the preallocated subset
+            with subset_read.lock:
+                slots = [subset_read.slots[(file_index, block_start, block_stop)].pop()
+                         for block_start, block_stop in blocks]
+
+            # The selection is evaluated once per read, only the events that pass it are copied into the subset
+            mask = self._selection(x) if self._selection is not None else None
+            lengths = np.array([block_stop - block_start for block_start, block_stop in blocks], dtype=np.int64)
+            if len(blocks) > 1 and lengths.mean() < 256:
+                # Short blocks, e.g. the chunks of channels that alternate every few rows, are gathered all at once
+                self._add_read_rows(x, mask, start, blocks, lengths, slots, subset_read)
+            else:
+                for slot, (block_start, block_stop) in zip(slots, blocks):
+                    rows = slice(block_start - start, block_stop - start)
+                    if mask is None:
+                        block = {k: v[rows] for k, v in x.items()}
                     else:
-                        cache_2[k] = v
-                x = cache_2
-
-                # Lock the data_read list to avoid concurrent modification
-                with self.data_lock:
-                    data_read.append(x)
-
-        def _background_loading_thread(self):
-            while True:
-                if self.kill_signal:
+                        block_mask = mask[rows]
+                        block = {k: v[rows][block_mask] for k, v in x.items()}
+                        subset_read.counts[slot] = int(np.count_nonzero(block_mask))
+                    subset_read.assembly.add(block, int(subset_read.offsets[slot]))
+
+            # Lock the data_read list to avoid concurrent modification
+            with subset_read.lock:
+                subset_read.data_read.extend([(file_index, block_start) for block_start, _ in blocks])
+                subset_read.num_rows_read += int(sum(block_stop - block_start for block_start, block_stop in blocks))
+
+        def _add_read_rows(self, x, mask, start, blocks, lengths, slots, subset_read):
+            # Row of x and row of the subset of every row of every block, with one index array instead of a slice
+            # per block
+            slots = np.array(slots, dtype=np.int64)
+            first_rows = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+            within = np.arange(int(lengths.sum())) - np.repeat(first_rows, lengths)
+            rows = np.repeat(np.array([b[0] for b in blocks], dtype=np.int64) - start, lengths) + within
+            if mask is None:
+                destination_rows = np.repeat(subset_read.offsets[slots], lengths) + within
+            else:
+                selected = mask[rows]
+                counts = np.add.reduceat(selected.astype(np.int64), first_rows)
+                subset_read.counts[slots] = counts
+                rows = rows[selected]
+                first_selected = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+                destination_rows = np.repeat(subset_read.offsets[slots] - first_selected, counts) + np.arange(len(rows))
+            subset_read.assembly.add_rows({k: v[rows] for k, v in x.items()}, destination_rows)
+
+        def _read_blocks_process_pool(self, subset_read):
+            # The workers hand the arrays back through shared memory, only the layout gets pickled
+            futures = {}
+            for file_index, start, end, blocks in subset_read.planned_reads:
+                future = self._process_pool.submit(read_range_to_shared_memory, self.input_files[file_index],
+                                                   self.tree_name, self._handle_pool.backend, self.keys, start, end)
+                futures[future] = (file_index, start, blocks)
+
+            # subset_read.cancelled completes on exit() and wakes this loop up
+            pending = set(futures) | {subset_read.cancelled}
+            while len(pending) > 1:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                if not subset_read.cancelled.done():
+                    for future in done:
+                        file_index, start, blocks = futures[future]
+                        if self.debug:
+                            print("Done", len(subset_read.data_read))
+                        try:
+                            # The blocks are copied from the segment straight into their slots of the subset
+                            with shared_memory_arrays(*future.result()) as x:
+                                self._add_read_blocks(x, file_index, start, blocks, subset_read)
+                        except Exception as e:
+                            subset_read.fail(e)
+                            break
+                if subset_read.cancelled.done() or subset_read.error is not None:
+                    for future in pending | done:
+                        # Reads that are already running still write their segment, it is freed once they are done
+                        if future is not subset_read.cancelled and not future.cancel():
+                            future.add_done_callback(discard_shared_memory_future)
                     break
-                if self.sampled_subsets_queue.qsize() > 2:
-                    time.sleep(0.1)
-                    continue
-
-                self.data_lock = threading.Lock()
-                self.block_lock = threading.Lock()
 
+        def _read_range_and_add(self, file_index, start, end, blocks, subset_read):
+            x = downcast_arrays(self.read_root_file(self.input_files[file_index], self.tree_name, start, end))
+            self._add_read_blocks(x, file_index, start, blocks, subset_read)
+
+        async def _read_blocks_async(self, subset_read):
+            # Every planned read is a task, the semaphore bounds how many of them are waiting on the storage at once.
+            # uproot itself is blocking, so the reads are handed to a thread pool with one thread per in flight read.
+            semaphore = asyncio.Semaphore(self._max_in_flight)
+            loop = asyncio.get_running_loop()
+
+            async def read(file_index, start, end, blocks):
+                async with semaphore:
+                    await asyncio.wrap_future(self._async_executor.submit(self._read_range_and_add, file_index, start,
+                                                                          end, blocks, subset_read))
+
+            tasks = [asyncio.ensure_future(read(*planned_read)) for planned_read in subset_read.planned_reads]
+            with self._async_lock:
+                self._async_loop = loop
+                self._async_tasks = tasks
+            if self._stop_event.is_set():
+                # exit() came before the tasks existed
+                for task in tasks:
+                    task.cancel()
+            try:
+                # Reads that are running when the tasks get cancelled finish in the pool, into their own subset_read
+                await asyncio.gather(*tasks)
+            finally:
+                with self._async_lock:
+                    self._async_loop = None
+                    self._async_tasks = []
+
+        def _cancel_async_reads(self):
+            with self._async_lock:
+                if self._async_loop is not None:
+                    for task in self._async_tasks:
+                        self._async_loop.call_soon_threadsafe(task.cancel)
+
+        def _draw_blocks(self, rng, num_blocks=None):
+            if num_blocks is None:
+                num_blocks = self._num_blocks
+            if self._channel_chunks is not None:
+                return self._draw_stratified(rng, num_blocks * self._block_size)
+
+            if self._file_weights is None:
+                # Every block of every file once per pass over the data
                 if self.all_blocks is None:
-                    self.all_blocks = list(range(0, math.floor(self.length_full / self._block_size)))
-                    random.shuffle(self.all_blocks)
-                elif len(self.all_blocks) < self._num_blocks:
+                    self.all_blocks = list(range(0, self._total_blocks))
+                    rng.shuffle(self.all_blocks)
+                elif len(self.all_blocks) < num_blocks:
                     prev_blocks = [x for x in self.all_blocks]
-                    new_all_blocks = list(
-                        set(range(0, math.floor(self.length_full / self._block_size))) - set(prev_blocks))
-                    random.shuffle(new_all_blocks)
+                    new_all_blocks = sorted(set(range(0, self._total_blocks)) - set(prev_blocks))
+                    rng.shuffle(new_all_blocks)
                     self.all_blocks = prev_blocks + new_all_blocks
 
-                sampled_blocks = self.select_and_delete_elements(self.all_blocks, self._num_blocks)
+                return self.select_and_delete_elements(self.all_blocks, num_blocks)
+
+            # Every file has its own permutation of blocks, how many blocks each file contributes to a subset is drawn
+            # from the weights. Files that are drawn more often than they have blocks are passed over again.
+            if self.all_blocks is None:
+                self.all_blocks = [[] for _ in self.input_files]
+            counts = rng.multinomial(num_blocks, self._file_weights)
+            sampled_blocks = []
+            for file_index, count in enumerate(counts):
+                file_blocks = self.all_blocks[file_index]
+                while count > 0:
+                    if len(file_blocks) == 0:
+                        file_blocks.extend(rng.permutation(np.arange(self._file_block_offsets[file_index],
+                                                                     self._file_block_offsets[file_index + 1])).tolist())
+                    selected = self.select_and_delete_elements(file_blocks, count)
+                    sampled_blocks += selected
+                    count -= len(selected)
+            return sampled_blocks
+
+        def _draw_stratified(self, rng, num_rows):
+            # Every channel gets its share of the rows (largest remainder, so they add up to num_rows exactly). The
+            # rows are taken as chunks of at most block_size consecutive entries of the channel, from a permutation
+            # of the chunks of the channel that is passed over again once used up. A chunk is split if the share ends
+            # in the middle of it, the rest of it comes first the next time.
+            shares = self._channel_proportions * num_rows
+            counts = np.floor(shares).astype(np.int64)
+            remainder_order = np.argsort(-(shares - counts), kind='stable')
+            counts[remainder_order[:num_rows - counts.sum()]] += 1
+
+            if self.all_blocks is None:
+                self.all_blocks = [collections.deque() for _ in self._channel_chunks]
+            sampled_chunks = []
+            for channel, count in enumerate(counts):
+                if not isinstance(self.all_blocks[channel], collections.deque):
+                    # A restored state
+                    self.all_blocks[channel] = collections.deque(self.all_blocks[channel])
+                channel_chunks = self.all_blocks[channel]
+                while count > 0:
+                    if len(channel_chunks) == 0:
+                        chunks = self._channel_chunks[channel]
+                        channel_chunks.extend([chunks[i] for i in rng.permutation(len(chunks))])
+                    file_index, start, stop = channel_chunks.popleft()
+                    if stop - start > count:
+                        channel_chunks.appendleft((file_index, start + count, stop))
+                        stop = start + count
+                    sampled_chunks.append((file_index, start, stop))
+                    count -= stop - start
+
+            self._last_channel_counts = {name: int(c) for name, c in zip(self._channel_names, counts)}
+            return sampled_chunks
+
+        def _plan_chunk_reads(self, sampled_chunks):
+            # Chunks of a file that are less than a block apart are read together, up to max_read_blocks blocks. The
+            # rows in between are read but not used, which is much cheaper than a read per chunk when the channels
+            # alternate every few rows.
+            max_read_size = self._max_read_blocks * self._block_size
+            planned_reads = []
+            for file_index, start, stop in sorted(sampled_chunks):
+                if len(planned_reads) > 0:
+                    read_file, read_start, read_stop, blocks = planned_reads[-1]
+                    if read_file == file_index and start - read_stop < self._block_size and \
+                            stop - read_start <= max_read_size:
+                        # A chunk drawn again in the next pass over the channel can overlap the previous one
+                        blocks.append((start, stop))
+                        planned_reads[-1] = (read_file, read_start, max(read_stop, stop), blocks)
+                        continue
+                planned_reads.append((file_index, start, stop, [(start, stop)]))
+            return planned_reads
+
+        def _plan_reads(self, sampled_blocks):
+            if self._channel_chunks is not None:
+                return self._plan_chunk_reads(sampled_blocks)
+
+            # Global block indices to (file, block in the file), then the reads are planned per file
+            file_indices = np.searchsorted(self._file_block_offsets, sampled_blocks, side='right') - 1
+            planned_reads = []
+            for file_index in sorted(set(file_indices.tolist())):
+                offset = self._file_block_offsets[file_index]
+                blocks = [b - offset for b, i in zip(sampled_blocks, file_indices) if i == file_index]
+                reads = plan_block_reads(blocks, self._block_size, self._file_lengths[file_index],
+                                         basket_boundaries=self._basket_boundaries[file_index],
+                                         max_read_size=self._max_read_blocks * self._block_size)
+                planned_reads += [(file_index, start, stop, read_blocks) for start, stop, read_blocks in reads]
+            return planned_reads
+
+        def _read_sampled_blocks(self, sampled_blocks, out=None, rng=None):
+            # Blocks are read in file order and merged where possible, the rows get shuffled in memory later
+            planned_reads = self._plan_reads(sampled_blocks)
+            num_reads = len(planned_reads)
+
+            subset_read = SubsetRead(planned_reads, out=out)
+            self._subset_read = subset_read
+            self._assembly = subset_read.assembly
+            self._data_read_copy_for_monitoring_progress = subset_read.data_read
+            self._num_blocks_being_read = len(sampled_blocks)
+            if self._stop_event.is_set():
+                # exit() came before this subset_read could be woken up
+                subset_read.cancel()
+
+            t1 = time.time()
+            if self._read_executor == 'process':
+                self._read_blocks_process_pool(subset_read)
+            elif self._read_executor == 'async':
+                try:
+                    asyncio.run(self._read_blocks_async(subset_read))
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:
+                    if not subset_read.cancelled.done():
+                        subset_read.fail(e)
+            else:
+                # Daemon threads, exit() doesn't wait for a read that is already running
+                subset_read.num_readers = self._num_read_workers
+                for _ in range(self._num_read_workers):
+                    thread = threading.Thread(target=self.read_blocks_thread, args=(subset_read,), daemon=True)
+                    thread.start()
 
-                data_read = []
-                self._data_read_copy_for_monitoring_progress = data_read
-                num_threads = 4
+                # Until all readers are done or the read is cancelled
+                subset_read.finished.wait()
+
+            if self.debug:
+                print("Took", time.time() - t1, "seconds for", len(sampled_blocks), "blocks in", num_reads,
+                      "reads.")
+
+            self._assembly = None
+            self._subset_read = None
+            if subset_read.cancelled.done():
+                # Cancelled by exit(), whatever was read is incomplete
+                return None
+            if subset_read.error is not None:
+                # Rows of the failed read would be uninitialised or left over from an earlier subset
+                raise subset_read.error
+            assert subset_read.num_rows_read == subset_read.assembly.length
+
+            num_rows = subset_read.compact() if self._selection is not None else subset_read.num_rows_read
+            with self._cursor_lock:
+                self._selection_stats['rows_read'] += subset_read.num_rows_read
+                self._selection_stats['rows_selected'] += num_rows
+            if self.debug and self._selection is not None:
+                print("Selected", num_rows, "of", subset_read.num_rows_read, "rows.")
+
+            # With an rng the rows are shuffled in place once all the blocks are in, otherwise they stay in file order
+            if rng is not None:
+                subset_read.assembly.permutation = rng.permutation(num_rows)
+            sampled_subset = subset_read.assembly.finish()
+            if self._pack_momenta:
+                # Row wise, so it doesn't matter that the rows are shuffled already
+                sampled_subset.update(pack_momenta_arrays(sampled_subset, out=out))
+            if self._truth_kinematics:
+                sampled_subset.update(derive_truth_kinematics(sampled_subset))
+            return sampled_subset
+
+        def _take_free_subset(self):
+            # Arrays of a subset its consumer has released can be overwritten by the next one
+            with self._free_lock:
+                if len(self._free_subsets) > 0:
+                    return self._free_subsets.popleft()
+            return None
+
+        def _release_subset(self, subset):
+            if subset is None:
+                return
+            with self._free_lock:
+                self._free_subsets.append(subset)
+                # Only one subset is ever being assembled at a time
+                while len(self._free_subsets) > 1:
+                    self._free_subsets.popleft()
 
-                threads = []
-                t1 = time.time()
-                for _ in range(num_threads):
-                    thread = threading.Thread(target=self.read_blocks_thread, args=(sampled_blocks, data_read))
-                    thread.start()
-                    threads.append(thread)
+        def _background_loading_thread(self):
+            while True:
+                if self._stop_event.is_set():
+                    break
+                # Blocks until the consumer has made room in the queue
+                if not self.sampled_subsets_queue.wait_for_space():
+                    break
+
+                with self._cursor_lock:
+                    # Everything random about a subset comes from (seed, subset id), so the cursor taken before
+                    # drawing it is enough to draw it again after a restart
+                    subset_id = self._next_subset_id
+                    cursor = self._make_cursor()
+                    self._pending_cursors.append(cursor)
+                    rng = np.random.default_rng((self._seed, subset_id))
+                    sampled_blocks = self._draw_blocks(rng)
+                    self._next_subset_id += 1
+                    if self._channel_chunks is not None:
+                        cursor['channel_counts'] = self._last_channel_counts
+
+                sampled_subset = self._read_sampled_blocks(sampled_blocks, out=self._take_free_subset(), rng=rng)
+                if sampled_subset is None or not self.sampled_subsets_queue.put(sampled_subset):
+                    break
+                # Otherwise this thread would keep the subset alive after the consumer has dropped it
+                del sampled_subset
+
+        def _background_streaming_thread(self):
+            # Rolling buffer of length_sampled rows in the order they were read. Every chunk of refresh_blocks fresh
+            # blocks overwrites the oldest rows, and once the consumer has taken the pending subset a shuffled copy of
+            # the buffer is handed out as the next one. The queue holds a single subset in streaming mode, so there is
+            # at most one copy waiting and it always has at least refresh_blocks blocks the previous one didn't have.
+            buffer = None
+            buffer_position = 0
+            blocks_since_put = 0
+            while True:
+                if self._stop_event.is_set():
+                    break
+                if buffer is not None and blocks_since_put >= self._num_blocks:
+                    # The whole buffer has been replaced since the last subset was handed out, reading more would
+                    # just overwrite rows that were never used
+                    if not self.sampled_subsets_queue.wait_for_space():
+                        break
 
-                # Wait for all threads to finish
-                for thread in threads:
-                    thread.join()
+                num_blocks = self._num_blocks if buffer is None else self._refresh_blocks
+                with self._cursor_lock:
+                    subset_id = self._next_subset_id
+                    rng = np.random.default_rng((self._seed, subset_id))
+                    sampled_blocks = self._draw_blocks(rng, num_blocks)
+                    self._next_subset_id += 1
 
-                if self.debug:
-                    print("Took", time.time() - t1, "seconds.")
+                chunk = self._read_sampled_blocks(sampled_blocks)
+                if chunk is None:
+                    break
+                if buffer is None:
+                    buffer = chunk
+                    self._stream_buffer = buffer
+                else:
+                    # With a selection the buffer is as long as the first subset was after it
+                    buffer_length = len(next(iter(buffer.values())))
+                    chunk_length = len(next(iter(chunk.values())))
+                    positions = (buffer_position + np.arange(chunk_length)) % buffer_length
+                    for k, v in chunk.items():
+                        buffer[k][positions] = v
+                    buffer_position = (buffer_position + chunk_length) % buffer_length
+                blocks_since_put += num_blocks
+
+                if blocks_since_put >= self._refresh_blocks and self.sampled_subsets_queue.has_space():
+                    with self._cursor_lock:
+                        # A restart from here refills the buffer with the blocks that come after it
+                        self._pending_cursors.append(self._make_cursor())
+                    # Shuffled copy of the buffer, into the arrays of a released subset if possible
+                    buffer_length = len(next(iter(buffer.values())))
+                    snapshot = DictArrayAssembler(buffer_length, permutation=rng.permutation(buffer_length),
+                                                  out=self._take_free_subset())
+                    snapshot.add(buffer, 0)
+                    if not self.sampled_subsets_queue.put(snapshot.finish()):
+                        break
+                    blocks_since_put = 0
 
-                sampled_subset = tensors_dict_join(data_read)
-                sampled_subset = self.shuffle_dict_arrays(sampled_subset)
-                self.sampled_subsets_queue.put(sampled_subset)
+        def _reading_thread(self, target):
+            try:
+                target()
+            except Exception as e:
+                # Handed to the consumer, which would otherwise wait for the next subset forever
+                self._reader_error = e
+                self._stop_reading()
 
         def load_subsets(self):
-            self.all_blocks = None
-            self.reading_thread_main = threading.Thread(target=self._background_loading_thread, args=())
+            target = self._background_streaming_thread if self._streaming else self._background_loading_thread
+            self._reader_error = None
+            self.reading_thread_main = threading.Thread(target=self._reading_thread, args=(target,))
             self.reading_thread_main.start()
 
-        def __init__(self, input_file, block_size=4096, num_blocks=10, debug=False):
+        def _raise_reader_error(self):
+            if self._reader_error is not None:
+                raise RuntimeError('Reading a subset failed.') from self._reader_error
+
+        def __init__(self, input_file, block_size=4096, num_blocks=10, debug=False, prefetch_subsets=3,
+                     prefetch_bytes=-1, branches=None, max_read_blocks=16, backend='uproot', read_executor='thread',
+                     num_read_workers=4, pack_momenta=False, seed=None, state=None, tree_name='DecayTree',
+                     file_weights=None, streaming=False, refresh_blocks=None, memory_budget=-1, max_in_flight=16,
+                     selection=None, selection_engine='numpy', stratify_by=None, channel_proportions=None,
+                     truth_kinematics=False):
+            """
+            :param input_file: a root file, a glob pattern or a list of either. Blocks are indexed across all the
+                               files and never span two of them, so e.g. the per channel RapidSim outputs can be read
+                               without merging them with hadd first.
+            :param tree_name: name of the tree in every file
+            :param file_weights: None to sample every block with the same probability, otherwise the probability of
+                                 a block coming from each file. Either a list in the order of the (sorted) files or a
+                                 dict from file path or file name to weight.
+            :param seed: seed of the block and row permutations. A random one is drawn if None, it is part of the
+                         state either way.
+            :param state: cursor returned by state_dict() of a previous run to continue from
+            :param streaming: keep a rolling buffer of num_blocks blocks instead of swapping whole subsets. Fresh blocks
+                              continuously replace the oldest ones and prepare_next_epoch switches to a shuffled copy
+                              of the buffer if one is ready, otherwise the current subset is used again. Only the
+                              very first subset is ever waited for. A restored state refills the buffer with the blocks
+                              that follow it. At most one shuffled copy is pending at a time, prefetch_subsets is
+                              ignored.
+            :param refresh_blocks: number of blocks read per refresh of the buffer in streaming mode, num_blocks // 10
+                                   if None
+            :param memory_budget: bytes the subsets of the loader may take in total (the current one, the queued ones,
+                                  the one being assembled and the streaming buffer), -1 for no limit. prefetch_subsets
+                                  and, if needed, num_blocks are lowered to fit. See get_memory_usage().
+            :param max_in_flight: with read_executor='async', the number of reads that may be waiting on the storage at
+                                  the same time. Worth raising on network file systems with high latency.
+            :param selection: per event selection applied while the blocks are read, see EventSelection. Rejected events
+                              never make it into a subset, so subsets are shorter than num_blocks * block_size. Its
+                              branches are read even if they are not in branches. See get_selection_stats().
+            :param selection_engine: 'numpy' or 'numexpr' (optional dependency)
+            :param stratify_by: branches that identify the decay channel of an event, e.g. mother_PID and
+                                particle_*_PID. If set, subsets are filled with every channel in channel_proportions
+                                instead of sampling whole blocks, from a per channel index of the files built once
+                                (see load_channel_index). Only the rows of the drawn channels are read.
+            :param channel_proportions: dict from channel name to weight, a channel name being the values of the
+                                        stratify_by branches joined by commas, e.g. '411,-321,211,211'. Channels
+                                        that are not in it are never sampled. None for the same share for all.
+                                        See get_channel_stats().
+            :param truth_kinematics: add the truth mass_13, mass_32 and parent_mass of every event to the subsets, see
+                                     derive_truth_kinematics. Computed once per subset instead of in every step of
+                                     every epoch that uses it.
+            """
             self._block_size = block_size
+            self._pack_momenta = pack_momenta
+            self._truth_kinematics = truth_kinematics
             self._num_blocks = num_blocks
-            self.input_file = input_file
-            self.kill_signal = False
+            self._stop_event = threading.Event()
             self.debug = debug
 
+            root_files = resolve_input_files(input_file)
+            input_files = root_files
+            if backend == 'columnar':
+                # Either directories written by convert_root_to_columnar or root files to convert (once)
+                input_files = []
+                for file_path in root_files:
+                    if not os.path.isdir(file_path):
+                        columnar_dir = get_columnar_cache_path(file_path)
+                        if not is_columnar_cache_valid(file_path, columnar_dir):
+                            if self.debug:
+                                print("Converting", file_path, "to columnar cache", columnar_dir)
+                            convert_root_to_columnar(file_path, columnar_dir, tree_name=tree_name)
+                        file_path = columnar_dir
+                    input_files.append(file_path)
+            elif backend != 'uproot':
+                raise ValueError('Unknown backend %s, has to be either uproot or columnar.' % backend)
+
+            self.input_files = input_files
+            self.tree_name = tree_name
+            self._handle_pool = RootTreeHandlePool(tree_name, backend=backend)
+
+            # Threads share the GIL for decompression and downcasting, worker processes don't. The async reader keeps
+            # up to max_in_flight reads waiting on the storage at once, for network file systems.
+            self._read_executor = read_executor
+            self._num_read_workers = num_read_workers
+            self._max_in_flight = max_in_flight
+            self._process_pool = None
+            self._async_executor = None
+            self._async_lock = threading.Lock()
+            self._async_loop = None
+            self._async_tasks = []
+            if read_executor == 'process':
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_read_workers, mp_context=multiprocessing.get_context('spawn'))
+            elif read_executor == 'async':
+                self._async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+            elif read_executor != 'thread':
+                raise ValueError('Unknown read_executor %s, has to be either thread, process or async.'
+                                 % read_executor)
+
+            self._selection = EventSelection(selection, engine=selection_engine) if selection is not None else None
+            self._selection_stats = {'rows_read': 0, 'rows_selected': 0}
+            read_branches = branches
+            if branches is not None and self._selection is not None:
+                read_branches = list(branches) + [b for b in self._selection.branches if b not in branches]
+
             # length = 1000000
-            tree = uproot.open(input_file)['DecayTree']
-            self.keys = tree.keys()
-            lens = set()
-            for k in self.keys:
-                num_entries = tree[k].num_entries
-                lens = lens.union({num_entries})
-            assert len(lens) == 1
+            # The metadata comes from the sidecar index of every file, so the files are only opened by the readers
+            self.keys = None
+            self._file_lengths = []
+            self._basket_boundaries = []
+            for file_path in self.input_files:
+                index = load_tree_index(file_path, tree_name, backend=backend)
+                # Only the projected branches are ever read
+                keys = check_branches(index['keys'], read_branches)
+                if self.keys is None:
+                    self.keys = keys
+                elif set(keys) != set(self.keys):
+                    raise ValueError('%s has different branches than %s.' % (file_path, self.input_files[0]))
+                self._file_lengths.append(index['num_entries'])
+                self._basket_boundaries.append(basket_boundaries_from_index(index, self.keys))
             # self.length_full = min(length, list(lens)[0])
-            self.length_full = list(lens)[0]
+            self.length_full = sum(self._file_lengths)
+            self._max_read_blocks = max_read_blocks
+
+            # Global block index, the blocks of file i are _file_block_offsets[i] to _file_block_offsets[i+1]
+            self._file_block_offsets = np.cumsum([0] + [l // self._block_size for l in self._file_lengths])
+            self._total_blocks = int(self._file_block_offsets[-1])
+            self._file_weights = self._normalise_file_weights(file_weights, root_files)
+            self._channel_chunks = None
+            self._channel_names = None
+            self._last_channel_counts = None
+            if stratify_by is not None:
+                if file_weights is not None:
+                    raise ValueError('file_weights and stratify_by can\'t be used together.')
+                self._build_channel_chunks(stratify_by, channel_proportions, backend)
 
             if self._num_blocks == -1:
-                self._num_blocks = self.length_full // self._block_size
+                self._num_blocks = self._total_blocks
 
-            if self.length_full // self._block_size < self._num_blocks:
+            if self._total_blocks < self._num_blocks:
                 warnings.warn('Too many blocks specified for the mentioned datafile. Using maximum num_blocks'
                                      ' possible.')
 
-            self._num_blocks = min(self.length_full//self._block_size, self._num_blocks)
+            self._num_blocks = min(self._total_blocks, self._num_blocks)
+
+            # Subsets are assembled in place, in the arrays of subsets released by prepare_next_epoch(release=True)
+            self._free_subsets = collections.deque()
+            self._free_lock = threading.Lock()
+            self._assembly = None
+            self._subset_read = None
+            self._stream_buffer = None
+            self._memory_budget = memory_budget
+            if memory_budget != -1:
+                prefetch_subsets = self._apply_memory_budget(memory_budget, prefetch_subsets, streaming)
 
             self.length_sampled = self._num_blocks * block_size
-            self.sampled_subsets_queue = Queue()
+            self._streaming = streaming
+            if refresh_blocks is None:
+                refresh_blocks = self._num_blocks // 10
+            self._refresh_blocks = max(1, min(refresh_blocks, self._num_blocks))
+            if streaming:
+                # More than one pending copy of the buffer would only hand out stale, nearly identical subsets
+                prefetch_subsets = 1
+            self._num_blocks_being_read = self._num_blocks
+            self.num_reused_subsets = 0
+            self.sampled_subsets_queue = SubsetPrefetchQueue(max_subsets=prefetch_subsets, max_bytes=prefetch_bytes)
+            self._data_read_copy_for_monitoring_progress = []
 
             self.current_sampled_subset = None
 
             self.num_retrieved = 0
             self.retrieved_mask = np.arange(self.length_sampled)
+
+            self._seed = seed if seed is not None else random.randrange(2 ** 32)
+            self._cursor_lock = threading.Lock()
+            self._reset_cursor(state)
+            self.load_subsets()
+
+        def _estimate_row_bytes(self):
+            x = downcast_arrays(self._handle_pool.read(self.input_files[0], 0, 1, branches=self.keys))
+            if self._pack_momenta:
+                x.update(pack_momenta_arrays(x))
+            if self._truth_kinematics:
+                x.update(derive_truth_kinematics(x))
+            return dict_arrays_nbytes(x)
+
+        def _apply_memory_budget(self, memory_budget, prefetch_subsets, streaming):
+            # Alive at the same time: the current subset, the queued ones of which one less while the next one is
+            # being assembled, and in streaming mode the rolling buffer on top
+            reserved = 3 if streaming else 2
+            row_bytes = self._estimate_row_bytes()
+            max_blocks = memory_budget // (reserved * row_bytes * self._block_size)
+            if max_blocks < 1:
+                raise ValueError('A memory budget of %d bytes doesn\'t fit %d subsets of a single block of %d bytes.'
+                                 % (memory_budget, reserved, row_bytes * self._block_size))
+            if self._num_blocks > max_blocks:
+                warnings.warn('num_blocks=%d doesn\'t fit the memory budget, using num_blocks=%d.'
+                              % (self._num_blocks, max_blocks))
+                self._num_blocks = int(max_blocks)
+
+            subset_bytes = self._num_blocks * self._block_size * row_bytes
+            return int(max(1, min(prefetch_subsets, memory_budget // subset_bytes - reserved + 1)))
+
+        def get_memory_usage(self):
+            """
+            Bytes currently held by the loader. Released subsets count under free until they are reused, arrays still
+            referenced by batches outside of the loader are not counted once they are dropped from it.
+            :return: dict with current, queued, assembling, buffer, free and total
+            """
+            current = self.current_sampled_subset
+            assembly = self._assembly
+            stream_buffer = self._stream_buffer
+            with self._free_lock:
+                free = sum(dict_arrays_nbytes(subset) for subset in self._free_subsets)
+            usage = {
+                'current': 0 if current is None else dict_arrays_nbytes(current),
+                'queued': self.sampled_subsets_queue.nbytes(),
+                'assembling': 0 if assembly is None else dict_arrays_nbytes(dict(assembly.result)),
+                'buffer': 0 if stream_buffer is None else dict_arrays_nbytes(stream_buffer),
+                'free': free,
+            }
+            usage['total'] = sum(usage.values())
+            return usage
+
+        def _build_channel_chunks(self, stratify_by, channel_proportions, backend):
+            # Runs of every channel in every file, cut into chunks of at most block_size entries
+            chunks = collections.defaultdict(list)
+            for file_index, file_path in enumerate(self.input_files):
+                index = load_channel_index(file_path, stratify_by, self.tree_name, backend=backend)
+                names = [','.join(str(v) for v in values) for values in index['channels'].tolist()]
+                for start, stop, channel in zip(index['run_starts'].tolist(), index['run_stops'].tolist(),
+                                                index['run_channels'].tolist()):
+                    for chunk_start in range(start, stop, self._block_size):
+                        chunks[names[channel]].append((file_index, chunk_start, min(chunk_start + self._block_size,
+                                                                                    stop)))
+
+            if channel_proportions is None:
+                channel_proportions = {name: 1. for name in chunks}
+            channel_proportions = {str(k): float(v) for k, v in channel_proportions.items() if v > 0}
+            missing = [name for name in channel_proportions if name not in chunks]
+            if len(missing) > 0:
+                raise ValueError('The following channels are not in the files: %s, available are %s'
+                                 % (missing, sorted(chunks.keys())))
+
+            self._channel_names = sorted(channel_proportions.keys())
+            self._channel_chunks = [chunks[name] for name in self._channel_names]
+            weights = np.array([channel_proportions[name] for name in self._channel_names])
+            self._channel_proportions = weights / weights.sum()
+
+        def get_channel_stats(self):
+            """
+            Rows every channel contributes to the current subset (or to the next one if none is being iterated),
+            with stratify_by only.
+            :return: dict from channel name to number of rows, None if not stratified or not known yet
+            """
+            with self._cursor_lock:
+                cursor = self._current_cursor
+                if cursor is None and len(self._pending_cursors) > 0:
+                    cursor = self._pending_cursors[0]
+                return None if cursor is None else cursor.get('channel_counts', None)
+
+        def _normalise_file_weights(self, file_weights, root_files):
+            if file_weights is None:
+                return None
+
+            if isinstance(file_weights, dict):
+                weights = []
+                for file_path in root_files:
+                    weight = file_weights.get(file_path, file_weights.get(os.path.basename(file_path), None))
+                    if weight is None:
+                        raise ValueError('No weight given for %s.' % file_path)
+                    weights.append(weight)
+            else:
+                weights = list(file_weights)
+            if len(weights) != len(root_files):
+                raise ValueError('Got %d file weights for %d files.' % (len(weights), len(root_files)))
+
+            weights = np.array(weights, dtype=np.float64)
+            # Files shorter than a block can't be sampled from
+            weights[np.diff(self._file_block_offsets) == 0] = 0
+            if np.sum(weights) <= 0:
+                raise ValueError('The file weights have to be positive for at least one file with a full block.')
+            return weights / np.sum(weights)
+
+        def _make_cursor(self):
+            return {'subset_id': self._next_subset_id, 'all_blocks': copy.deepcopy(self.all_blocks)}
+
+        def _reset_cursor(self, state):
+            # Cursors of the subsets that have been drawn but not handed out yet, in queue order
+            self._pending_cursors = collections.deque()
+            self._current_cursor = None
+            self.all_blocks = None
+            self._next_subset_id = 0
+            if state is None:
+                return
+
+            if state['block_size'] != self._block_size:
+                raise ValueError('The state was saved with block_size %d, not %d.'
+                                 % (state['block_size'], self._block_size))
+            self._seed = state['seed']
+            self._next_subset_id = state['subset_id']
+            self.all_blocks = copy.deepcopy(state['all_blocks'])
+
+        def state_dict(self):
+            """
+            Returns the cursor of the subset currently being iterated, or of the next one if none is. Loading it
+            re-reads that subset and continues with the same sequence of blocks and rows.
+            """
+            with self._cursor_lock:
+                if self._current_cursor is not None:
+                    cursor = self._current_cursor
+                elif len(self._pending_cursors) > 0:
+                    cursor = self._pending_cursors[0]
+                else:
+                    cursor = self._make_cursor()
+                return {'seed': self._seed, 'block_size': self._block_size, 'subset_id': cursor['subset_id'],
+                        'all_blocks': cursor['all_blocks']}
+
+        def load_state_dict(self, state):
+            # Drop whatever has been prefetched and restart the background thread from the cursor
+            self._stop_reading()
+            self.reading_thread_main.join()
+
+            self.sampled_subsets_queue = SubsetPrefetchQueue(max_subsets=self.sampled_subsets_queue.max_subsets,
+                                                             max_bytes=self.sampled_subsets_queue.max_bytes)
+            self.current_sampled_subset = None
+            self._reset_cursor(state)
+            self._stop_event.clear()
             self.load_subsets()
 
         @property
@@ -359,17 +1451,46 @@ if torch_installed:
         def __len__(self):
             return self.length_sampled
 
+        def _check_current_subset(self):
+            if self.current_sampled_subset is None:
+                # Blocks on the queue's condition variable until the background thread delivers a subset
+                subset = self.sampled_subsets_queue.get()
+                if subset is None:
+                    self._raise_reader_error()
+                    raise RuntimeError('The dataset has been exited, no more subsets can be read.')
+                with self._cursor_lock:
+                    self._current_cursor = self._pending_cursors.popleft()
+                self.current_sampled_subset = subset
+
+        def get_wait_stats(self):
+            return self.sampled_subsets_queue.get_wait_stats()
+
+        def get_selection_stats(self):
+            """
+            Rows read and rows that passed the selection, summed over all the subsets assembled so far.
+            :return: dict with rows_read, rows_selected and efficiency
+            """
+            with self._cursor_lock:
+                stats = dict(self._selection_stats)
+            stats['efficiency'] = float(stats['rows_selected']) / stats['rows_read'] if stats['rows_read'] > 0 else 1.
+            return stats
+
+        def get_subset_length(self):
+            """
+            Number of rows of the current subset, waits for it if needed. Without a selection it is always
+            num_blocks * block_size, with one it varies from subset to subset and len() is only an upper bound.
+            """
+            self._check_current_subset()
+            return len(next(iter(self.current_sampled_subset.values())))
+
         def get_batch(self, batch):
             assert type(batch) is np.ndarray
             assert batch.dtype == np.int32 or batch.dtype == np.int64
             assert len(batch.shape) == 1
 
-            if self.current_sampled_subset is None:
-                while self.sampled_subsets_queue.qsize() == 0:
-                    time.sleep(0.1)
-                self.current_sampled_subset = self.sampled_subsets_queue.get()
+            self._check_current_subset()
 
-            results = {key: self.current_sampled_subset[key][batch] for key in self.keys}
+            results = {key: value[batch] for key, value in self.current_sampled_subset.items()}
             # self.num_retrieved += len(batch)
             # self.retrieved_mask[batch] = 1
 
@@ -386,13 +1507,18 @@ if torch_installed:
             # self.num_retrieved = 0
 
 
+        def get_subset(self):
+            """
+            Returns the current subset. It is already shuffled and every array is contiguous, so consecutive
+            slices of it are random batches.
+            """
+            self._check_current_subset()
+            return self.current_sampled_subset
+
         def get_no_masking(self, item):
-            if self.current_sampled_subset is None:
-                while self.sampled_subsets_queue.qsize() == 0:
-                    time.sleep(0.1)
-                self.current_sampled_subset = self.sampled_subsets_queue.get()
+            self._check_current_subset()
 
-            results = {key: self.current_sampled_subset[key][item] for key in self.keys}
+            results = {key: value[item] for key, value in self.current_sampled_subset.items()}
             return results
 
 
@@ -406,28 +1532,134 @@ if torch_installed:
 
             return results
 
+        def _stop_reading(self):
+            # Wakes up the background thread wherever it waits: on the queue, on the readers of a subset or on async
+            # reads. Pending reads are dropped, the ones already running finish on their own.
+            self._stop_event.set()
+            self.sampled_subsets_queue.close()
+            subset_read = self._subset_read
+            if subset_read is not None:
+                subset_read.cancel()
+            self._cancel_async_reads()
+
         def exit(self, wait=True):
-            self.kill_signal = True
+            """
+            Stops the background reading, mid subset if needed, closes the files and drops all the subsets held by the
+            loader. Doesn't wait for reads that are already running, so it returns quickly even while a subset is
+            being loaded.
+            :param wait: wait for the background thread to stop before closing the files and pools
+            """
+            self._stop_reading()
             if wait:
                 self.reading_thread_main.join()
+                self._handle_pool.close()
+                if self._process_pool is not None:
+                    self._process_pool.shutdown(wait=False, cancel_futures=True)
+                if self._async_executor is not None:
+                    self._async_executor.shutdown(wait=False, cancel_futures=True)
 
-        def prepare_next_epoch(self):
+            # Batches that are still referenced outside keep their arrays alive, the rest is freed here
+            self.current_sampled_subset = None
+            self._stream_buffer = None
+            with self._free_lock:
+                self._free_subsets.clear()
+
+        def prepare_next_epoch(self, release=False):
+            """
+            Moves on to the next subset.
+            :param release: hand the arrays of the current subset back to the loader, which assembles one of the next
+                            subsets in them. Only if nothing that is still used refers to them: get_batch returns copies,
+                            but get_subset, slices from __getitem__ and torch.from_numpy tensors of either are views.
+                            Otherwise the current subset is only dropped and freed once nothing references it anymore.
+            """
+            if self._streaming and self.current_sampled_subset is not None:
+                # Never waits, switches to the refreshed buffer only if it is ready
+                subset = self.sampled_subsets_queue.get(block=False)
+                if subset is None:
+                    self._raise_reader_error()
+                    self.num_reused_subsets += 1
+                    return
+                with self._cursor_lock:
+                    self._current_cursor = self._pending_cursors.popleft()
+                if release:
+                    self._release_subset(self.current_sampled_subset)
+                self.current_sampled_subset = subset
+                return
+
+            with self._cursor_lock:
+                self._current_cursor = None
+            if release:
+                self._release_subset(self.current_sampled_subset)
             self.current_sampled_subset = None
 
         def get_read_progress(self):
             if self.sampled_subsets_queue.qsize() >= 1:
                 return 1.
 
-            return float(len(self._data_read_copy_for_monitoring_progress)) / self._num_blocks
+            return float(len(self._data_read_copy_for_monitoring_progress)) / self._num_blocks_being_read
 
 
 
     class RootBlockShuffledSubsetDataLoader(Iterable):
-        def __init__(self, dataset: str, block_size, num_blocks, batch_size, engine='torch'):
+        def __init__(self, dataset: str, block_size, num_blocks, batch_size, engine='torch', prefetch_subsets=3,
+                     prefetch_bytes=-1, branches=None, max_read_blocks=16, backend='uproot', read_executor='thread',
+                     num_read_workers=4, zero_copy=False, pin_memory=False, pack_momenta=False, seed=None,
+                     state=None, tree_name='DecayTree', file_weights=None, streaming=False, refresh_blocks=None,
+                     memory_budget=-1, max_in_flight=16, selection=None, selection_engine='numpy', stratify_by=None,
+                     channel_proportions=None, truth_kinematics=False):
+            """
+            :param dataset: a root file, a glob pattern or a list of either, see RootBlockShuffledSubsetDataset
+            :param zero_copy: yield torch.from_numpy views of consecutive slices of the (already shuffled) subset
+                              instead of copying every batch. Only used with the torch engine. The batches then alias
+                              the arrays of the subset: modifying a batch in place modifies the subset, and the subset
+                              is only reused for later subsets once prepare_next_epoch(release=True) says that none of
+                              its batches is in use anymore.
+            :param pin_memory: with zero_copy, copy each subset once into page-locked memory so that the batches can be
+                               moved to the GPU asynchronously. Ignored if CUDA is not available.
+            :param pack_momenta: add the momenta [N, 3, 3] and momenta_mother [N, 1, 3] arrays to every subset so that
+                                 MomentaCatPreprocessor doesn't have to stack them on every step.
+            :param seed: seed of the block and row permutations, see RootBlockShuffledSubsetDataset
+            :param state: state_dict() of a previous loader to resume from
+            :param tree_name: name of the tree in every file
+            :param file_weights: per file sampling weights, see RootBlockShuffledSubsetDataset
+            :param streaming: rolling buffer instead of whole subset swaps, see RootBlockShuffledSubsetDataset
+            :param refresh_blocks: blocks per buffer refresh in streaming mode
+            :param memory_budget: bytes the subsets may take in total, see RootBlockShuffledSubsetDataset
+            :param max_in_flight: concurrent reads of the async reader, see RootBlockShuffledSubsetDataset
+            :param selection: per event selection applied by the reader, see RootBlockShuffledSubsetDataset. len() is
+                              then an upper bound, every pass yields the full batches of the current subset.
+            :param selection_engine: 'numpy' or 'numexpr'
+            :param stratify_by: branches identifying the decay channel, see RootBlockShuffledSubsetDataset
+            :param channel_proportions: share of every channel in the subsets, see RootBlockShuffledSubsetDataset
+            :param truth_kinematics: add the truth Dalitz and parent masses to the subsets, so that the losses only
+                                     compute the decoded side
+            """
             # super().__init__(dataset)
-            self._dataset = RootBlockShuffledSubsetDataset(dataset, block_size=block_size, num_blocks=num_blocks)
+            self._dataset = RootBlockShuffledSubsetDataset(dataset, block_size=block_size, num_blocks=num_blocks,
+                                                           prefetch_subsets=prefetch_subsets,
+                                                           prefetch_bytes=prefetch_bytes,
+                                                           branches=branches,
+                                                           max_read_blocks=max_read_blocks,
+                                                           backend=backend,
+                                                           read_executor=read_executor,
+                                                           num_read_workers=num_read_workers,
+                                                           pack_momenta=pack_momenta,
+                                                           seed=seed,
+                                                           state=state,
+                                                           tree_name=tree_name,
+                                                           file_weights=file_weights,
+                                                           streaming=streaming,
+                                                           refresh_blocks=refresh_blocks,
+                                                           max_in_flight=max_in_flight,
+                                                           selection=selection,
+                                                           selection_engine=selection_engine,
+                                                           stratify_by=stratify_by,
+                                                           channel_proportions=channel_proportions,
+                                                           truth_kinematics=truth_kinematics,
+                                                           memory_budget=memory_budget)
 
             self._batch_size = batch_size
+            # The dataset may have lowered num_blocks to fit the memory budget
             self.length = math.floor(len(self._dataset) / self._batch_size)
             self.block_size = block_size
             self.engine = engine
@@ -436,6 +1668,11 @@ if torch_installed:
             elif self.engine == 'tf':
                 self.fn_to_tensor = lambda x: tf.convert_to_tensor(x)
 
+            self.zero_copy = zero_copy and self.engine == 'torch'
+            self.pin_memory = pin_memory and torch.cuda.is_available()
+            self._tensor_subset_source = None
+            self._tensor_subset = None
+
         @property
         def num_blocks(self):
             return self._dataset.num_blocks
@@ -451,6 +1688,26 @@ if torch_installed:
         def get_read_progress(self):
             return self._dataset.get_read_progress()
 
+        def get_wait_stats(self):
+            return self._dataset.get_wait_stats()
+
+        def get_memory_usage(self):
+            return self._dataset.get_memory_usage()
+
+        def get_selection_stats(self):
+            return self._dataset.get_selection_stats()
+
+        def get_channel_stats(self):
+            return self._dataset.get_channel_stats()
+
+        def state_dict(self):
+            return self._dataset.state_dict()
+
+        def load_state_dict(self, state):
+            self._tensor_subset_source = None
+            self._tensor_subset = None
+            self._dataset.load_state_dict(state)
+
         def wait_to_load(self, prefix=''):
             with AsyncProgressBar(1., lambda: self._dataset.get_read_progress(), prefix=prefix):
                 self._dataset.get_no_masking(0)
@@ -458,12 +1715,45 @@ if torch_installed:
         def reset(self):
             self._dataset.reset()
 
-        def prepare_next_epoch(self):
+        def prepare_next_epoch(self, release=None):
+            """
+            :param release: let the loader reuse the arrays of the current subset for one of the next ones, see
+                            RootBlockShuffledSubsetDataset.prepare_next_epoch. None to release them only if the batches
+                            handed out were copies, True once no batch of the current subset is in use anymore.
+            """
             print("Next epoch now.")
-            self._dataset.prepare_next_epoch()
+            if release is None:
+                release = not self._batches_are_views()
+            self._tensor_subset_source = None
+            self._tensor_subset = None
+            self._dataset.prepare_next_epoch(release=release)
+
+        def _batches_are_views(self):
+            # Pinned tensors are copies of the subset, the plain torch.from_numpy ones share its memory
+            return self.zero_copy and not self.pin_memory
+
+        def _get_tensor_subset(self):
+            # Converted once per subset, the batches are views into these tensors
+            subset = self._dataset.get_subset()
+            if subset is not self._tensor_subset_source:
+                tensors = {k: torch.from_numpy(v) for k, v in subset.items()}
+                if self.pin_memory:
+                    tensors = {k: v.pin_memory() for k, v in tensors.items()}
+                self._tensor_subset_source = subset
+                self._tensor_subset = tensors
+            return self._tensor_subset
 
         def __iter__(self):
-            for i in range(self.length):
+            # Subsets can be shorter than len() batches if a selection is applied
+            num_batches = min(self.length, self._dataset.get_subset_length() // self._batch_size)
+            if self.zero_copy:
+                for i in range(num_batches):
+                    tensors = self._get_tensor_subset()
+                    start = i * self._batch_size
+                    yield {k: v[start:start + self._batch_size] for k, v in tensors.items()}
+                return
+
+            for i in range(num_batches):
                 indices = np.arange(self._batch_size) + (i * self._batch_size)
                 batch = self._dataset.get_batch(indices)
                 batch = {k:self.fn_to_tensor(v) for k,v in batch.items()}
@@ -478,19 +1768,15 @@ if torch_installed:
             self._dataset.exit()
 
     class RootTensorDataset(Dataset):
-        def __init__(self, file, tree_name, cache_size=-1):
+        def __init__(self, file, tree_name, cache_size=-1, branches=None):
             self.tree = uproot.open(file)[tree_name]
-            self.keys = self.tree.keys()
+            index = load_tree_index(file, tree_name)
+            self.keys = check_branches(index['keys'], branches)
             self.cache = []
             self.cache_start = 0
             self.cache_end = 0
 
-            lens = set()
-            for k in self.keys:
-                num_entries = self.tree[k].num_entries
-                lens = lens.union({num_entries})
-            assert len(lens) == 1
-            self.length = list(lens)[0]
+            self.length = index['num_entries']
 
             self.cache_size = cache_size if cache_size != -1 else self.length
             self.cache_size = min(self.cache_size, self.length)
@@ -502,15 +1788,7 @@ if torch_installed:
             self.cache = self.tree.arrays(self.keys, library="np", entry_start=self.cache_start,
                                           entry_stop=self.cache_end)
 
-            cache_2 = {}
-            for k,v in self.cache.items():
-                if v.dtype == np.float64:
-                    cache_2[k] = v.astype(np.float32)
-                elif v.dtype == np.int64:
-                    cache_2[k] = v.astype(np.int32)
-                else:
-                    cache_2[k] = v
-            self.cache = cache_2
+            self.cache = downcast_arrays(self.cache)
             print("Cache loaded")
 
         def __getitem__(self, item):
@@ -521,6 +1799,43 @@ if torch_installed:
 
             return results
 
+        def __getitems__(self, items):
+            """
+            Whole batch at once for DataLoader(..., batch_size=n, collate_fn=nbe_default_collate), one indexing
+            operation per key instead of a dict per row.
+            :param items: row indices from the batch sampler
+            :return: dict of tensors with len(items) rows
+            """
+            indices = batch_indices(items)
+            if isinstance(indices, slice):
+                first, last = indices.start, indices.stop - 1
+            else:
+                first, last = int(indices.min()), int(indices.max())
+            if first >= self.cache_start and last < self.cache_end:
+                if isinstance(indices, slice):
+                    indices = slice(indices.start - self.cache_start, indices.stop - self.cache_start)
+                else:
+                    indices = indices - self.cache_start
+                return {key: torch.from_numpy(np.ascontiguousarray(self.cache[key][indices])) for key in self.keys}
+
+            # The batch spans more than the cache, gather it one cache window at a time in sorted order
+            indices = np.arange(indices.start, indices.stop) if isinstance(indices, slice) else indices
+            order = np.argsort(indices, kind='stable')
+            sorted_indices = indices[order]
+            results = None
+            i = 0
+            while i < len(sorted_indices):
+                if sorted_indices[i] < self.cache_start or sorted_indices[i] >= self.cache_end:
+                    self._load_cache(int(sorted_indices[i]))
+                j = np.searchsorted(sorted_indices, self.cache_end)
+                if results is None:
+                    results = {key: np.empty((len(indices),) + self.cache[key].shape[1:], self.cache[key].dtype)
+                               for key in self.keys}
+                for key in self.keys:
+                    results[key][order[i:j]] = self.cache[key][sorted_indices[i:j] - self.cache_start]
+                i = j
+            return {key: torch.from_numpy(v) for key, v in results.items()}
+
         def __len__(self):
             return self.length
 
@@ -531,17 +1846,133 @@ if torch_installed:
             self.one_key = None
             for k, v in dict.items():
                 assert type(v) is not list
-                self.dataset_dict[k] = TensorDataset(v)
+                self.dataset_dict[k] = v
                 lens = lens.union({len(v)})
                 self.one_key = k
 
             assert len(lens) == 1
 
         def __getitem__(self, item):
-            return_dict = {}
-            for k,v in self.dataset_dict.items():
-                return_dict[k] = v[item][0] # It returns output as a list
-            return return_dict
+            return {k: v[item] for k, v in self.dataset_dict.items()}
+
+        def __getitems__(self, items):
+            """
+            Whole batch at once for DataLoader(..., batch_size=n, collate_fn=nbe_default_collate), one index_select
+            per key (or a view for contiguous indices) instead of a dict per row.
+            :param items: row indices from the batch sampler
+            :return: dict of tensors with len(items) rows
+            """
+            indices = batch_indices(items)
+            if isinstance(indices, slice):
+                return {k: v[indices] for k, v in self.dataset_dict.items()}
+            indices = torch.from_numpy(indices)
+            return {k: v.index_select(0, indices) for k, v in self.dataset_dict.items()}
 
         def __len__(self):
             return len(self.dataset_dict[self.one_key])
+
+
+    def read_dict_tensors(input_file, tree_name='DecayTree', branches=None, selection=None, selection_engine='numpy',
+                          pack_momenta=False, truth_kinematics=False):
+        """
+        Reads whole trees into contiguous torch tensors, with the same 32 bit downcasts, selection and packed momenta
+        as the block loader.
+        :param input_file: a root file, a directory written by convert_root_to_columnar, a glob pattern or a list
+        :return: dict of tensors with the events of all the files, in file order
+        """
+        event_selection = EventSelection(selection, engine=selection_engine) if selection is not None else None
+        read_branches = branches
+        if branches is not None and event_selection is not None:
+            read_branches = list(branches) + [b for b in event_selection.branches if b not in branches]
+
+        chunks = []
+        for file_path in resolve_input_files(input_file):
+            file, tree = open_tree(file_path, tree_name, 'columnar' if os.path.isdir(file_path) else 'uproot')
+            try:
+                keys = check_branches(tree.keys(), read_branches)
+                x = downcast_arrays(tree.arrays(keys, library='np'))
+            finally:
+                file.close()
+            if event_selection is not None:
+                mask = event_selection(x)
+                x = {k: v[mask] for k, v in x.items()}
+            chunks.append(x)
+
+        joined = tensors_dict_join(chunks)
+        if pack_momenta:
+            joined.update(pack_momenta_arrays(joined))
+        if truth_kinematics:
+            joined.update(derive_truth_kinematics(joined))
+        return {k: torch.from_numpy(np.ascontiguousarray(v)) for k, v in joined.items()}
+
+
+    class InMemoryDataLoader(Iterable):
+        """
+        Loader for data that fits in memory. Every column is a single contiguous tensor and every pass over it draws
+        a new permutation, batches are gathered from it with one index_select per column, no per event __getitem__
+        and no collate. Yields the same dict batches as RootBlockShuffledSubsetDataLoader.
+
+        :param tensors: dict of tensors with the same first dimension, e.g. from read_dict_tensors
+        :param batch_size: events per batch, the last incomplete batch is dropped
+        :param shuffle: draw a new permutation for every pass, otherwise the events come in order
+        :param seed: the permutation of pass i comes from (seed, i), random if None
+        :param pin_memory: gather the batches into page-locked memory so that they can be moved to the GPU
+                           asynchronously. Ignored if CUDA is not available.
+        """
+        def __init__(self, tensors, batch_size, shuffle=True, seed=None, pin_memory=False):
+            lens = set(len(v) for v in tensors.values())
+            assert len(lens) == 1
+            self.length_full = list(lens)[0]
+            self._batch_size = batch_size
+            self.length = self.length_full // batch_size
+            self.shuffle = shuffle
+            self.pin_memory = pin_memory and torch.cuda.is_available()
+            self.tensors = {k: v.contiguous() for k, v in tensors.items()}
+
+            self._seed = seed if seed is not None else random.randrange(2 ** 32)
+            self._epoch = 0
+
+        @property
+        def batch_size(self):
+            return self._batch_size
+
+        def __len__(self):
+            return self.length
+
+        def state_dict(self):
+            return {'seed': self._seed, 'epoch': self._epoch}
+
+        def load_state_dict(self, state):
+            self._seed = state['seed']
+            self._epoch = state['epoch']
+
+        def wait_to_load(self, prefix=''):
+            # Everything is read in the constructor
+            pass
+
+        def reset(self):
+            pass
+
+        def prepare_next_epoch(self):
+            pass
+
+        def exit(self):
+            self.tensors = {}
+
+        def __iter__(self):
+            permutation = None
+            if self.shuffle:
+                rng = np.random.default_rng((self._seed, self._epoch))
+                permutation = torch.from_numpy(rng.permutation(self.length_full))
+            self._epoch += 1
+
+            for i in range(self.length):
+                start = i * self._batch_size
+                if permutation is None:
+                    batch = {k: v[start:start + self._batch_size] for k, v in self.tensors.items()}
+                else:
+                    indices = permutation[start:start + self._batch_size]
+                    batch = {k: v.index_select(0, indices) for k, v in self.tensors.items()}
+                if self.pin_memory:
+                    batch = {k: v.pin_memory() for k, v in batch.items()}
+                yield batch
@@ -105,9 +105,14 @@ class ThreeBodyDecayGanExperiment(pl.LightningModule):
         # if len(self.preprocessors) > 0:
         #     return
         if datamodule is None:
-            loader = self.trainer.datamodule.train_dataloader()
-        else:
-            loader = datamodule.train_dataloader()
+            datamodule = self.trainer.datamodule
+
+        if getattr(datamodule, 'precomputed_stats', False):
+            # From the full train files, loaded from next to the data, no batch of the loader is consumed
+            self.preprocessors[1].estimate_from_stats(datamodule.get_preprocessing_stats())
+            return
+
+        loader = datamodule.train_dataloader()
 
         all_data = []
         the_preprocessors = []
@@ -132,6 +137,14 @@ class ThreeBodyDecayGanExperiment(pl.LightningModule):
     def on_train_epoch_end(self) -> None:
         loader = self.trainer.datamodule.train_dataloader()
         if type(loader) is RootBlockShuffledSubsetDataLoader:
+            self.log('loader_wait_time', loader.get_wait_stats()['consumer_wait_time'])
+            self.log('loader_memory', float(loader.get_memory_usage()['total']))
+            self.log('loader_selection_efficiency', loader.get_selection_stats()['efficiency'])
+            channel_stats = loader.get_channel_stats()
+            if channel_stats is not None:
+                for channel, rows in channel_stats.items():
+                    # Channel names are the PIDs joined by commas, which don't belong in a metric name
+                    self.log('loader_rows_%s' % channel.replace(',', '_'), float(rows))
             prepare_next = True
             if 'reuse_prev_epoch_if_next_not_ready' in self.params:
                 if self.params['reuse_prev_epoch_if_next_not_ready']:
@@ -0,0 +1,200 @@
+import warnings
+
+import numpy as np
+
+
+# torch is imported where it is needed, the numpy kernels are also used by the rapidsim tools
+def get_engine(_engine):
+    if _engine == 'np':
+        return np
+    elif _engine == 'torch':
+        import torch
+        return torch
+    else:
+        raise RuntimeError("Unknown engine")
+
+
+def three_body_kinematics(momenta, masses, squared=False, nan_to_num=True, _engine='torch'):
+    """
+    Energies, Dalitz masses and parent mass of three body decays in a single pass over the momenta. Same formulas
+    (and order of operations) as compute_dalitz_masses and compute_parent_mass.
+
+    :param momenta: [B, 3, 3] momenta, particle x (PX, PY, PZ)
+    :param masses: [B, 3] masses of the three particles
+    :param squared: return m13^2 and m32^2 instead of m13 and m32
+    :param nan_to_num: replace NaNs of the Dalitz masses (from unphysical momenta) by zeros
+    :param _engine: 'torch' or 'np'
+    :return: dict with energies [B, 3], mass_13 [B], mass_32 [B] and parent_mass [B]
+    """
+    engine = get_engine(_engine)
+
+    px = momenta[:, :, 0]
+    py = momenta[:, :, 1]
+    pz = momenta[:, :, 2]
+    energies = engine.sqrt(masses ** 2 + px ** 2 + py ** 2 + pz ** 2)
+
+    def pair_mass(i, j):
+        mass = (energies[:, i] + energies[:, j]) ** 2 - (px[:, i] + px[:, j]) ** 2 - (py[:, i] + py[:, j]) ** 2 \
+               - (pz[:, i] + pz[:, j]) ** 2
+        if not squared:
+            mass = engine.sqrt(mass)
+        if nan_to_num:
+            mass = engine.nan_to_num(mass)
+        return mass
+
+    mass_32 = pair_mass(2, 1)
+    mass_13 = pair_mass(0, 2)
+
+    pe = energies[:, 0] + energies[:, 1] + energies[:, 2]
+    parent_mass = engine.sqrt(pe ** 2 - (px[:, 0] + px[:, 1] + px[:, 2]) ** 2 - (py[:, 0] + py[:, 1] + py[:, 2]) ** 2
+                              - (pz[:, 0] + pz[:, 1] + pz[:, 2]) ** 2)
+
+    return {'energies': energies, 'mass_13': mass_13, 'mass_32': mass_32, 'parent_mass': parent_mass}
+
+
+# Depend on the truth momenta and masses only, the loaders can add them to the subsets once (truth_kinematics) and the
+# losses then only compute the decoded side
+truth_kinematics_features = ['mass_13', 'mass_32', 'parent_mass']
+
+
+_compiled_kinematics = None
+
+
+def get_kinematics_fn(compile=False):
+    """
+    three_body_kinematics, or the torch.compile version of it (compiled once per process, falls back to the eager
+    function where torch.compile is not available).
+    """
+    global _compiled_kinematics
+    if not compile:
+        return three_body_kinematics
+    if _compiled_kinematics is None:
+        import torch
+        try:
+            _compiled_kinematics = torch.compile(three_body_kinematics, dynamic=True)
+        except Exception as e:
+            warnings.warn("torch.compile not available, using eager kinematics: %s" % e)
+            _compiled_kinematics = three_body_kinematics
+    return _compiled_kinematics
+
+
+def masses_from_sample(sample, _engine='torch'):
+    """
+    :return: [B, 3] masses from particle_{1,2,3}_M
+    """
+    return get_engine(_engine).stack([sample['particle_%d_M' % i] for i in [1, 2, 3]], 1)
+
+
+def momenta_from_sample(sample, tag, reco_var='momenta_reconstructed_upp', _engine='torch'):
+    """
+    [B, 3, 3] momenta the way compute_dalitz_masses picks them: reco_var for tag '_DECODED', momenta_upp for the truth
+    (tag '') if they are in the sample, the particle_{i}_{PX,PY,PZ}{tag} branches otherwise.
+    """
+    if tag == '_DECODED' and reco_var in sample:
+        return sample[reco_var]
+    if tag == '' and 'momenta_upp' in sample:
+        return sample['momenta_upp']
+    engine = get_engine(_engine)
+    return engine.stack([engine.stack([sample[f'particle_{p}_{c}{tag}'] for c in ['PX', 'PY', 'PZ']], 1)
+                         for p in ['1', '2', '3']], 1)
+
+
+def sample_kinematics(sample, tag, squared=False, nan_to_num=True, _engine='torch',
+                      reco_var='momenta_reconstructed_upp', compile=False):
+    """
+    three_body_kinematics of the truth (tag '') or decoded (tag '_DECODED') momenta of a sample dict.
+    """
+    momenta = momenta_from_sample(sample, tag, reco_var=reco_var, _engine=_engine)
+    kinematics_fn = get_kinematics_fn(compile and _engine == 'torch')
+    return kinematics_fn(momenta, masses_from_sample(sample, _engine=_engine), squared=squared,
+                         nan_to_num=nan_to_num, _engine=_engine)
+
+
+def rotation_matrices(vec1, vec2):
+    """
+    Batched Rodrigues rotation matrices that align every vec1 with the corresponding vec2, no per event Python.
+    R = I + K + K^2 / (1 + c) with K the cross product matrix of v = a x b and c = a . b of the unit vectors, which is
+    the (1 - c) / |v|^2 form but also gives the identity for vectors that are already aligned. Undefined (inf) for
+    antiparallel ones.
+    :param vec1: [N, 3] source vectors
+    :param vec2: [N, 3] or [3] destination vectors
+    :return: [N, 3, 3] rotation matrices
+    """
+    vec1 = np.asarray(vec1, dtype=np.float64)
+    vec2 = np.broadcast_to(np.asarray(vec2, dtype=np.float64), vec1.shape)
+    a = vec1 / np.linalg.norm(vec1, axis=1, keepdims=True)
+    b = vec2 / np.linalg.norm(vec2, axis=1, keepdims=True)
+    v = np.cross(a, b)
+    c = np.einsum('ni,ni->n', a, b)
+
+    matrices = np.zeros((len(a), 3, 3))
+    matrices[:, 0, 1], matrices[:, 0, 2], matrices[:, 1, 2] = -v[:, 2], v[:, 1], -v[:, 0]
+    matrices[:, 1, 0], matrices[:, 2, 0], matrices[:, 2, 1] = v[:, 2], -v[:, 1], v[:, 0]
+    # K^2 = v v^T - |v|^2 I
+    k_squared = np.einsum('ni,nj->nij', v, v)
+    k_squared[:, [0, 1, 2], [0, 1, 2]] -= np.einsum('ni,ni->n', v, v)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrices += k_squared / (1 + c)[:, np.newaxis, np.newaxis]
+    matrices[:, [0, 1, 2], [0, 1, 2]] += 1
+    return matrices
+
+
+def rotate(vectors, matrices):
+    """
+    :param vectors: [N, 3] or [N, K, 3] vectors, e.g. the momenta of the K particles of every event
+    :param matrices: [N, 3, 3] rotation matrices
+    :return: the vectors rotated by the matrix of their event, same shape
+    """
+    if vectors.ndim == 2:
+        return np.einsum('nij,nj->ni', matrices, vectors)
+    return np.einsum('nij,nkj->nki', matrices, vectors)
+
+
+def align_to_axis(vectors, reference, axis=(0., 0., 1.), chunk_size=None, out=None):
+    """
+    Rotates every event so that its reference vector (e.g. the parent momentum) points along axis.
+    :param vectors: [N, K, 3] vectors to rotate
+    :param reference: [N, 3] reference vectors
+    :param axis: [3] destination of the reference vectors
+    :param chunk_size: number of events to rotate at a time, None for all at once. The temporaries (the rotation
+                       matrices and their intermediates, ~150 bytes per event) are then bounded by the chunk size, so
+                       large or memory mapped inputs can be rotated in fixed memory.
+    :param out: optional [N, K, 3] array to write into, may be vectors itself
+    :return: rotated [N, K, 3] vectors
+    """
+    if out is None:
+        out = np.empty(np.shape(vectors), dtype=np.result_type(vectors, np.float64))
+    num_events = len(vectors)
+    chunk_size = num_events if chunk_size is None else chunk_size
+    for start in range(0, num_events, max(chunk_size, 1)):
+        stop = min(start + chunk_size, num_events)
+        out[start:stop] = rotate(vectors[start:stop], rotation_matrices(reference[start:stop], axis))
+    return out
+
+
+def boost_to_rest_frame(momenta, energies, frame_momenta, frame_energies):
+    """
+    Boosts four-vectors into the rest frame of another one (vector's boostCM_of), plain numpy.
+    :param momenta: [..., 3] momenta to boost
+    :param energies: [...] their energies
+    :param frame_momenta: [..., 3] momenta of the frame, broadcastable to momenta, e.g. the parent of every event
+    :param frame_energies: [...] energies of the frame
+    :return: boosted momenta [..., 3] and energies [...]
+    """
+    beta = frame_momenta / frame_energies[..., np.newaxis]
+    beta2 = np.sum(beta ** 2, axis=-1)
+    gamma = 1. / np.sqrt(1. - beta2)
+    beta_p = np.sum(beta * momenta, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coefficient = np.where(beta2 > 0, (gamma - 1.) / beta2, 0.)
+    boosted_energies = gamma * (energies - beta_p)
+    boosted_momenta = momenta + ((coefficient * beta_p - gamma * energies)[..., np.newaxis]) * beta
+    return boosted_momenta, boosted_energies
+
+
+def invariant_mass(momenta, energies):
+    """
+    :return: sqrt(E^2 - p^2), negative for space like four-vectors like vector's .mass
+    """
+    mass_squared = energies ** 2 - np.sum(momenta ** 2, axis=-1)
+    return np.copysign(np.sqrt(np.abs(mass_squared)), mass_squared)
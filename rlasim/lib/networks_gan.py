@@ -4,7 +4,7 @@ from torch.nn import functional as F
 from functools import reduce
 from typing import List, Callable, Union, Any, TypeVar, Tuple
 from operator import mul
-from rlasim.lib.organise_data import compute_dalitz_masses, compute_parent_mass
+from rlasim.lib.kinematics import sample_kinematics, truth_kinematics_features
 
 Tensor = TypeVar('torch.tensor')
 
@@ -238,7 +238,8 @@ class MlpConditionalWGAN(nn.Module):
 
 
 class ThreeBodyGanLoss(nn.Module):
-    def __init__(self, secondary_weight=0.0, dalitz_weight=0.0, parent_mass_weight=0.0, loss_type='mse', truth_var='momenta', predicted_var='momenta_reconstructed', **kwards):
+    def __init__(self, secondary_weight=0.0, dalitz_weight=0.0, parent_mass_weight=0.0, loss_type='mse', truth_var='momenta', predicted_var='momenta_reconstructed',
+                 compile_kinematics=False, **kwards):
         super().__init__()
 
         self.secondary_weight = secondary_weight
@@ -248,6 +249,7 @@ class ThreeBodyGanLoss(nn.Module):
         self.truth_var = truth_var
         self.dalitz_weight = dalitz_weight
         self.parent_mass_weight = parent_mass_weight
+        self.compile_kinematics = compile_kinematics # torch.compile the Dalitz / parent mass kernel
 
 
     def forward(self, sample, iteration=-1):
@@ -281,10 +283,18 @@ class ThreeBodyGanLoss(nn.Module):
 
         # the_dict['loss_reco_p'] = recons_loss
 
-        mass_13, mass_32 = compute_dalitz_masses(sample, '', reco_var=self.predicted_var)
-        parent_mass = compute_parent_mass(sample, '', reco_var=self.predicted_var)
-        parent_mass_decoded = compute_parent_mass(sample, '_DECODED', reco_var=self.predicted_var)
-        mass_13_decoded, mass_32_decoded = compute_dalitz_masses(sample, '_DECODED', squared=True, reco_var=self.predicted_var)
+        # Masses of the truth, squared Dalitz masses of the decoded momenta, one pass each. The truth side comes
+        # with the batch if the loader derives it (data_params.truth_kinematics), from the raw particle momenta. With
+        # momenta_upp in the sample the truth masses are computed from those instead, like sample_kinematics does.
+        if 'momenta_upp' not in sample and all(k in sample for k in truth_kinematics_features):
+            truth = sample
+        else:
+            truth = sample_kinematics(sample, '', reco_var=self.predicted_var, compile=self.compile_kinematics)
+        decoded = sample_kinematics(sample, '_DECODED', squared=True, reco_var=self.predicted_var,
+                                    compile=self.compile_kinematics)
+        mass_13, mass_32, parent_mass = truth['mass_13'], truth['mass_32'], truth['parent_mass']
+        mass_13_decoded, mass_32_decoded, parent_mass_decoded = decoded['mass_13'], decoded['mass_32'], \
+            decoded['parent_mass']
         # print(mass_13, mass_13_decoded, mass_32, mass_32_decoded)
         # dalitz_loss = (F.mse_loss(mass_13, mass_13_decoded) + F.mse_loss(mass_32, mass_32_decoded))*0.001
         dalitz_loss = (distance_func(mass_13, mass_13_decoded) + distance_func(mass_32, mass_32_decoded))
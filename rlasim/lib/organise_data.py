@@ -7,6 +7,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import vector
 import math
+import re
 
 from pytorch_lightning import LightningDataModule
 from sklearn.preprocessing import QuantileTransformer
@@ -17,8 +18,10 @@ from torch.utils.data import DataLoader, TensorDataset, Dataset
 from torch import nn
 
 from rlasim.lib.data_core import DictTensorDataset, tensors_dict_join, RootTensorDataset, RootTensorDataset2, \
-    nbe_default_collate, RootBlockShuffledSubsetDataLoader
+    nbe_default_collate, RootBlockShuffledSubsetDataLoader, packed_feature_branches, InMemoryDataLoader, \
+    read_dict_tensors, load_branch_stats, combine_branch_stats, resolve_input_files
 from rlasim.lib.progress_bar import AsyncProgressBar
+from rlasim.lib.kinematics import three_body_kinematics, masses_from_sample, sample_kinematics, rotation_matrices
 
 
 def rotation_matrix_from_vectors_vectorised(vec1, vec2):
@@ -27,29 +30,13 @@ def rotation_matrix_from_vectors_vectorised(vec1, vec2):
     :param vec2: A 3d "destination" vector
     :return mat: A transform matrix (3x3) which when applied to vec1, aligns it with vec2.
     """
-    norm_vec1 = np.swapaxes(
-        np.asarray([np.linalg.norm(vec1, axis=1), np.linalg.norm(vec1, axis=1), np.linalg.norm(vec1, axis=1)]), 0, 1)
-    norm_vec2 = np.swapaxes(
-        np.asarray([np.linalg.norm(vec2, axis=1), np.linalg.norm(vec2, axis=1), np.linalg.norm(vec2, axis=1)]), 0, 1)
-    shape = np.shape(vec1)[0]
-    a, b = (vec1 / norm_vec1).reshape(shape, 3), (vec2 / norm_vec2).reshape(shape, 3)
-    v = np.cross(a, b, axis=1)
-    c = np.array([a[i, :].dot(b[i, :]) for i in range(shape)])
-    s = np.linalg.norm(v, axis=1)
-    kmat = np.array([[np.zeros(shape), -v[:, 2], v[:, 1]], [v[:, 2], np.zeros(shape), -v[:, 0]],
-                     [-v[:, 1], v[:, 0], np.zeros(shape)]])
-    rotation_matrix = np.array(
-        [np.eye(3) + kmat[:, :, i] + kmat[:, :, i].dot(kmat[:, :, i]) * ((1 - c[i]) / (s[i] ** 2)) for i in
-         range(shape)])
-    return rotation_matrix
+    # [N, 3] each, see rlasim.lib.kinematics.rotation_matrices
+    return rotation_matrices(vec1, vec2)
 
 
 def mag(vec):
-    sum_sqs = 0
-    for component in vec:
-        sum_sqs += component ** 2
-    mag = np.sqrt(sum_sqs)
-    return mag
+    # Components along the first axis
+    return np.sqrt(np.sum(np.asarray(vec) ** 2, axis=0))
 
 
 def norm(vec):
@@ -60,19 +47,12 @@ def norm(vec):
 
 
 def dot(vec1, vec2):
-    dot = 0
-    for component_idx in range(np.shape(vec1)[0]):
-        dot += vec1[component_idx] * vec2[component_idx]
-    return dot
+    return np.sum(np.asarray(vec1) * np.asarray(vec2), axis=0)
 
 
 def rot_vectorised(vec, mat):
-    rot_A = np.expand_dims(vec[0] * mat[:, 0, 0] + vec[1] * mat[:, 0, 1] + vec[2] * mat[:, 0, 2], 0)
-    rot_B = np.expand_dims(vec[0] * mat[:, 1, 0] + vec[1] * mat[:, 1, 1] + vec[2] * mat[:, 1, 2], 0)
-    rot_C = np.expand_dims(vec[0] * mat[:, 2, 0] + vec[1] * mat[:, 2, 1] + vec[2] * mat[:, 2, 2], 0)
-
-    vec = np.concatenate((rot_A, rot_B, rot_C), axis=0)
-    return vec
+    # vec is [3, N] (components first), mat [N, 3, 3]
+    return np.einsum('nij,jn->in', mat, np.asarray(vec))
 
     reshaped = np.asarray([[training_parameters["B_phi"], training_parameters["B_theta"], training_parameters["B_P"]]])
 
@@ -733,7 +713,8 @@ class MomentaCatPreprocessor(nn.Module, PreProcessor):
             raise ValueError('MomentaCatPreprocessor is only a preprocessor.')
         sample_2 = {}
 
-        if 'particle_1_PX' in sample:
+        # Already packed by the loader (pack_momenta)
+        if 'particle_1_PX' in sample and 'momenta' not in sample:
             momenta = torch.stack([sample['particle_1_PX'], sample['particle_1_PY'],
                                    sample['particle_1_PZ'], sample['particle_2_PX'],
                                    sample['particle_2_PY'], sample['particle_2_PZ'],
@@ -744,7 +725,7 @@ class MomentaCatPreprocessor(nn.Module, PreProcessor):
 
             sample_2['momenta'] = momenta
 
-        if 'mother_PX_TRUE' in sample:
+        if 'mother_PX_TRUE' in sample and 'momenta_mother' not in sample:
             momenta_mother = torch.stack([sample['mother_PX_TRUE'],
                                  sample['mother_PY_TRUE'], sample['mother_PZ_TRUE']], dim=1)
             momenta_mother = momenta_mother.reshape((len(sample['particle_1_PX']), 1, 3))
@@ -754,178 +735,70 @@ class MomentaCatPreprocessor(nn.Module, PreProcessor):
         return sample_2
 
 
-def compute_dalitz_masses_2(vec4, sample, nan_to_num=True, squared=False, _engine='torch'):
-    # This is recomputing it twice at least. This is fine as these things are fast but could be cleaned up later on.
-    sample_2 = {}
-    # sample_2.update(sample)
-    for particle_idx, particle in enumerate(['1', '2', '3']):
-        for coordinate_idx, coordinate in enumerate(['PX', 'PY', 'PZ']):
-            sample_2[f'particle_{particle}_{coordinate}'] = vec4[
-                                                                   :, particle_idx, coordinate_idx]
-
-                # # Check
-                # if coordinate_idx == 2:
-                #     sample_2[f'particle_{particle}_{coordinate}_DECODED']=sample_2['momenta_reconstructed_upp'][
-                #                                                        :, particle_idx, coordinate_idx]*0.0
-
-    if _engine == 'np':
-        engine = np
-    elif _engine == 'torch':
-        engine = torch
-    else:
-        raise RuntimeError("Unknown engine")
-
-    pe_1 = engine.sqrt(
-        sample['particle_1_M'] ** 2 + sample_2[f'particle_1_PX'] ** 2 + sample_2[f'particle_1_PY'] ** 2 + sample_2[
-            f'particle_1_PZ'] ** 2)
-    pe_2 = engine.sqrt(
-        sample['particle_2_M'] ** 2 + sample_2[f'particle_2_PX'] ** 2 + sample_2[f'particle_2_PY'] ** 2 + sample_2[
-            f'particle_2_PZ'] ** 2)
-    pe_3 = engine.sqrt(
-        sample['particle_3_M'] ** 2 + sample_2[f'particle_3_PX'] ** 2 + sample_2[f'particle_3_PY'] ** 2 + sample_2[
-            f'particle_3_PZ'] ** 2)
-
-    pe = pe_3 + pe_2
-    px = sample_2[f'particle_3_PX'] + sample_2[f'particle_2_PX']
-    py = sample_2[f'particle_3_PY'] + sample_2[f'particle_2_PY']
-    pz = sample_2[f'particle_3_PZ'] + sample_2[f'particle_2_PZ']
-    # p_32 = vector.obj(px=px, py=py, pz=pz, E=pe)
-
-    mass_32 = pe ** 2 - px ** 2 - py ** 2 - pz ** 2
-    if not squared:
-        mass_32 = engine.sqrt(mass_32)
-
-    pe = pe_1 + pe_3
-    px = sample_2[f'particle_1_PX'] + sample_2[f'particle_3_PX']
-    py = sample_2[f'particle_1_PY'] + sample_2[f'particle_3_PY']
-    pz = sample_2[f'particle_1_PZ'] + sample_2[f'particle_3_PZ']
-    # p_13 = vector.obj(px=px, py=py, pz=pz, E=pe)
-
-    mass_13 = pe ** 2 - px ** 2 - py ** 2 - pz ** 2
-    if not squared:
-        mass_13 = engine.sqrt(mass_13)
-
-    if nan_to_num:
-        mass_13 = engine.nan_to_num(mass_13)
-        mass_32 = engine.nan_to_num(mass_32)
-
-    return mass_13, mass_32
-
-def compute_parent_mass(sample, tag, nan_to_num=False, _engine='torch', reco_var='momenta_reconstructed_upp'):
+# Branches that features derived by the preprocessors are built from
+derived_feature_branches = packed_feature_branches
 
-    if _engine == 'np':
-        engine = np
-    elif _engine == 'torch':
-        engine = torch
-    else:
-        raise RuntimeError("Unknown engine")
-
-    sample_2 = {}
-    sample_2.update(sample)
-
-    for particle_idx, particle in enumerate(['1', '2', '3']):
-        for coordinate_idx, coordinate in enumerate(['PX', 'PY', 'PZ']):
-
-            if reco_var in sample.keys():
-                sample_2[f'particle_{particle}_{coordinate}_DECODED'] = sample_2[reco_var][
-                                                                       :, particle_idx, coordinate_idx]
-            if 'momenta_upp' in sample.keys():
-                sample_2[f'particle_{particle}_{coordinate}'] = sample_2['momenta_upp'][
-                                                                       :, particle_idx, coordinate_idx]
-
-    sample = sample_2
-
-    pe_1 = engine.sqrt(
-        sample_2['particle_1_M'] ** 2 + sample[f'particle_1_PX{tag}'] ** 2 + sample[f'particle_1_PY{tag}'] ** 2 + sample[
-            f'particle_1_PZ{tag}'] ** 2)
-    pe_2 = engine.sqrt(
-        sample_2['particle_2_M'] ** 2 + sample[f'particle_2_PX{tag}'] ** 2 + sample[f'particle_2_PY{tag}'] ** 2 + sample[
-            f'particle_2_PZ{tag}'] ** 2)
-    pe_3 = engine.sqrt(
-        sample_2['particle_3_M'] ** 2 + sample[f'particle_3_PX{tag}'] ** 2 + sample[f'particle_3_PY{tag}'] ** 2 + sample[
-            f'particle_3_PZ{tag}'] ** 2)
-
-    pe = pe_1 + pe_2 + pe_3
-    px = sample[f'particle_1_PX{tag}'] + sample[f'particle_2_PX{tag}'] + sample[f'particle_3_PX{tag}']
-    py = sample[f'particle_1_PY{tag}'] + sample[f'particle_2_PY{tag}'] + sample[f'particle_3_PY{tag}']
-    pz = sample[f'particle_1_PZ{tag}'] + sample[f'particle_2_PZ{tag}'] + sample[f'particle_3_PZ{tag}']
-
-    B_mass = engine.sqrt(pe ** 2 - px ** 2 - py ** 2 - pz ** 2)
-    if tag == '':
-        tag = '_DECODED'
-    # print("YYY", tag, '%#05.5f'%float(engine.mean(pe)), '%#05.5f'%float(engine.mean(px)), '%#05.5f'%float(engine.mean(py)), '%#05.5f'%float(engine.mean(pz)), '%#05.5f'%float(engine.mean(sample[f'particle_3_PZ{tag}'])))
-    return B_mass
-
-def compute_dalitz_masses(sample, tag, nan_to_num=True, squared=False, _engine='torch', reco_var='momenta_reconstructed_upp'):
-    # This is recomputing it twice at least. This is fine as these things are fast but could be cleaned up later on.
-    sample_2 = {}
-    sample_2.update(sample)
-    # sample_2.pop('particle_1_PX')
-    # sample_2.pop('particle_1_PY')
-    # sample_2.pop('particle_1_PZ')
-    # sample_2.pop('particle_2_PX')
-    # sample_2.pop('particle_2_PY')
-    # sample_2.pop('particle_2_PZ')
-    # sample_2.pop('particle_3_PX')
-    # sample_2.pop('particle_3_PY')
-    # sample_2.pop('particle_3_PZ')
-    for particle_idx, particle in enumerate(['1', '2', '3']):
-        for coordinate_idx, coordinate in enumerate(['PX', 'PY', 'PZ']):
-
-            if reco_var in sample.keys():
-                sample_2[f'particle_{particle}_{coordinate}_DECODED'] = sample_2[reco_var][
-                                                                       :, particle_idx, coordinate_idx]
-            if 'momenta_upp' in sample.keys():
-                sample_2[f'particle_{particle}_{coordinate}'] = sample_2['momenta_upp'][
-                                                                       :, particle_idx, coordinate_idx]
-
-            # # Check
-            # if coordinate_idx == 2:
-            #     sample_2[f'particle_{particle}_{coordinate}_DECODED']=sample_2['momenta_reconstructed_upp'][
-            #                                                        :, particle_idx, coordinate_idx]*0.0
+# Consumed by the Dalitz/parent mass computations in the losses and by the validation plots
+auxiliary_branches = ['particle_1_M', 'particle_2_M', 'particle_3_M',
+                      'particle_1_PID', 'particle_2_PID', 'particle_3_PID', 'mother_PID']
 
-    if _engine == 'np':
-        engine = np
-    elif _engine == 'torch':
-        engine = torch
-    else:
-        raise RuntimeError("Unknown engine")
 
-    pe_1 = engine.sqrt(
-        sample_2['particle_1_M'] ** 2 + sample_2[f'particle_1_PX{tag}'] ** 2 + sample_2[f'particle_1_PY{tag}'] ** 2 + sample_2[
-            f'particle_1_PZ{tag}'] ** 2)
-    pe_2 = engine.sqrt(
-        sample_2['particle_2_M'] ** 2 + sample_2[f'particle_2_PX{tag}'] ** 2 + sample_2[f'particle_2_PY{tag}'] ** 2 + sample_2[
-            f'particle_2_PZ{tag}'] ** 2)
-    pe_3 = engine.sqrt(
-        sample_2['particle_3_M'] ** 2 + sample_2[f'particle_3_PX{tag}'] ** 2 + sample_2[f'particle_3_PY{tag}'] ** 2 + sample_2[
-            f'particle_3_PZ{tag}'] ** 2)
+def get_required_branches(config):
+    """
+    Derives the branches of the tree that need to be read from a full yaml config.
 
-    pe = pe_3 + pe_2
-    px = sample_2[f'particle_3_PX{tag}'] + sample_2[f'particle_2_PX{tag}']
-    py = sample_2[f'particle_3_PY{tag}'] + sample_2[f'particle_2_PY{tag}']
-    pz = sample_2[f'particle_3_PZ{tag}'] + sample_2[f'particle_2_PZ{tag}']
-    # p_32 = vector.obj(px=px, py=py, pz=pz, E=pe)
+    data_params.branches, if set, overrides the derived list. data_params.extra_branches and the {branch} placeholders of
+    the plotter conditions are added to it.
+    :param config: dict of the full config with model_params, data_params and optionally plotter
+    :return: Sorted list of branch names
+    """
+    data_params = config['data_params']
+    if data_params.get('branches', None) is not None:
+        return list(data_params['branches'])
+
+    # MomentaCatPreprocessor and OnlineThreeBodyDecayMomentaPreprocessor always need both momenta and momenta_mother
+    required = set(derived_feature_branches['momenta']) | set(derived_feature_branches['momenta_mother'])
+    required |= set(auxiliary_branches)
+
+    model_params = config['model_params']
+    for feats in [model_params.get('conditional_feats', None), model_params.get('data_feats', None)]:
+        if feats is None:
+            continue
+        for k in feats.keys():
+            k = k[:-len('_pp')] if k.endswith('_pp') else k
+            if k in derived_feature_branches:
+                required |= set(derived_feature_branches[k])
+            else:
+                required.add(k)
+
+    # The plotter evaluates its conditions on the validation samples, e.g. '{particle_1_PID} == -11'
+    plotter_params = config.get('plotter', None) or {}
+    for condition in plotter_params.get('conditions', None) or []:
+        code = condition[0] if type(condition) is list else condition
+        for k in re.findall(r'\{(\w+)\}', code):
+            if k in derived_feature_branches:
+                required |= set(derived_feature_branches[k])
+            else:
+                required.add(k)
 
-    mass_32 = pe ** 2 - px ** 2 - py ** 2 - pz ** 2
-    if not squared:
-        mass_32 = engine.sqrt(mass_32)
+    required |= set(data_params.get('extra_branches', []))
+    return sorted(required)
 
-    pe = pe_1 + pe_3
-    px = sample_2[f'particle_1_PX{tag}'] + sample_2[f'particle_3_PX{tag}']
-    py = sample_2[f'particle_1_PY{tag}'] + sample_2[f'particle_3_PY{tag}']
-    pz = sample_2[f'particle_1_PZ{tag}'] + sample_2[f'particle_3_PZ{tag}']
-    # p_13 = vector.obj(px=px, py=py, pz=pz, E=pe)
 
-    mass_13 = pe ** 2 - px ** 2 - py ** 2 - pz ** 2
-    if not squared:
-        mass_13 = engine.sqrt(mass_13)
+def compute_dalitz_masses_2(vec4, sample, nan_to_num=True, squared=False, _engine='torch'):
+    # vec4 are [B, 3, 3] momenta, the masses come from the sample
+    kinematics = three_body_kinematics(vec4, masses_from_sample(sample, _engine=_engine), squared=squared,
+                                       nan_to_num=nan_to_num, _engine=_engine)
+    return kinematics['mass_13'], kinematics['mass_32']
 
-    if nan_to_num:
-        mass_13 = engine.nan_to_num(mass_13)
-        mass_32 = engine.nan_to_num(mass_32)
+def compute_parent_mass(sample, tag, nan_to_num=False, _engine='torch', reco_var='momenta_reconstructed_upp'):
+    # nan_to_num is ignored, as it always was. Use sample_kinematics to get all the masses in one go.
+    return sample_kinematics(sample, tag, _engine=_engine, reco_var=reco_var)['parent_mass']
 
-    return mass_13, mass_32
+def compute_dalitz_masses(sample, tag, nan_to_num=True, squared=False, _engine='torch', reco_var='momenta_reconstructed_upp'):
+    kinematics = sample_kinematics(sample, tag, squared=squared, nan_to_num=nan_to_num, _engine=_engine,
+                                   reco_var=reco_var)
+    return kinematics['mass_13'], kinematics['mass_32']
 
 
 
@@ -1107,6 +980,32 @@ class OnlineThreeBodyDecayMomentaPreprocessor(nn.Module, PreProcessor, PostProce
             estimation_sample = tensors_dict_join(estimation_sample)
         self.get_limits_from_samples(estimation_sample['momenta'], estimation_sample['momenta_mother'])
 
+    def estimate_from_stats(self, stats):
+        """
+        Same limits as get_limits_from_samples but from the precomputed min and max of the branches (see
+        ThreeBodyDecayDataset.get_preprocessing_stats), without reading any events. log(pz + 5) is monotonic, so the
+        limits of the transformed pz are the transformed limits of pz.
+        :param stats: dict from branch name to a dict with min and max, for the packed_feature_branches
+        """
+        def limits(feature, key):
+            x = torch.tensor([stats[b][key] for b in packed_feature_branches[feature]], dtype=torch.float32)
+            x = x.reshape((1, -1, 3))
+            x[:, :, 2] = torch.log(x[:, :, 2] + 5.0)
+            return x
+
+        self.min_decay_prods.data = self._widen_min(limits('momenta', 'min'))
+        self.max_decay_prods.data = self._widen_max(limits('momenta', 'max'))
+        self.min_mother.data = self._widen_min(limits('momenta_mother', 'min'))
+        self.max_mother.data = self._widen_max(limits('momenta_mother', 'max'))
+
+    @staticmethod
+    def _widen_min(x):
+        return torch.where(x<0, x * 1.1, x * 0.9)
+
+    @staticmethod
+    def _widen_max(x):
+        return torch.where(x<0, x * 0.9, x * 1.1)
+
     def forward(self, sample: dict, direction=1, on=None):
         """
         :param data: dict
@@ -1168,12 +1067,10 @@ class OnlineThreeBodyDecayMomentaPreprocessor(nn.Module, PreProcessor, PostProce
     def get_limits_from_samples(self, sample, sample_mother):
         def min_func(x):
             x,_ = torch.min(x, dim=0, keepdim=True)
-            x = torch.where(x<0, x * 1.1, x * 0.9)
-            return x
+            return self._widen_min(x)
         def max_func(x):
             x,_ = torch.max(x, dim=0, keepdim=True)
-            x = torch.where(x<0, x * 0.9, x * 1.1)
-            return x
+            return self._widen_max(x)
 
         assert len(sample.shape) == 3
         assert sample.shape[1] == 3
@@ -1268,6 +1165,26 @@ class ThreeBodyDecayDataset(LightningDataModule):
             load_together=200000,
             shuffle=False,
             engine = 'torch',
+            prefetch_subsets=3,
+            prefetch_bytes=-1,
+            branches=None,
+            backend='uproot',
+            read_executor='thread',
+            num_read_workers=4,
+            zero_copy=False,
+            pack_momenta=False,
+            seed=None,
+            tree_name='DecayTree',
+            streaming=False,
+            refresh_blocks=None,
+            memory_budget=-1,
+            max_in_flight=16,
+            selection=None,
+            selection_engine='numpy',
+            stratify_by=None,
+            channel_proportions=None,
+            truth_kinematics=False,
+            precomputed_stats=False,
             **kwargs,
     ):
         super().__init__()
@@ -1286,9 +1203,34 @@ class ThreeBodyDecayDataset(LightningDataModule):
         self.use_root_reader = use_root_reader
         self.load_together = load_together
         self.shuffle = shuffle # Only set to true if the whole dataset can be loaded into memory
+        self.prefetch_subsets = prefetch_subsets
+        self.prefetch_bytes = prefetch_bytes
+        self.branches = branches # None reads all the branches, see get_required_branches
+        self.backend = backend # 'columnar' reads from a memory mapped cache, see convert_root_to_columnar
+        self.read_executor = read_executor
+        self.num_read_workers = num_read_workers
+        self.zero_copy = zero_copy # Block loader batches are views of the subset, see RootBlockShuffledSubsetDataLoader
+        self.pack_momenta = pack_momenta
+        self.seed = seed # Seeds the block and row order of the loaders, which is saved in the checkpoints
+        self.tree_name = tree_name
+        self.streaming = streaming # Rolling buffer, prepare_next_epoch never waits for the next subset
+        self.refresh_blocks = refresh_blocks
+        self.memory_budget = memory_budget # Bytes per loader, -1 for no limit
+        self.max_in_flight = max_in_flight # Concurrent reads with read_executor='async'
+        self.selection = selection # Applied by the block loaders while reading, see EventSelection
+        self.selection_engine = selection_engine
+        self.stratify_by = stratify_by # Fill the subsets per decay channel, see RootBlockShuffledSubsetDataset
+        self.channel_proportions = channel_proportions
+        self.truth_kinematics = truth_kinematics # Truth Dalitz / parent masses computed by the loaders, once per subset
+        self.precomputed_stats = precomputed_stats # Preprocessor limits from get_preprocessing_stats, not from batches
+
+        # Loader states restored from a checkpoint before the loaders were created
+        self._loader_states = {}
 
         self._train_loader = None
         self._val_loader = None
+        self.dataset_train = None
+        self.dataset_test = None
 
     def get_data_simple(self, file):
         print("Attempting eta load")
@@ -1448,15 +1390,46 @@ class ThreeBodyDecayDataset(LightningDataModule):
     def split(self, data, split_at):
         return data[:split_at], data[split_at:]
 
-    def _get_loader(self, data_param, batch_size):
-        if type(data_param) is str:
+    def get_preprocessing_stats(self):
+        """
+        Min, max, mean and std of the momentum branches over all of the train files, computed in one pass
+        the first time and then loaded from sidecar files next to the data (see load_branch_stats).
+        rlasim/bin/compute_preprocessing_stats.py computes them ahead of training.
+        :return: dict from branch name to its stats
+        """
+        data_param = self.data_path['train']
+        p = data_param['path'] if type(data_param) is dict else data_param
+        branches = packed_feature_branches['momenta'] + packed_feature_branches['momenta_mother']
+        # Over the events that pass the selection, like the batches the limits would otherwise be estimated from
+        stats = [load_branch_stats(file_path, branches, tree_name=self.tree_name, backend=self.backend,
+                                   selection=self.selection, selection_engine=self.selection_engine)
+                 for file_path in resolve_input_files(p)]
+        return combine_branch_stats(stats)['branches']
+
+    def _read_in_memory(self, data_param):
+        p = data_param['path'] if type(data_param) is dict else data_param
+        return read_dict_tensors(p, tree_name=self.tree_name, branches=self.branches, selection=self.selection,
+                                 selection_engine=self.selection_engine, pack_momenta=self.pack_momenta,
+                                 truth_kinematics=self.truth_kinematics)
+
+    def _get_in_memory_loader(self, tensors, batch_size, shuffle, state=None):
+        loader = InMemoryDataLoader(tensors, batch_size, shuffle=shuffle, seed=self.seed, pin_memory=self.pin_memory)
+        if state is not None:
+            loader.load_state_dict(state)
+        return loader
+
+    def _get_loader(self, data_param, batch_size, state=None):
+        file_weights = None
+        if type(data_param) is str or type(data_param) is list:
             p = data_param
             block_size = 10000
             num_blocks = -1
         elif type(data_param) is dict:
+            # path can be a file, a glob pattern or a list of files
             p = data_param['path']
             num_blocks = data_param['num_blocks']
             block_size = data_param['block_size']
+            file_weights = data_param.get('file_weights', None)
         else:
             raise ValueError('The data param is of unknown type. It has to be either str showing the path of the'
                              'data file or a dict containing element data_path containing the path of the data file'
@@ -1466,7 +1439,29 @@ class ThreeBodyDecayDataset(LightningDataModule):
                                                  block_size=block_size,
                                                  num_blocks=num_blocks,
                                                  batch_size=batch_size,
-                                                 engine=self.engine)
+                                                 engine=self.engine,
+                                                 prefetch_subsets=self.prefetch_subsets,
+                                                 prefetch_bytes=self.prefetch_bytes,
+                                                 branches=self.branches,
+                                                 backend=self.backend,
+                                                 read_executor=self.read_executor,
+                                                 num_read_workers=self.num_read_workers,
+                                                 zero_copy=self.zero_copy,
+                                                 pin_memory=self.pin_memory,
+                                                 pack_momenta=self.pack_momenta,
+                                                 seed=self.seed,
+                                                 state=state,
+                                                 tree_name=self.tree_name,
+                                                 file_weights=file_weights,
+                                                 streaming=self.streaming,
+                                                 refresh_blocks=self.refresh_blocks,
+                                                 memory_budget=self.memory_budget,
+                                                 max_in_flight=self.max_in_flight,
+                                                 selection=self.selection,
+                                                 selection_engine=self.selection_engine,
+                                                 stratify_by=self.stratify_by,
+                                                 channel_proportions=self.channel_proportions,
+                                                 truth_kinematics=self.truth_kinematics)
 
 
     def setup(self, stage: Optional[str] = None) -> None:
@@ -1476,15 +1471,24 @@ class ThreeBodyDecayDataset(LightningDataModule):
         #     'momenta_mother': torch.tensor(momenta_mother)}
         # )
         if not self.use_root_reader:
-            raise NotImplementedError('Adapt code to to use RootTensorDataset')
-            results_dict = self.get_data_simple(self.data_path)
-            full_dataset = DictTensorDataset({k:torch.Tensor(v) for k,v in results_dict.items()})
-            train_size = int(0.8 * len(full_dataset))
-            test_size = len(full_dataset) - train_size
-
-            generator = None if self.split_seed == -1 else torch.Generator().manual_seed(self.split_seed)
-            self.dataset_train, self.dataset_test = torch.utils.data.random_split(full_dataset, [train_size, test_size],
-                                                                    generator=generator)
+            # Everything is read once into contiguous tensors, the loaders only permute and slice them
+            if self.dataset_train is not None:
+                return
+            if type(self.data_path) is dict and 'train' in self.data_path:
+                self.dataset_train = self._read_in_memory(self.data_path['train'])
+                self.dataset_test = self._read_in_memory(self.data_path['validate'])
+            else:
+                full_dataset = self._read_in_memory(self.data_path)
+                full_size = len(next(iter(full_dataset.values())))
+                train_size = int(self.train_test_split * full_size)
+
+                generator = None if self.split_seed == -1 else torch.Generator().manual_seed(self.split_seed)
+                indices = torch.randperm(full_size, generator=generator)
+                self.dataset_train = {k: v.index_select(0, indices[:train_size]) for k, v in full_dataset.items()}
+                self.dataset_test = {k: v.index_select(0, indices[train_size:]) for k, v in full_dataset.items()}
+                del full_dataset
+            print("Loaded %d train and %d validation events into memory" % (
+                len(next(iter(self.dataset_train.values()))), len(next(iter(self.dataset_test.values())))))
         else:
             # self.dataset_train = RootTensorDataset(self.data_path['train'], 'DecayTree', cache_size=-1)
             # self.dataset_test = RootTensorDataset(self.data_path['validate'], 'DecayTree', cache_size=-1)
@@ -1501,15 +1505,23 @@ class ThreeBodyDecayDataset(LightningDataModule):
     def train_dataloader(self):
         print("train_dataloader() getting called!")
 
+        if self._train_loader is None and not self.use_root_reader:
+            self._train_loader = self._get_in_memory_loader(self.dataset_train, self.train_batch_size, shuffle=True,
+                                                            state=self._loader_states.pop('train', None))
         if self._train_loader is None:
-            self._train_loader = self._get_loader(self.data_path['train'], self.train_batch_size)
+            self._train_loader = self._get_loader(self.data_path['train'], self.train_batch_size,
+                                                  state=self._loader_states.pop('train', None))
             self._train_loader.wait_to_load('Reading train data: ')
         # self._train_loader.prepare_next_epoch()
         return self._train_loader
 
     def check_val_loader(self):
+        if self._val_loader is None and not self.use_root_reader:
+            self._val_loader = self._get_in_memory_loader(self.dataset_test, self.val_batch_size, shuffle=False,
+                                                          state=self._loader_states.pop('validate', None))
         if self._val_loader is None:
-            self._val_loader = self._get_loader(self.data_path['validate'], self.val_batch_size)
+            self._val_loader = self._get_loader(self.data_path['validate'], self.val_batch_size,
+                                                state=self._loader_states.pop('validate', None))
             self._val_loader.wait_to_load('Reading val data: ')
 
 
@@ -1526,6 +1538,23 @@ class ThreeBodyDecayDataset(LightningDataModule):
         self.check_val_loader()
         return self._val_loader
 
+    def state_dict(self):
+        state = dict(self._loader_states)
+        if self._train_loader is not None:
+            state['train'] = self._train_loader.state_dict()
+        if self._val_loader is not None:
+            state['validate'] = self._val_loader.state_dict()
+        return state
+
+    def load_state_dict(self, state_dict):
+        for key, loader in [('train', self._train_loader), ('validate', self._val_loader)]:
+            if key not in state_dict:
+                continue
+            if loader is None:
+                self._loader_states[key] = state_dict[key]
+            else:
+                loader.load_state_dict(state_dict[key])
+
     def exit(self):
         if self._train_loader is not None:
             self._train_loader.exit()
@@ -480,7 +480,8 @@ class ThreeBodyDecayPlotter:
 
 	def plot(self, data_samples, file):
 		if type(data_samples) is list:
-			data_samples = tensors_dict_join(data_samples)
+			# Straight into numpy arrays on the cpu, batch by batch
+			data_samples = tensors_dict_join(data_samples, to_numpy=True)
 
 		assert type(data_samples) is dict
 
@@ -558,7 +559,7 @@ def plot_x_y_yerr(ax, data, limits=None, bins=50, label=None, c='tab:blue', mark
 
 def plot_latent_space(samples, path='latent_space_'):
 	if type(samples) is list:
-		samples = tensors_dict_join(samples)
+		samples = tensors_dict_join(samples, to_numpy=True)
 	data_samples_2 = {}
 	for k, v in samples.items():
 		if isinstance(v, torch.Tensor):
@@ -607,7 +608,7 @@ def plot_latent_space(samples, path='latent_space_'):
 
 def plot_summaries(all_results, path=None, only_summary=False, t2='sampled'):
 	if type(all_results) is list:
-		all_results = tensors_dict_join(all_results)
+		all_results = tensors_dict_join(all_results, to_numpy=True)
 	data_samples_2 = {}
 	for k, v in all_results.items():
 		if isinstance(v, torch.Tensor):
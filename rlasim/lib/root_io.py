@@ -0,0 +1,630 @@
+# Reading primitives that only depend on numpy and uproot. They are kept out of data_core so that the worker
+# processes of the process pool reader don't have to import torch or tensorflow.
+import contextlib
+import glob
+import json
+import os
+import re
+from multiprocessing import shared_memory
+
+import numpy as np
+import uproot
+
+
+def resolve_input_files(input_files):
+    """
+    Expands the input of the loaders into a list of files.
+    :param input_files: a path, a glob pattern (e.g. 'data/rs_*_tree2.root') or a list of either
+    :return: List of paths, glob matches are sorted so the order doesn't depend on the file system
+    """
+    if isinstance(input_files, str):
+        input_files = [input_files]
+
+    resolved = []
+    for pattern in input_files:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                raise FileNotFoundError('No files match %s' % pattern)
+            resolved += matches
+        else:
+            resolved.append(pattern)
+    return resolved
+
+
+def downcast_arrays(dict_of_arrays):
+    """
+    Converts 64 bit floats and ints to 32 bit, leaves the rest as they are.
+    """
+    result = {}
+    for k, v in dict_of_arrays.items():
+        if v.dtype == np.float64:
+            result[k] = v.astype(np.float32)
+        elif v.dtype == np.int64:
+            result[k] = v.astype(np.int32)
+        else:
+            result[k] = v
+    return result
+
+
+class EventSelection:
+    """
+    Vectorised per event selection, written with the same {branch} placeholders as the plotter conditions, e.g.
+    '({particle_1_PZ} > 0) & (abs({particle_1_PX}) < 5)'. Evaluated on a dict of arrays it returns a boolean mask.
+
+    :param expression: The selection, the branches it uses are in .branches
+    :param engine: 'numpy' evaluates the expression with np in scope, 'numexpr' with numexpr.evaluate (only the
+                   operators and functions numexpr supports, no np.*), which is faster on large blocks and doesn't
+                   allocate the intermediate arrays
+    """
+    def __init__(self, expression, engine='numpy'):
+        self.expression = expression
+        self.engine = engine
+        self.branches = list(dict.fromkeys(re.findall(r"\{(\w+)\}", expression)))
+
+        if engine == 'numexpr':
+            import numexpr
+            self._numexpr = numexpr
+            self._code = re.sub(r"\{(\w+)\}", r"\1", expression)
+        elif engine == 'numpy':
+            self._code = compile(re.sub(r"\{(\w+)\}", r"data['\1']", expression), '<selection>', 'eval')
+        else:
+            raise ValueError('Unknown selection engine %s, has to be either numpy or numexpr.' % engine)
+
+    def __call__(self, data):
+        if self.engine == 'numexpr':
+            mask = self._numexpr.evaluate(self._code, local_dict={b: data[b] for b in self.branches})
+        else:
+            mask = eval(self._code, {'np': np, 'data': data})
+        mask = np.asarray(mask, dtype=bool)
+        length = len(data[self.branches[0]]) if self.branches else len(next(iter(data.values())))
+        # Selections that don't depend on the event, e.g. 'True'
+        return np.broadcast_to(mask, (length,))
+
+
+def get_columnar_cache_path(root_file):
+    return os.path.splitext(root_file)[0] + '.columnar'
+
+
+def _file_signature(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def convert_root_to_columnar(root_file, output_dir=None, tree_name='DecayTree', branches=None, chunk_size=1000000):
+    """
+    One-time conversion of a tree into a directory with one .npy file per branch. The same 32 bit downcasts as
+    in the ROOT loaders are applied, so reading the cache back gives identical arrays.
+
+    :param root_file: Path of the input root file
+    :param output_dir: Directory to write to, by default next to the root file (see get_columnar_cache_path)
+    :param tree_name: Name of the tree to convert
+    :param branches: Branches to convert, None for all
+    :param chunk_size: Number of entries decompressed at a time
+    :return: Path of the output directory
+    """
+    if output_dir is None:
+        output_dir = get_columnar_cache_path(root_file)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with uproot.open(root_file) as file:
+        tree = file[tree_name]
+        keys = list(tree.keys()) if branches is None else list(branches)
+        num_entries = tree.num_entries
+
+        outputs = None
+        for start in range(0, num_entries, chunk_size):
+            stop = min(start + chunk_size, num_entries)
+            chunk = downcast_arrays(tree.arrays(keys, library='np', entry_start=start, entry_stop=stop))
+            if outputs is None:
+                outputs = {k: np.lib.format.open_memmap(os.path.join(output_dir, k + '.npy'), mode='w+',
+                                                        dtype=v.dtype, shape=(num_entries,) + v.shape[1:])
+                           for k, v in chunk.items()}
+            for k, v in chunk.items():
+                outputs[k][start:stop] = v
+
+        dtypes = {}
+        for k, v in (outputs or {}).items():
+            dtypes[k] = v.dtype.str
+            v.flush()
+        del outputs
+
+    meta = {'tree_name': tree_name, 'keys': keys, 'num_entries': num_entries, 'dtypes': dtypes,
+            'source': _file_signature(root_file)}
+    # Written last, a directory without it is an interrupted conversion
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return output_dir
+
+
+def is_columnar_cache_valid(root_file, output_dir=None):
+    if output_dir is None:
+        output_dir = get_columnar_cache_path(root_file)
+    meta_file = os.path.join(output_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    return meta['source'] == _file_signature(root_file)
+
+
+class ColumnarBranch:
+    def __init__(self, tree, key):
+        self._tree = tree
+        self.name = key
+
+    @property
+    def num_entries(self):
+        return self._tree.num_entries
+
+    def array(self, library='np', entry_start=None, entry_stop=None, **kwargs):
+        return self._tree.arrays([self.name], library=library, entry_start=entry_start,
+                                 entry_stop=entry_stop)[self.name]
+
+
+class ColumnarTree:
+    """
+    Reader for the output of convert_root_to_columnar. It mimics the parts of uproot's TTree interface used by the
+    loaders (keys, num_entries, indexing and arrays) but every branch is a memory mapped .npy file, so reading
+    entries is a slice of the mapped array and nothing is decompressed or copied.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self._meta = json.load(f)
+        self._arrays = {}
+
+    def keys(self):
+        return list(self._meta['keys'])
+
+    @property
+    def num_entries(self):
+        return self._meta['num_entries']
+
+    def _get_array(self, key):
+        if key not in self._arrays:
+            if key not in self._meta['keys']:
+                raise KeyError(key)
+            self._arrays[key] = np.load(os.path.join(self.directory, key + '.npy'), mmap_mode='r')
+        return self._arrays[key]
+
+    def __getitem__(self, key):
+        self._get_array(key)
+        return ColumnarBranch(self, key)
+
+    def arrays(self, expressions=None, library='np', entry_start=None, entry_stop=None, **kwargs):
+        assert library == 'np'
+        keys = self.keys() if expressions is None else expressions
+        return {k: self._get_array(k)[entry_start:entry_stop] for k in keys}
+
+    def close(self):
+        self._arrays = {}
+
+
+def open_tree(file_path, tree_name='DecayTree', backend='uproot'):
+    """
+    :return: (file, tree) where file is what has to be closed once the tree is no longer needed
+    """
+    if backend == 'columnar':
+        tree = ColumnarTree(file_path)
+        return tree, tree
+    file = uproot.open(file_path)
+    return file, file[tree_name]
+
+
+def get_tree_index_path(root_file):
+    return os.path.splitext(root_file)[0] + '.index.json'
+
+
+def build_tree_index(file_path, tree_name='DecayTree'):
+    """
+    Collects the metadata the loaders need from a root file: branch names, number of entries (checked to be the
+    same for every branch), dtypes and, for TTrees, the entry offsets of the baskets of every branch.
+    """
+    with uproot.open(file_path) as file:
+        tree = file[tree_name]
+        keys = list(tree.keys())
+        lens = set()
+        for k in keys:
+            lens = lens.union({tree[k].num_entries})
+        if len(lens) != 1:
+            raise ValueError('The branches of %s in %s have different numbers of entries: %s' %
+                             (tree_name, file_path, sorted(lens)))
+
+        dtypes = {}
+        entry_offsets = None
+        if isinstance(tree, uproot.TTree):
+            entry_offsets = {}
+            for branch in tree.branches:
+                entry_offsets[branch.name] = [int(x) for x in branch.entry_offsets]
+                try:
+                    dtypes[branch.name] = np.dtype(branch.interpretation.numpy_dtype).str
+                except AttributeError:
+                    # Jagged and object branches have no single dtype
+                    pass
+        num_entries = list(lens)[0]
+
+    return {'tree_name': tree_name, 'keys': keys, 'num_entries': num_entries, 'dtypes': dtypes,
+            'entry_offsets': entry_offsets, 'source': _file_signature(file_path)}
+
+
+def load_tree_index(file_path, tree_name='DecayTree', backend='uproot'):
+    """
+    Metadata of a tree (see build_tree_index) from a sidecar index file next to it. The index is built and written
+    on the first call and rebuilt whenever the size or modification time of the file changes, so constructing a
+    loader doesn't open the file and scan every branch again. If the directory is not writable the index is just
+    built every time.
+
+    :param file_path: Path of the root file, or of a directory written by convert_root_to_columnar
+    :param tree_name: Name of the tree
+    :param backend: 'uproot' or 'columnar', the latter already has its metadata in meta.json
+    :return: dict with keys, num_entries, dtypes and entry_offsets (None if the tree doesn't expose baskets)
+    """
+    if backend == 'columnar':
+        with open(os.path.join(file_path, 'meta.json')) as f:
+            meta = json.load(f)
+        return {'tree_name': meta['tree_name'], 'keys': meta['keys'], 'num_entries': meta['num_entries'],
+                'dtypes': meta['dtypes'], 'entry_offsets': None}
+
+    index_path = get_tree_index_path(file_path)
+    indices = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                indices = json.load(f)
+        except (OSError, ValueError):
+            indices = {}
+    index = indices.get(tree_name, None)
+    if index is not None and index['source'] == _file_signature(file_path):
+        return index
+
+    index = build_tree_index(file_path, tree_name)
+    indices[tree_name] = index
+    try:
+        # Written to a temporary file and renamed, so concurrent loaders never see a partial index
+        temp_path = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(indices, f)
+        os.replace(temp_path, index_path)
+    except OSError:
+        pass
+    return index
+
+
+def basket_boundaries_from_index(index, branches=None):
+    """
+    Entries at which any of the (projected) branches starts a new basket, computed from the entry offsets of a tree
+    index. Branches of different types rarely have their baskets aligned, so between two consecutive boundaries every
+    branch stays within a single basket but a boundary is not necessarily one of all the branches.
+    :return: Sorted np.ndarray of entry numbers including 0 and the number of entries or None if the tree doesn't
+             expose basket offsets (for instance RNTuples)
+    """
+    if index['entry_offsets'] is None:
+        return None
+    boundaries = [np.asarray(index['entry_offsets'][branch], dtype=np.int64)
+                  for branch in (index['entry_offsets'].keys() if branches is None else branches)]
+    return np.unique(np.concatenate(boundaries + [np.array([0, index['num_entries']], dtype=np.int64)]))
+
+
+def get_channel_index_path(root_file):
+    return os.path.splitext(root_file)[0] + '.channels.npz'
+
+
+def build_channel_index(file_path, branches, tree_name='DecayTree', backend='uproot', chunk_size=1000000):
+    """
+    Splits the entries of a tree into runs of consecutive entries of the same decay channel, a channel being a
+    distinct combination of values of branches (e.g. mother_PID and particle_*_PID).
+
+    :return: dict with channels ([C, len(branches)] int64, one row per channel) and run_starts, run_stops and
+             run_channels (one per run, the last one indexes channels)
+    """
+    channels = {}
+    run_starts, run_stops, run_channels = [], [], []
+    file, tree = open_tree(file_path, tree_name, backend)
+    try:
+        num_entries = tree.num_entries
+        for start in range(0, num_entries, chunk_size):
+            stop = min(start + chunk_size, num_entries)
+            arrays = tree.arrays(list(branches), library='np', entry_start=start, entry_stop=stop)
+            values = np.stack([np.asarray(arrays[b]) for b in branches], axis=1).astype(np.int64)
+            unique, inverse = np.unique(values, axis=0, return_inverse=True)
+            mapping = np.array([channels.setdefault(tuple(u), len(channels)) for u in unique.tolist()])
+            codes = mapping[inverse.reshape(-1)]
+
+            change = np.flatnonzero(np.diff(codes)) + 1
+            starts = np.concatenate([[0], change]) + start
+            stops = np.concatenate([change, [len(codes)]]) + start
+            ids = codes[starts - start]
+            if len(run_channels) > 0 and run_channels[-1][-1] == ids[0]:
+                # The last run of the previous chunk goes on
+                run_stops[-1][-1] = stops[0]
+                starts, stops, ids = starts[1:], stops[1:], ids[1:]
+            run_starts.append(starts)
+            run_stops.append(stops)
+            run_channels.append(ids)
+    finally:
+        file.close()
+
+    channel_values = sorted(channels, key=channels.get)
+    return {'channels': np.array(channel_values, dtype=np.int64).reshape((len(channel_values), len(branches))),
+            'run_starts': np.concatenate(run_starts).astype(np.int64) if run_starts else np.zeros(0, np.int64),
+            'run_stops': np.concatenate(run_stops).astype(np.int64) if run_stops else np.zeros(0, np.int64),
+            'run_channels': np.concatenate(run_channels).astype(np.int64) if run_channels else np.zeros(0, np.int64)}
+
+
+def load_channel_index(file_path, branches, tree_name='DecayTree', backend='uproot'):
+    """
+    build_channel_index, cached in a sidecar .npz next to root files (see get_channel_index_path) that is rebuilt
+    when the file or the branches change. Columnar directories are memory mapped and cheap to scan, they are not
+    cached.
+    """
+    if backend == 'columnar':
+        return build_channel_index(file_path, branches, tree_name, backend)
+
+    index_path = get_channel_index_path(file_path)
+    key = json.dumps({'tree_name': tree_name, 'branches': list(branches), 'source': _file_signature(file_path)})
+    if os.path.exists(index_path):
+        try:
+            with np.load(index_path) as cached:
+                if str(cached['key']) == key:
+                    return {k: cached[k] for k in ['channels', 'run_starts', 'run_stops', 'run_channels']}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    index = build_channel_index(file_path, branches, tree_name, backend)
+    try:
+        temp_path = '%s.%d.tmp.npz' % (index_path, os.getpid())
+        np.savez(temp_path, key=np.array(key), **index)
+        os.replace(temp_path, index_path)
+    except OSError:
+        pass
+    return index
+
+
+def get_branch_stats_path(root_file):
+    return os.path.splitext(root_file)[0] + '.stats.json'
+
+
+# Quantiles stored by build_branch_stats
+stats_quantiles = [0.001, 0.01, 0.05, 0.5, 0.95, 0.99, 0.999]
+
+# The quantiles come from a histogram of the float32 values with one bin per sign, exponent and top 7 bits of the
+# mantissa, i.e. bins 2^-7 wide relative to their value. It is filled in one pass without knowing the range first,
+# never has more than 65536 bins and the histograms of several files simply add up.
+_sketch_shift = 23 - 7
+
+
+def _sketch_bins(values):
+    # float32 bit patterns as int32, with the magnitude bits of negative numbers flipped so that they are ordered like
+    # the values, then the low mantissa bits dropped
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.int32)
+    return (bits ^ ((bits >> 31) & np.int32(0x7fffffff))) >> _sketch_shift
+
+
+def _sketch_bin_centers(bins):
+    bits = (np.asarray(bins, dtype=np.int32) << _sketch_shift) + np.int32(1 << (_sketch_shift - 1))
+    return (bits ^ ((bits >> 31) & np.int32(0x7fffffff))).view(np.float32).astype(np.float64)
+
+
+def _add_to_sketch(sketch, bins, counts):
+    bins, inverse = np.unique(np.concatenate([sketch[0], bins]).astype(np.int32), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([sketch[1], counts])).astype(np.int64)
+    return bins, counts
+
+
+def sketch_quantiles(sketch, quantiles, min_value=-np.inf, max_value=np.inf):
+    """
+    Quantiles from the histogram of build_branch_stats, accurate to about 0.4% of their value.
+    :param sketch: (bins, counts)
+    :return: dict from str(quantile) to value, NaN if the histogram is empty
+    """
+    bins, counts = np.asarray(sketch[0], dtype=np.int32), np.asarray(sketch[1], dtype=np.int64)
+    if counts.sum() == 0:
+        return {str(q): float('nan') for q in quantiles}
+    cumulative = np.cumsum(counts)
+    indices = np.minimum(np.searchsorted(cumulative, np.asarray(quantiles) * cumulative[-1], side='left'),
+                         len(bins) - 1)
+    values = np.clip(_sketch_bin_centers(bins[indices]), min_value, max_value)
+    return {str(q): float(v) for q, v in zip(quantiles, values)}
+
+
+def build_branch_stats(file_path, branches, tree_name='DecayTree', backend='uproot', chunk_size=1000000,
+                       selection=None, selection_engine='numpy'):
+    """
+    Statistics of branches over a whole tree in a single pass of chunk_size entries at a time: exact min, max, mean
+    and std of the finite values (NaNs and infs are skipped) and their stats_quantiles (see sketch_quantiles). The
+    branches are downcast like the loaders do, so that the stats are those of the values the models see.
+
+    :param selection: only the events passing this EventSelection expression are counted, None for all of them
+    :return: dict with num_entries (the number of events counted) and, per branch, min, max, mean, std, count (the
+             number of finite values), quantiles (dict from quantile to value) and sketch (the histogram the
+             quantiles come from, for combine_branch_stats)
+    """
+    branches = list(branches)
+    event_selection = EventSelection(selection, engine=selection_engine) if selection is not None else None
+    read_branches = branches if event_selection is None else \
+        branches + [b for b in event_selection.branches if b not in branches]
+    totals = {b: {'min': np.inf, 'max': -np.inf, 'sum': 0., 'sum_squares': 0., 'count': 0} for b in branches}
+    sketches = {b: (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)) for b in branches}
+    num_entries = 0
+    file, tree = open_tree(file_path, tree_name, backend)
+    try:
+        for start in range(0, tree.num_entries, chunk_size):
+            stop = min(start + chunk_size, tree.num_entries)
+            arrays = downcast_arrays(tree.arrays(read_branches, library='np', entry_start=start, entry_stop=stop))
+            if event_selection is not None:
+                mask = event_selection(arrays)
+                arrays = {b: arrays[b][mask] for b in branches}
+            num_entries += len(arrays[branches[0]]) if len(branches) > 0 else 0
+            for b in branches:
+                # A single NaN would otherwise become the min and max of the branch
+                finite = arrays[b][np.isfinite(arrays[b])]
+                if len(finite) == 0:
+                    continue
+                totals[b]['min'] = min(totals[b]['min'], float(np.min(finite)))
+                totals[b]['max'] = max(totals[b]['max'], float(np.max(finite)))
+                finite = finite.astype(np.float64)
+                totals[b]['sum'] += float(np.sum(finite))
+                totals[b]['sum_squares'] += float(np.sum(finite ** 2))
+                totals[b]['count'] += len(finite)
+                bins, counts = np.unique(_sketch_bins(finite), return_counts=True)
+                sketches[b] = _add_to_sketch(sketches[b], bins, counts)
+    finally:
+        file.close()
+
+    stats = {'num_entries': num_entries, 'branches': {}}
+    for b in branches:
+        count = totals[b]['count']
+        mean = totals[b]['sum'] / max(count, 1)
+        variance = max(totals[b]['sum_squares'] / max(count, 1) - mean ** 2, 0.)
+        stats['branches'][b] = {'min': totals[b]['min'], 'max': totals[b]['max'], 'mean': mean,
+                                'std': float(np.sqrt(variance)), 'count': count,
+                                'quantiles': sketch_quantiles(sketches[b], stats_quantiles, totals[b]['min'],
+                                                              totals[b]['max']),
+                                'sketch': [sketches[b][0].tolist(), sketches[b][1].tolist()]}
+    return stats
+
+
+def load_branch_stats(file_path, branches, tree_name='DecayTree', backend='uproot', selection=None,
+                      selection_engine='numpy'):
+    """
+    build_branch_stats, cached in a sidecar .stats.json next to the file (see get_branch_stats_path) that is rebuilt
+    when the size or modification time of the file changes. Branches missing from the sidecar are computed and
+    added to it. Columnar directories are keyed by their meta.json. Every selection expression has its own entry in
+    the sidecar.
+    """
+    if backend == 'columnar':
+        stats_path = os.path.join(file_path, 'stats.json')
+        source = _file_signature(os.path.join(file_path, 'meta.json'))
+    else:
+        stats_path = get_branch_stats_path(file_path)
+        source = _file_signature(file_path)
+
+    all_stats = {}
+    if os.path.exists(stats_path):
+        try:
+            with open(stats_path) as f:
+                all_stats = json.load(f)
+        except (OSError, ValueError):
+            all_stats = {}
+    key = tree_name if selection is None else '%s [%s]' % (tree_name, selection)
+    cached = all_stats.get(key, None)
+    if cached is None or cached['source'] != source:
+        cached = {'source': source, 'num_entries': None, 'branches': {}}
+    # Stats without a sketch were written before the values were downcast and non-finite values were skipped
+    missing = [b for b in branches if 'sketch' not in cached['branches'].get(b, {})]
+    if len(missing) > 0:
+        stats = build_branch_stats(file_path, missing, tree_name, backend, selection=selection,
+                                   selection_engine=selection_engine)
+        cached['num_entries'] = stats['num_entries']
+        cached['branches'].update(stats['branches'])
+        all_stats[key] = cached
+        try:
+            temp_path = '%s.%d.tmp' % (stats_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(all_stats, f)
+            os.replace(temp_path, stats_path)
+        except OSError:
+            pass
+
+    return {'num_entries': cached['num_entries'], 'branches': {b: cached['branches'][b] for b in branches}}
+
+
+def combine_branch_stats(stats_list):
+    """
+    Stats of several files as if they were one, min, max, mean and std are exact and the quantiles come from the
+    summed histograms.
+    """
+    if len(stats_list) == 1:
+        return stats_list[0]
+    num_entries = sum(s['num_entries'] for s in stats_list)
+    combined = {'num_entries': num_entries, 'branches': {}}
+    for b in stats_list[0]['branches']:
+        count = sum(s['branches'][b]['count'] for s in stats_list)
+        per_file = [(s['branches'][b]['count'] / max(count, 1), s['branches'][b]) for s in stats_list]
+        mean = sum(w * x['mean'] for w, x in per_file)
+        second_moment = sum(w * (x['std'] ** 2 + x['mean'] ** 2) for w, x in per_file)
+        sketch = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64))
+        for _, x in per_file:
+            sketch = _add_to_sketch(sketch, x['sketch'][0], x['sketch'][1])
+        min_value = min(x['min'] for _, x in per_file)
+        max_value = max(x['max'] for _, x in per_file)
+        combined['branches'][b] = {
+            'min': min_value,
+            'max': max_value,
+            'mean': mean,
+            'std': float(np.sqrt(max(second_moment - mean ** 2, 0.))),
+            'count': count,
+            'quantiles': sketch_quantiles(sketch, stats_quantiles, min_value, max_value),
+            'sketch': [sketch[0].tolist(), sketch[1].tolist()],
+        }
+    return combined
+
+
+# Trees opened by a worker process, kept for the lifetime of the worker
+_worker_trees = {}
+
+
+def read_range_to_shared_memory(file_path, tree_name, backend, branches, start, stop):
+    """
+    Runs in a worker process. Reads (and downcasts) a range of entries and writes all the arrays into a single
+    new shared memory segment so that only the layout has to be sent back to the parent, not the arrays.
+
+    :return: Name of the shared memory segment and a list of (key, dtype, shape, offset)
+    """
+    key = (file_path, tree_name, backend)
+    if key not in _worker_trees:
+        _worker_trees[key] = open_tree(file_path, tree_name, backend)
+    tree = _worker_trees[key][1]
+
+    arrays = downcast_arrays(tree.arrays(branches, library='np', entry_start=start, entry_stop=stop,
+                                         array_cache=None))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(int(v.nbytes) for v in arrays.values())))
+    layout = []
+    offset = 0
+    for k, v in arrays.items():
+        destination = np.ndarray(v.shape, dtype=v.dtype, buffer=shm.buf, offset=offset)
+        destination[...] = v
+        del destination
+        layout.append((k, v.dtype.str, v.shape, offset))
+        offset += int(v.nbytes)
+    name = shm.name
+    shm.close()
+    return name, layout
+
+
+@contextlib.contextmanager
+def shared_memory_arrays(name, layout):
+    """
+    Counterpart of read_range_to_shared_memory in the parent process. Yields the arrays as views of the segment,
+    without copying them, and frees the segment on exit. The views must not be used after that, copy whatever has
+    to outlive the with block.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    try:
+        for k, dtype, shape, offset in layout:
+            arrays[k] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        yield arrays
+    finally:
+        arrays.clear()
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # Views are still referenced, e.g. by the traceback of an exception, the mapping goes with them
+            pass
+
+
+def discard_shared_memory_future(future):
+    """
+    Done callback for a read_range_to_shared_memory future whose result is no longer needed, frees the segment.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    name, _ = future.result()
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
@@ -1,6 +1,8 @@
 import math
 import os
 import shutil
+import subprocess
+import sys
 import time
 import unittest
 import uuid
@@ -16,7 +18,13 @@ from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 import threading
 
-from rlasim.lib.data_core import tensors_dict_join, RootBlockShuffledSubsetDataset, RootBlockShuffledSubsetDataLoader
+from rlasim.lib.data_core import tensors_dict_join, RootBlockShuffledSubsetDataset, RootBlockShuffledSubsetDataLoader, \
+    SubsetPrefetchQueue, plan_block_reads, convert_root_to_columnar, ColumnarTree, packed_feature_branches, \
+    DictArrayAssembler, load_tree_index, get_tree_index_path, InMemoryDataLoader, read_dict_tensors, \
+    DictTensorDataset, RootTensorDataset, nbe_default_collate, load_branch_stats, get_branch_stats_path, \
+    basket_boundaries_from_index, combine_branch_stats
+from rlasim.lib.kinematics import three_body_kinematics, sample_kinematics, rotation_matrices, align_to_axis, \
+    boost_to_rest_frame, invariant_mass
 from queue import Queue
 from torch.utils.data._utils.collate import default_collate
 
@@ -141,6 +149,682 @@ class TestSubetDataLoader(unittest.TestCase):
 
 
 
+    def test_SubsetPrefetchQueue(self):
+        queue = SubsetPrefetchQueue(max_subsets=2)
+        subset = {'first': np.arange(10)}
+        assert queue.put(subset)
+        assert queue.put(subset)
+        assert queue.qsize() == 2
+        assert queue.nbytes() == 2 * subset['first'].nbytes
+
+        def consume():
+            time.sleep(0.2)
+            queue.get()
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        # Has to block until the consumer makes room
+        assert queue.put(subset)
+        consumer.join()
+        assert queue.get_wait_stats()['producer_wait_time'] > 0.1
+
+        queue.get()
+        queue.get()
+        closer = threading.Timer(0.2, queue.close)
+        closer.start()
+        # Has to block until closed and then return None
+        assert queue.get() is None
+        assert queue.get_wait_stats()['consumer_wait_time'] > 0.1
+        assert not queue.put(subset)
+
+    def test_PrefetchBytes(self):
+        self._my_setup(total_length=20000)
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=1000, num_blocks=2, prefetch_bytes=1)
+
+        # With one byte of budget, only a single subset can ever wait in the queue
+        dataset.get_no_masking(0)
+        time.sleep(0.5)
+        assert dataset.sampled_subsets_queue.qsize() == 1
+        dataset.exit()
+
+        self._my_cleanup()
+
+    def test_RequiredBranches(self):
+        # Importing organise_data after the loaders crashes in the same process, so it runs in its own
+        code = '\n'.join([
+            'from rlasim.lib.organise_data import get_required_branches',
+            "config = {'data_params': {}, 'model_params': {'data_feats': {'momenta_pp': 9}},",
+            "          'plotter': {'conditions': [['{mother_TRUEID} == 411', 'D+'], '{nEvent} % 2 == 0']}}",
+            'print(get_required_branches(config))',
+        ])
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        branches = eval(output.strip().splitlines()[-1])
+        assert 'mother_TRUEID' in branches
+        assert 'nEvent' in branches
+
+    def test_BranchProjection(self):
+        self._my_setup(total_length=20000)
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=1000, num_blocks=5, batch_size=10,
+                                                       branches=['second'])
+        for x in dataloader:
+            assert list(x.keys()) == ['second']
+        dataloader.exit()
+
+        with self.assertRaises(ValueError):
+            RootBlockShuffledSubsetDataset(self.test_file, block_size=1000, num_blocks=5, branches=['third'])
+
+        self._my_cleanup()
+
+    def test_PlanBlockReads(self):
+        # Adjacent blocks are merged, the last block is clipped
+        reads = plan_block_reads([3, 1, 2, 9], block_size=10, length=95)
+        assert [(r[0], r[1]) for r in reads] == [(10, 40), (90, 95)]
+        assert reads[0][2] == [(10, 20), (20, 30), (30, 40)]
+
+        # Blocks 1 and 4 share the basket [0, 50), block 6 starts a new one
+        reads = plan_block_reads([1, 4, 6], block_size=10, length=100, basket_boundaries=np.array([0, 50, 100]))
+        assert [(r[0], r[1]) for r in reads] == [(10, 50), (60, 70)]
+        assert reads[0][2] == [(10, 20), (40, 50)]
+
+        # Reads are split once they get too long, also within a basket
+        reads = plan_block_reads([0, 1, 2, 3], block_size=10, length=100, max_read_size=20)
+        assert [(r[0], r[1]) for r in reads] == [(0, 20), (20, 40)]
+        reads = plan_block_reads([0, 1, 2, 3], block_size=10, length=100, max_read_size=20,
+                                 basket_boundaries=np.array([0, 30, 100]))
+        assert [(r[0], r[1]) for r in reads] == [(0, 20), (20, 40)]
+        reads = plan_block_reads([0, 9], block_size=10, length=100, max_read_size=20,
+                                 basket_boundaries=np.array([0, 100]))
+        assert [(r[0], r[1]) for r in reads] == [(0, 10), (90, 100)]
+
+        # Misaligned baskets, no entry but 0 and 100 starts a basket of both branches. Only gaps within a basket of
+        # every branch are merged, not everything in between.
+        index = {'num_entries': 100, 'entry_offsets': {'a': [0, 25, 50, 75, 100], 'b': [0, 40, 80, 100]}}
+        boundaries = basket_boundaries_from_index(index)
+        assert np.all(boundaries == [0, 25, 40, 50, 75, 80, 100])
+        reads = plan_block_reads([0, 1, 3, 6, 8], block_size=5, length=100, basket_boundaries=boundaries)
+        assert [(r[0], r[1]) for r in reads] == [(0, 20), (30, 35), (40, 45)]
+
+    def test_ColumnarBackend(self):
+        self._my_setup(total_length=20000)
+
+        columnar_dir = convert_root_to_columnar(self.test_file, chunk_size=3000)
+        tree = ColumnarTree(columnar_dir)
+        assert tree.num_entries == self.total_length
+        assert tree.arrays(['first'], entry_start=10, entry_stop=20)['first'].dtype == np.int32
+        assert np.all(tree.arrays(['first'], entry_start=10, entry_stop=20)['first'] == np.arange(10, 20))
+
+        block_size = 1000
+        num_blocks = 5
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                 backend='columnar')
+        collected = []
+        for i in range(self.total_length // (block_size * num_blocks)):
+            for j, x in enumerate(dataset):
+                collected += [x['first']]
+            dataset.prepare_next_epoch()
+
+        assert len(np.unique(collected)) == self.total_length
+        dataset.exit()
+
+        self._my_cleanup()
+
+    def test_ProcessReadExecutor(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 1000
+        num_blocks = 5
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                 read_executor='process', num_read_workers=2)
+        collected = []
+        for i in range(self.total_length // (block_size * num_blocks)):
+            for j, x in enumerate(dataset):
+                collected += [x['first']]
+            dataset.prepare_next_epoch()
+
+        assert len(np.unique(collected)) == self.total_length
+        dataset.exit()
+
+        self._my_cleanup()
+
+    def test_AsyncReadExecutor(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 100
+        num_blocks = 50
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                 read_executor='async', max_in_flight=4, max_read_blocks=1)
+        collected = []
+        for i in range(self.total_length // (block_size * num_blocks)):
+            collected += list(dataset.get_subset()['first'])
+            dataset.prepare_next_epoch()
+        assert len(np.unique(collected)) == self.total_length
+
+        # Cancels the reads of the subsets being prefetched
+        dataset.exit()
+        assert not dataset.reading_thread_main.is_alive()
+
+        self._my_cleanup()
+
+    def test_FastExit(self):
+        self._my_setup(total_length=20000)
+
+        class SlowDataset(RootBlockShuffledSubsetDataset):
+            def read_root_file(self, *args):
+                time.sleep(0.5)
+                return super().read_root_file(*args)
+
+        for read_executor in ['thread', 'async']:
+            # A subset takes ~5 s to read, exit() comes in the middle of it
+            dataset = SlowDataset(self.test_file, block_size=100, num_blocks=40, max_read_blocks=1,
+                                  read_executor=read_executor, max_in_flight=4)
+            time.sleep(1.)
+            t1 = time.time()
+            dataset.exit()
+            assert time.time() - t1 < 1.
+            assert not dataset.reading_thread_main.is_alive()
+            assert dataset.get_memory_usage()['total'] == 0
+
+        self._my_cleanup()
+
+    def test_FailedRead(self):
+        self._my_setup(total_length=20000)
+
+        class FailingDataset(RootBlockShuffledSubsetDataset):
+            def read_root_file(self, file_path, tree_name, start_index, end_index):
+                if start_index >= 10000:
+                    raise OSError('Broken basket')
+                return super().read_root_file(file_path, tree_name, start_index, end_index)
+
+        for read_executor in ['thread', 'async']:
+            # Half of the blocks can't be read, one of the first subsets has one of them
+            dataset = FailingDataset(self.test_file, block_size=1000, num_blocks=5, max_read_blocks=1,
+                                     read_executor=read_executor)
+            with self.assertRaises(RuntimeError) as context:
+                for i in range(4):
+                    # Only ever complete subsets of readable blocks
+                    assert np.all(dataset.get_subset()['first'] < 10000)
+                    dataset.prepare_next_epoch()
+            assert isinstance(context.exception.__cause__, OSError)
+            dataset.reading_thread_main.join(timeout=5.)
+            assert not dataset.reading_thread_main.is_alive()
+            dataset.exit()
+
+        self._my_cleanup()
+
+    def test_Selection(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 1000
+        num_blocks = 5
+        for engine in ['numpy', 'numexpr']:
+            dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                     branches=['first'], selection='({second} % 4) == 0',
+                                                     selection_engine=engine, seed=1)
+            collected = []
+            for i in range(self.total_length // (block_size * num_blocks)):
+                subset = dataset.get_subset()
+                assert dataset.get_subset_length() == 1250
+                collected += list(subset['first'])
+                dataset.prepare_next_epoch()
+            # The branches of the selection are read too
+            assert set(subset.keys()) == {'first', 'second'}
+            assert np.all(np.sort(collected) == np.arange(0, self.total_length, 4))
+            assert dataset.get_selection_stats()['efficiency'] == 0.25
+            dataset.exit()
+
+        self._my_cleanup()
+
+    def test_StratifiedChannels(self):
+        self._my_setup(total_length=20000)
+        # Channels in runs of 700 entries, channel 0 has as many entries as 1 and 2
+        test_file = os.path.join('temp_files', 'channels.root')
+        file2 = uproot.recreate(test_file)
+        file2['DecayTree'] = {'first': np.arange(21000), 'chan': (np.arange(21000) // 700) % 3}
+        file2.close()
+
+        dataset = RootBlockShuffledSubsetDataset(test_file, block_size=500, num_blocks=8, stratify_by=['chan'],
+                                                 channel_proportions={'0': 2., '1': 1., '2': 1.}, seed=3)
+        collected = []
+        for i in range(3):
+            subset = dataset.get_subset()
+            assert dataset.get_channel_stats() == {'0': 2000, '1': 1000, '2': 1000}
+            assert np.all(np.bincount(subset['chan']) == [2000, 1000, 1000])
+            assert np.all(subset['chan'] == (subset['first'] // 700) % 3)
+            collected += list(subset['first'][subset['chan'] == 0])
+            dataset.prepare_next_epoch()
+        dataset.exit()
+        # 6000 of the 7000 rows of channel 0, each at most once
+        assert len(np.unique(collected)) == 6000
+
+        # Channels alternating every row, every chunk is a single row. They are read in a few reads spanning many
+        # chunks and gathered by index, with and without a selection.
+        test_file = os.path.join('temp_files', 'interleaved.root')
+        file2 = uproot.recreate(test_file)
+        file2['DecayTree'] = {'first': np.arange(20000), 'chan': np.arange(20000) % 2}
+        file2.close()
+
+        class CountingDataset(RootBlockShuffledSubsetDataset):
+            num_reads = 0
+
+            def read_root_file(self, *args):
+                CountingDataset.num_reads += 1
+                return super().read_root_file(*args)
+
+        for selection in [None, '({first} % 4) != 0']:
+            CountingDataset.num_reads = 0
+            dataset = CountingDataset(test_file, block_size=500, num_blocks=8, stratify_by=['chan'],
+                                      channel_proportions={'0': 3., '1': 1.}, selection=selection, seed=3)
+            subset = dataset.get_subset()
+            assert dataset.get_channel_stats() == {'0': 3000, '1': 1000}
+            assert np.all(subset['chan'] == subset['first'] % 2)
+            assert len(np.unique(subset['first'])) == len(subset['first'])
+            if selection is None:
+                assert np.all(np.bincount(subset['chan']) == [3000, 1000])
+            else:
+                assert np.all(subset['first'] % 4 != 0)
+                assert np.sum(subset['chan'] == 1) == 1000
+            dataset.exit()
+            assert CountingDataset.num_reads < 100
+
+        self._my_cleanup()
+
+    def test_InMemoryDataLoader(self):
+        self._my_setup(total_length=20000)
+
+        tensors = read_dict_tensors(self.test_file, selection='{first} % 2 == 0')
+        assert tensors['first'].dtype == torch.int32 and len(tensors['first']) == 10000
+
+        loader = InMemoryDataLoader(tensors, batch_size=1000, seed=5)
+        epochs = []
+        for i in range(2):
+            batches = list(loader)
+            assert len(batches) == 10
+            assert torch.equal(batches[0]['first'], batches[0]['second'])
+            epochs.append(torch.cat([b['first'] for b in batches]))
+            # Every event once per epoch
+            assert len(torch.unique(epochs[-1])) == 10000
+        assert not torch.equal(epochs[0], epochs[1])
+
+        # A loader restored from the state continues with the same order
+        state = loader.state_dict()
+        loader2 = InMemoryDataLoader(tensors, batch_size=1000)
+        loader2.load_state_dict(state)
+        assert torch.equal(next(iter(loader))['first'], next(iter(loader2))['first'])
+
+        self._my_cleanup()
+
+    def test_BatchedGetItems(self):
+        self._my_setup(total_length=20000)
+
+        tensors = read_dict_tensors(self.test_file)
+        # Cache smaller than the file, shuffled batches span several cache windows
+        for dataset in [DictTensorDataset(tensors), RootTensorDataset(self.test_file, 'DecayTree', cache_size=3000)]:
+            loader = DataLoader(dataset, batch_size=1000, shuffle=True, collate_fn=nbe_default_collate)
+            collected = []
+            for batch in loader:
+                assert batch['first'].shape == (1000,)
+                assert torch.equal(batch['first'], batch['second'])
+                collected.append(batch['first'])
+            assert len(torch.unique(torch.cat(collected))) == 20000
+
+            batch = nbe_default_collate(dataset.__getitems__(list(range(500, 600))))
+            assert torch.equal(batch['first'], torch.arange(500, 600, dtype=batch['first'].dtype))
+
+        self._my_cleanup()
+
+    def test_ThreeBodyKinematics(self):
+        # Back to back particles 1 and 2 and particle 3 at rest: the parent mass is the sum of the energies
+        momenta = torch.tensor([[[3., 0., 4.], [-3., 0., -4.], [0., 0., 0.]]])
+        masses = torch.tensor([[0., 12., 1.]])
+        result = three_body_kinematics(momenta, masses)
+        assert torch.allclose(result['energies'], torch.tensor([[5., 13., 1.]]))
+        assert torch.allclose(result['parent_mass'], torch.tensor([19.]))
+        # m13^2 = (5 + 1)^2 - 25
+        assert torch.allclose(result['mass_13'], torch.tensor([math.sqrt(11.)]))
+
+        result_np = three_body_kinematics(momenta.numpy(), masses.numpy(), squared=True, _engine='np')
+        assert np.allclose(result_np['mass_32'], (13. + 1.) ** 2 - 25.)
+
+    def test_AlignToAxis(self):
+        rng = np.random.default_rng(0)
+        reference = rng.normal(size=(1000, 3))
+        matrices = rotation_matrices(reference, [0., 0., 1.])
+        # Proper rotations, no reflections
+        assert np.allclose(np.einsum('nij,nkj->nik', matrices, matrices), np.eye(3))
+        assert np.allclose(np.linalg.det(matrices), 1.)
+
+        vectors = np.concatenate([reference[:, np.newaxis], rng.normal(size=(1000, 2, 3))], axis=1)
+        rotated = align_to_axis(vectors, reference, chunk_size=300)
+        assert np.allclose(rotated[:, 0, :2], 0.) and np.allclose(rotated[:, 0, 2], np.linalg.norm(reference, axis=1))
+        assert np.allclose(np.linalg.norm(rotated, axis=2), np.linalg.norm(vectors, axis=2))
+        assert np.array_equal(rotated, align_to_axis(vectors, reference))
+
+    def test_BoostToRestFrame(self):
+        import vector
+        rng = np.random.default_rng(0)
+        momenta = rng.normal(size=(1000, 3, 3)) + [0., 0., 5.]
+        energies = np.sqrt(rng.uniform(0.1, 1., size=(1000, 3)) ** 2 + np.sum(momenta ** 2, axis=-1))
+        parent_momenta, parent_energies = momenta.sum(axis=1), energies.sum(axis=1)
+
+        boosted, boosted_energies = boost_to_rest_frame(momenta, energies, parent_momenta[:, np.newaxis],
+                                                        parent_energies[:, np.newaxis])
+        parent = vector.array({'px': parent_momenta[:, 0], 'py': parent_momenta[:, 1], 'pz': parent_momenta[:, 2],
+                               'E': parent_energies})
+        first = vector.array({'px': momenta[:, 0, 0], 'py': momenta[:, 0, 1], 'pz': momenta[:, 0, 2],
+                              'E': energies[:, 0]}).boostCM_of(parent)
+        assert np.allclose(boosted[:, 0, 0], first.px) and np.allclose(boosted_energies[:, 0], first.E)
+        # Back to back in the rest frame, masses unchanged
+        assert np.allclose(boosted.sum(axis=1), 0.)
+        assert np.allclose(invariant_mass(boosted, boosted_energies), invariant_mass(momenta, energies))
+
+    def test_PreprocessingStats(self):
+        self._my_setup(total_length=20000)
+        test_file = os.path.join('temp_files', 'momenta.root')
+        rng = np.random.default_rng(0)
+        data = {b: rng.normal(size=30000) * 3 + 10 for b in packed_feature_branches['momenta'] +
+                packed_feature_branches['momenta_mother']}
+        # Non-finite values are skipped, not propagated into the limits
+        data['particle_1_PX'][[5, 20000]] = [np.nan, np.inf]
+        finite = np.isfinite(data['particle_1_PX'])
+        file2 = uproot.recreate(test_file)
+        file2['DecayTree'] = data
+        file2.close()
+
+        stats = load_branch_stats(test_file, ['particle_1_PX'])
+        assert os.path.exists(get_branch_stats_path(test_file))
+        assert stats['num_entries'] == 30000
+        assert np.isclose(stats['branches']['particle_1_PX']['min'], data['particle_1_PX'][finite].min())
+        assert np.isclose(stats['branches']['particle_1_PX']['max'], data['particle_1_PX'][finite].max())
+        assert stats['branches']['particle_1_PX']['count'] == 29998
+        assert abs(stats['branches']['particle_1_PX']['mean'] - 10.) < 0.1
+        # Over the float32 values the loader feeds
+        float32_min = float(np.min(data['particle_1_PX'][finite].astype(np.float32)))
+        assert stats['branches']['particle_1_PX']['min'] == float32_min
+        quantiles = stats['branches']['particle_1_PX']['quantiles']
+        for q in ['0.01', '0.5', '0.99']:
+            assert abs(quantiles[q] - np.quantile(data['particle_1_PX'][finite], float(q))) < 0.01 * quantiles[q]
+
+        # Cached, a second call doesn't read the file
+        os.utime(get_branch_stats_path(test_file), None)
+        t1 = time.time()
+        assert load_branch_stats(test_file, ['particle_1_PX']) == stats
+        assert time.time() - t1 < 0.1
+
+        # Over the events the loader would keep, cached separately from the stats of all of them
+        selection = '{particle_1_PY} > 10'
+        selected = load_branch_stats(test_file, ['particle_1_PX'], selection=selection)
+        mask = data['particle_1_PY'] > 10
+        assert selected['num_entries'] == np.count_nonzero(mask)
+        assert np.isclose(selected['branches']['particle_1_PX']['max'], data['particle_1_PX'][mask & finite].max())
+        assert load_branch_stats(test_file, ['particle_1_PX']) == stats
+
+        # The histograms of the files add up, a file and the other events are the same as all of them
+        rejected = load_branch_stats(test_file, ['particle_1_PX'], selection='{particle_1_PY} <= 10')
+        combined = combine_branch_stats([selected, rejected])
+        assert combined['num_entries'] == 30000
+        assert combined['branches']['particle_1_PX']['quantiles'] == stats['branches']['particle_1_PX']['quantiles']
+
+        self._my_cleanup()
+
+    def test_TruthKinematics(self):
+        self._my_setup(total_length=20000)
+        test_file = os.path.join('temp_files', 'particles.root')
+        rng = np.random.default_rng(0)
+        data = {'particle_%d_%s' % (i, c): rng.normal(size=5000) for i in [1, 2, 3] for c in ['PX', 'PY', 'PZ', 'M']}
+        file2 = uproot.recreate(test_file)
+        file2['DecayTree'] = data
+        file2.close()
+
+        loader = RootBlockShuffledSubsetDataLoader(test_file, block_size=500, num_blocks=4, batch_size=500,
+                                                   truth_kinematics=True, seed=1)
+        for batch in loader:
+            # What the losses would otherwise compute on every step
+            expected = sample_kinematics(batch, '')
+            for k in ['mass_13', 'mass_32', 'parent_mass']:
+                assert torch.allclose(batch[k], expected[k], equal_nan=True)
+        loader.exit()
+
+        self._my_cleanup()
+
+    def test_ZeroCopyBatches(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 1000
+        num_blocks = 5
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                       batch_size=100, zero_copy=True)
+
+        collected = []
+        copies = []
+        for i in range(self.total_length // (block_size * num_blocks)):
+            subset = dataloader._dataset.get_subset()
+            for j, x in enumerate(dataloader):
+                # The batches are views of the subset, not copies
+                assert np.shares_memory(x['first'].numpy(), subset['first'])
+                collected += [x['first']]
+                copies += [x['first'].clone()]
+            dataloader.prepare_next_epoch()
+
+        collected_copy = torch.cat(copies, dim=0)
+        # The batches are still views of the subsets, which were not released and so never assembled into again
+        assert torch.equal(torch.cat(collected, dim=0), collected_copy)
+        assert len(np.unique(collected_copy)) == self.total_length
+        dataloader.exit()
+
+        self._my_cleanup()
+
+    def test_PackMomenta(self):
+        total_length = 20000
+        data = {b: np.random.normal(size=total_length).astype(np.float32)
+                for branches in packed_feature_branches.values() for b in branches}
+        self.test_file = os.path.join('temp_files', str(uuid.uuid4()) + '.root')
+        os.system('mkdir -p temp_files')
+        with uproot.recreate(self.test_file) as file2:
+            file2['DecayTree'] = data
+
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=1000, num_blocks=5, batch_size=100,
+                                                       pack_momenta=True)
+        for x in dataloader:
+            assert x['momenta'].shape == (100, 3, 3)
+            assert x['momenta_mother'].shape == (100, 1, 3)
+            # The packed arrays are shuffled together with the branches they come from
+            assert torch.all(x['momenta'][:, 1, 2] == x['particle_2_PZ'])
+            assert torch.all(x['momenta_mother'][:, 0, 0] == x['mother_PX_TRUE'])
+        dataloader.exit()
+
+        self._my_cleanup()
+
+    def test_ResumableOrder(self):
+        self._my_setup(total_length=20000)
+
+        def read_subset(dataloader):
+            subset = torch.cat([x['first'] for x in dataloader], dim=0)
+            dataloader.prepare_next_epoch()
+            return subset
+
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=1000, num_blocks=3, batch_size=100,
+                                                       seed=5)
+        first = read_subset(dataloader)
+        read_subset(dataloader)
+        state = dataloader.state_dict()
+        expected = [read_subset(dataloader) for _ in range(4)]
+        dataloader.exit()
+
+        # Same seed, same sequence
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=1000, num_blocks=3, batch_size=100,
+                                                       seed=5)
+        assert torch.equal(read_subset(dataloader), first)
+
+        # Loading the state drops the prefetched subsets and continues from the cursor
+        dataloader.load_state_dict(state)
+        for subset in expected:
+            assert torch.equal(read_subset(dataloader), subset)
+        dataloader.exit()
+
+        # Also from a fresh loader, without any seed
+        dataloader = RootBlockShuffledSubsetDataLoader(self.test_file, block_size=1000, num_blocks=3, batch_size=100,
+                                                       state=state)
+        for subset in expected:
+            assert torch.equal(read_subset(dataloader), subset)
+        dataloader.exit()
+
+        self._my_cleanup()
+
+    def test_MultipleFiles(self):
+        os.system('mkdir -p temp_files')
+        prefix = os.path.join('temp_files', str(uuid.uuid4()))
+        # Lengths that aren't multiples of the block size, the tails are never sampled
+        lengths = [5500, 3200, 7000]
+        offset = 0
+        for i, length in enumerate(lengths):
+            with uproot.recreate('%s_%d.root' % (prefix, i)) as file2:
+                file2['DecayTree'] = {'first': np.arange(offset, offset + length), 'second': np.arange(length)}
+            offset += length
+
+        block_size = 1000
+        num_blocks = 3
+        dataset = RootBlockShuffledSubsetDataset(prefix + '_*.root', block_size=block_size, num_blocks=num_blocks)
+        assert len(dataset.input_files) == 3
+        collected = []
+        for i in range(5):
+            collected += [dataset.get_batch(np.arange(len(dataset)))['first']]
+            dataset.prepare_next_epoch()
+        dataset.exit()
+
+        collected = np.concatenate(collected)
+        assert len(np.unique(collected)) == 15 * block_size
+        assert not np.any((collected >= 5000) & (collected < 5500))
+        assert not np.any((collected >= 8500) & (collected < 8700))
+
+        dataset = RootBlockShuffledSubsetDataset(prefix + '_*.root', block_size=block_size, num_blocks=num_blocks,
+                                                 file_weights={os.path.basename(prefix) + '_1.root': 1.,
+                                                               os.path.basename(prefix) + '_0.root': 0.,
+                                                               os.path.basename(prefix) + '_2.root': 0.})
+        for i in range(3):
+            first = dataset.get_batch(np.arange(len(dataset)))['first']
+            assert np.all((first >= 5500) & (first < 8500))
+            dataset.prepare_next_epoch()
+        dataset.exit()
+
+        self._my_cleanup()
+
+    def test_StreamingBuffer(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 1000
+        num_blocks = 5
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                 streaming=True, refresh_blocks=1, prefetch_subsets=1)
+        seen = set()
+        for i in range(20):
+            first = dataset.get_batch(np.arange(len(dataset)))['first']
+            assert len(first) == block_size * num_blocks
+            seen |= set(first.tolist())
+            # Doesn't wait for the next subset, whatever is ready is used
+            t1 = time.time()
+            dataset.prepare_next_epoch()
+            assert time.time() - t1 < 0.5
+            time.sleep(0.05)
+        dataset.exit()
+
+        # The buffer got refreshed while the old subsets were being used
+        assert len(seen) > block_size * num_blocks
+        assert np.all(np.array(list(seen)) < self.total_length)
+        self._my_cleanup()
+
+        # A single pending copy of the buffer, whatever prefetch_subsets says. Every subset has at least the
+        # refreshed blocks the previous one didn't have, never a stale copy of it.
+        self._my_setup(total_length=100000)
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=num_blocks,
+                                                 streaming=True, refresh_blocks=1, prefetch_subsets=3, seed=2)
+        assert dataset.sampled_subsets_queue.max_subsets == 1
+        previous = set(dataset.get_subset()['first'].tolist())
+        for i in range(5):
+            while dataset.sampled_subsets_queue.qsize() == 0:
+                time.sleep(0.01)
+            dataset.prepare_next_epoch()
+            current = set(dataset.get_subset()['first'].tolist())
+            assert len(current - previous) >= block_size
+            previous = current
+        dataset.exit()
+
+        self._my_cleanup()
+
+    def test_MemoryBudget(self):
+        self._my_setup(total_length=20000)
+
+        block_size = 1000
+        # Two int32 branches, 8 bytes per row. Fits two subsets of 5 blocks but not of 10.
+        memory_budget = 2 * 5 * block_size * 8
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=10,
+                                                 memory_budget=memory_budget)
+        assert dataset.num_blocks == 5
+        pointers = []
+        for i in range(6):
+            first = dataset.get_batch(np.arange(len(dataset)))['first']
+            assert len(np.unique(first)) == len(dataset)
+            pointers.append(dataset.get_subset()['first'].__array_interface__['data'][0])
+            assert dataset.get_memory_usage()['total'] <= memory_budget
+            # get_batch returned a copy, the subset can be reused
+            dataset.prepare_next_epoch(release=True)
+        dataset.exit()
+
+        # The released subsets get assembled into again
+        assert len(set(pointers)) < len(pointers)
+
+        # Subsets that are not released are never overwritten, views of them stay valid
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=block_size, num_blocks=5,
+                                                 prefetch_subsets=1)
+        held = []
+        for i in range(6):
+            subset = dataset.get_subset()
+            held.append((subset['first'][:100], subset['first'][:100].copy()))
+            dataset.prepare_next_epoch()
+        dataset.exit()
+        assert all(np.all(view == copy) for view, copy in held)
+
+        self._my_cleanup()
+
+    def test_DictArrayAssembler(self):
+        blocks = [{'a': np.arange(i * 10, (i + 1) * 10), 'b': np.ones((10, 3, 3)) * i} for i in range(5)]
+        joined = {k: np.concatenate([b[k] for b in blocks]) for k in ['a', 'b']}
+
+        permutation = np.random.permutation(50)
+        assembler = DictArrayAssembler(50, permutation=permutation)
+        # Blocks can come in any order, the offsets decide where they end up
+        for i in [3, 0, 4, 1, 2]:
+            assembler.add(blocks[i], i * 10)
+        result = assembler.finish()
+        for k in ['a', 'b']:
+            assert np.all(result[k] == joined[k][permutation])
+
+        joined_torch = tensors_dict_join([{k: torch.from_numpy(v) for k, v in b.items()} for b in blocks])
+        assert torch.equal(joined_torch['a'], torch.from_numpy(joined['a']))
+        joined_numpy = tensors_dict_join([{k: torch.from_numpy(v) for k, v in b.items()} for b in blocks], to_numpy=True)
+        assert isinstance(joined_numpy['b'], np.ndarray) and np.all(joined_numpy['b'] == joined['b'])
+
+
+    def test_TreeIndex(self):
+        self._my_setup(total_length=20000)
+
+        index = load_tree_index(self.test_file)
+        assert os.path.exists(get_tree_index_path(self.test_file))
+        assert index['num_entries'] == 20000 and set(index['keys']) == {'first', 'second'}
+
+        # Served from the sidecar as long as the file is unchanged, rebuilt once it changes
+        assert load_tree_index(self.test_file) == index
+        file2 = uproot.recreate(self.test_file)
+        file2['DecayTree'] = {'first': np.arange(100)}
+        file2.close()
+        os.utime(self.test_file, (0, 0))
+        assert load_tree_index(self.test_file)['num_entries'] == 100
+
+        dataset = RootBlockShuffledSubsetDataset(self.test_file, block_size=10, num_blocks=5)
+        assert len(dataset.get_subset()['first']) == 50
+        dataset.exit()
+
+        self._my_cleanup()
+
 
 if __name__ == '__main__':
     unittest.main()